@@ -4,13 +4,19 @@ __version__ = '0.5'
 
 import os
 import sys
+import hmac
+import hashlib
 import flask
 from werkzeug.utils import cached_property
 from flask.ext.uploads import configure_uploads, patch_request_class
 from dulwich.repo import Repo
 
-from .environment import alter_environment
-from . import document, view
+from .cache import LRUCache, FileSystemCache
+from .shards import (
+    ShardRouter, open_repository, shard_paths, split_repository)
+from .environment import alter_environment, TemplateCache
+from .maintenance import GRACE_PERIOD, maintain
+from . import document, view, pdf, jobs
 from .helpers import with_metaclass
 from .view import auth_url_for
 
@@ -43,9 +49,36 @@ class Pynuts(object):
                                    os.path.join(app.instance_path, 'uploads'))
         self.app.config.setdefault('PYNUTS_DOCUMENT_REPOSITORY',
                                    'documents.git')
+        self.app.config.setdefault('PYNUTS_DOCUMENT_SHARDS', None)
+        self.app.config.setdefault('PYNUTS_DOCUMENT_SHARD_BY', 'id')
+        self.app.config.setdefault('PYNUTS_ENVIRONMENT_CACHE_SIZE', 64)
+        self.app.config.setdefault('PYNUTS_TEMPLATE_CACHE_SIZE', 256)
+        self.app.config.setdefault('PYNUTS_DIRECTIVE_CACHE_SIZE', 1024)
+        self.app.config.setdefault('PYNUTS_DOCTREE_CACHE_SIZE', 32)
+        self.app.config.setdefault('PYNUTS_RENDER_CACHE', None)
+        self.app.config.setdefault('PYNUTS_RENDER_CACHE_SIZE', 128)
+        self.app.config.setdefault('PYNUTS_RENDER_CACHE_PATH', 'render_cache')
+        self.app.config.setdefault('PYNUTS_PDF_RENDERER', 'inline')
+        self.app.config.setdefault('PYNUTS_PDF_PROCESSES', None)
+        self.app.config.setdefault('PYNUTS_PDF_TIMEOUT', None)
+        self.app.config.setdefault('PYNUTS_PDF_QUEUE_SIZE', None)
+        self.app.config.setdefault('PYNUTS_JOB_DATABASE', 'jobs.sqlite')
+        self.app.config.setdefault('PYNUTS_JOB_THREADS', 2)
+        self.app.config.setdefault('PYNUTS_JOB_TIMEOUT', 600)
+        self.app.config.setdefault('PYNUTS_JOB_MAX_AGE', 86400)
+        self.app.config.setdefault('PYNUTS_RESOURCE_MAX_AGE', 31536000)
+        self.app.config.setdefault('PYNUTS_RESOURCE_CACHE_CONTROL', 'private')
+        self.app.config.setdefault('PYNUTS_PACK_OBJECTS', False)
+        self.app.config.setdefault('PYNUTS_MERGE_RETRIES', 0)
+        self.app.config.setdefault('PYNUTS_GRACE_PERIOD', GRACE_PERIOD)
 
         self.documents = {}
         self.views = {}
+        # (signature, tree id) of the stored model directories, by
+        # repository path and model path
+        self.model_trees = {}
+        # Indexes of the document branches, by repository path and base
+        self.ref_indexes = {}
 
         # Serve files from the Pynuts static folder
         # at the /_pynuts/static/<path:filename> URL
@@ -55,6 +88,9 @@ class Pynuts(object):
             '/_pynuts/update_content', '_pynuts-update_content',
             lambda: document.update_content(self),
             methods=('POST',))
+        self.app.add_url_rule(
+            '/_pynuts/jobs/<ticket>', '_pynuts-job',
+            lambda ticket: self.job_queue.response(ticket))
 
         class Document(document.Document):
             """Document base class of the application."""
@@ -131,11 +167,207 @@ class Pynuts(object):
                 self.app.config.get('PYNUTS_DOCUMENT_REPOSITORY')))
         # If document_repository_path does not exist,
         # create it (and possible parent folders) and initialize the bare repo
-        if os.path.exists(self.document_repository_path):
-            return Repo(self.document_repository_path)
-        else:
-            os.makedirs(self.document_repository_path)
-            return Repo.init_bare(self.document_repository_path)
+        return open_repository(self.document_repository_path)
+
+    @cached_property
+    def repository_router(self):
+        """Return the :class:`pynuts.shards.ShardRouter` of the documents.
+
+        If the ``PYNUTS_DOCUMENT_SHARDS`` configuration key is set, documents
+        are stored in this number of repositories, whose paths are given by
+        ``PYNUTS_DOCUMENT_REPOSITORY`` (see :func:`pynuts.shards.shard_paths`),
+        and routed by id or by type according to the
+        ``PYNUTS_DOCUMENT_SHARD_BY`` configuration key. Otherwise, all the
+        documents are stored in :attr:`document_repository`.
+
+        """
+        shards = self.app.config.get('PYNUTS_DOCUMENT_SHARDS')
+        if not shards:
+            return ShardRouter(
+                [self.document_repository.path],
+                repositories=[self.document_repository])
+        return ShardRouter(shard_paths(os.path.join(
+            self.app.instance_path,
+            self.app.config.get('PYNUTS_DOCUMENT_REPOSITORY')), shards),
+            self.app.config.get('PYNUTS_DOCUMENT_SHARD_BY'))
+
+    def split_document_repository(self, source=None):
+        """Copy the documents of the unsharded repository to the shards.
+
+        Return the number of branches copied by shard.
+
+        :param source: path of the repository to split, default is
+            ``PYNUTS_DOCUMENT_REPOSITORY`` without shard placeholder
+
+        """
+        if source is None:
+            source = os.path.join(
+                self.app.instance_path,
+                self.app.config.get('PYNUTS_DOCUMENT_REPOSITORY'))
+        return split_repository(Repo(source), self.repository_router)
+
+    def maintain(self, prune=True, grace_period=None, refs=True):
+        """Pack the objects and the refs of the document repositories.
+
+        Return a dict of the reports of :func:`pynuts.maintenance.maintain`,
+        keyed by repository path.
+
+        :param prune: whether to remove the unreachable objects
+        :param grace_period: number of seconds before unreachable objects
+            are removed, default is the ``PYNUTS_GRACE_PERIOD``
+            configuration key
+        :param refs: whether to pack the refs
+
+        """
+        if grace_period is None:
+            grace_period = self.app.config['PYNUTS_GRACE_PERIOD']
+        return dict(
+            (repository.path, maintain(
+                repository, prune=prune, grace_period=grace_period,
+                refs=refs))
+            for repository in self.repository_router.repositories())
+
+    @cached_property
+    def environment_cache(self):
+        """Return the cache of the document Jinja2 environments.
+
+        Environments are keyed by commit SHA and shared by all the documents
+        of a given version, so that their templates are only compiled once.
+        Its size is given by the ``PYNUTS_ENVIRONMENT_CACHE_SIZE``
+        configuration key.
+
+        """
+        return LRUCache(self.app.config.get('PYNUTS_ENVIRONMENT_CACHE_SIZE'))
+
+    @cached_property
+    def template_cache(self):
+        """Return the cache of the compiled document templates.
+
+        Templates are keyed by name and source, so that the environments of
+        the different versions of a document only compile the templates that
+        have changed. Its size is given by the ``PYNUTS_TEMPLATE_CACHE_SIZE``
+        configuration key.
+
+        """
+        return TemplateCache(
+            LRUCache(self.app.config.get('PYNUTS_TEMPLATE_CACHE_SIZE')))
+
+    @cached_property
+    def directive_cache(self):
+        """Return the cache of the document parts read by directives.
+
+        The blob SHAs of the parts are keyed by commit SHA and part name,
+        and their contents by blob SHA, so that they are shared by all the
+        renders including the ``editable`` and ``content`` directives. The
+        HTML of the directives is keyed by their source and by the blob SHA
+        of their part, and the HTML of the default contents of ``editable``
+        directives by a hash of their source. Its size is given by the
+        ``PYNUTS_DIRECTIVE_CACHE_SIZE`` configuration key.
+
+        """
+        return LRUCache(self.app.config.get('PYNUTS_DIRECTIVE_CACHE_SIZE'))
+
+    @cached_property
+    def fragment_key(self):
+        """Return the secret key signing the directive markers of documents.
+
+        The key is derived from the ``SECRET_KEY`` of the application, or is
+        random if there is none, so that the ReST source of a document cannot
+        include forged markers rendering other documents.
+
+        """
+        secret = self.app.secret_key or os.urandom(32)
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        return hmac.new(secret, b'pynuts-fragments', hashlib.sha1).digest()
+
+    @cached_property
+    def version_token(self):
+        """Return the string replacing the version of documents in their
+        ReST source and in their rendered HTML.
+
+        Versions with the same source share their parsed and written HTML.
+        The token is derived from :attr:`fragment_key`, so that documents
+        cannot include it, and only the token is replaced by the version.
+
+        """
+        return 'pynutsversion' + hmac.new(
+            self.fragment_key, b'pynuts-version', hashlib.sha1).hexdigest()
+
+    @cached_property
+    def doctree_cache(self):
+        """Return the cache of the parsed ReST documents.
+
+        Pickled doctrees are keyed by a hash of their ReST source and of the
+        parser settings, so that a document is parsed once when its HTML
+        parts are rendered many times. Its size is given by the
+        ``PYNUTS_DOCTREE_CACHE_SIZE`` configuration key.
+
+        """
+        return LRUCache(self.app.config.get('PYNUTS_DOCTREE_CACHE_SIZE'))
+
+    @cached_property
+    def render_cache(self):
+        """Return the cache of the rendered documents, or ``None``.
+
+        The ``PYNUTS_RENDER_CACHE`` configuration key can be ``'memory'`` for
+        an in-memory LRU cache of ``PYNUTS_RENDER_CACHE_SIZE`` items,
+        ``'filesystem'`` for a cache stored in the
+        ``PYNUTS_RENDER_CACHE_PATH`` directory (taken relatively to the
+        application instance path), ``None`` to disable the cache, or any
+        object with ``get(key)`` and ``set(key, value)`` methods.
+
+        """
+        cache = self.app.config.get('PYNUTS_RENDER_CACHE')
+        if cache == 'memory':
+            return LRUCache(self.app.config.get('PYNUTS_RENDER_CACHE_SIZE'))
+        elif cache == 'filesystem':
+            return FileSystemCache(os.path.join(
+                self.app.instance_path,
+                self.app.config.get('PYNUTS_RENDER_CACHE_PATH')))
+        return cache
+
+    @cached_property
+    def pdf_renderer(self):
+        """Return the engine rendering the PDF documents.
+
+        The ``PYNUTS_PDF_RENDERER`` configuration key can be ``'inline'`` to
+        render documents in the current thread, ``'process'`` to render them
+        in a pool of ``PYNUTS_PDF_PROCESSES`` processes, waiting at most
+        ``PYNUTS_PDF_TIMEOUT`` seconds with at most ``PYNUTS_PDF_QUEUE_SIZE``
+        pending documents, or any object with a ``render(html)`` method
+        returning a PDF bytestring.
+
+        """
+        renderer = self.app.config.get('PYNUTS_PDF_RENDERER')
+        if renderer == 'inline':
+            return pdf.InlineRenderer()
+        elif renderer == 'process':
+            return pdf.ProcessPoolRenderer(
+                self.app,
+                processes=self.app.config.get('PYNUTS_PDF_PROCESSES'),
+                timeout=self.app.config.get('PYNUTS_PDF_TIMEOUT'),
+                queue_size=self.app.config.get('PYNUTS_PDF_QUEUE_SIZE'))
+        return renderer
+
+    @cached_property
+    def job_queue(self):
+        """Return the queue of the background PDF jobs.
+
+        Jobs are rendered by ``PYNUTS_JOB_THREADS`` threads, and stored in the
+        ``PYNUTS_JOB_DATABASE`` SQLite database, taken relatively to the
+        application instance path. Lost jobs are enqueued again after
+        ``PYNUTS_JOB_TIMEOUT`` seconds, and jobs are purged after
+        ``PYNUTS_JOB_MAX_AGE`` seconds.
+
+        """
+        store = jobs.JobStore(os.path.join(
+            self.app.instance_path,
+            self.app.config.get('PYNUTS_JOB_DATABASE')))
+        return jobs.JobQueue(
+            self.app, store, self.app.config.get('PYNUTS_JOB_THREADS'),
+            timeout=self.app.config.get('PYNUTS_JOB_TIMEOUT'),
+            max_age=self.app.config.get('PYNUTS_JOB_MAX_AGE'))
 
     def render_rest(self, document_type, part='index.rst.jinja2',
                     **kwargs):
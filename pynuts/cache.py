@@ -0,0 +1,118 @@
+"""Caches for Pynuts."""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class LRUCache(object):
+    """Thread-safe mapping discarding the least recently used items first.
+
+    :param size: maximum number of items kept, ``0`` disables the cache
+
+    The ``hits`` and ``misses`` attributes count the successful and failed
+    calls to :meth:`get`.
+
+    """
+    def __init__(self, size=128):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Return the value stored for `key`, or `default`."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Move the key at the end of the queue
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store `value` for `key`, discarding the oldest items if needed."""
+        with self._lock:
+            self._items.pop(key, None)
+            if not self.size:
+                return
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """Remove all the items and reset the counters."""
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+
+class FileSystemCache(object):
+    """Content-addressed cache storing pickled values in a directory.
+
+    Each value is stored in a file named after the SHA1 hash of its key, so
+    that the cache can be shared between processes. Files are written
+    atomically, and unreadable files are considered as missing.
+
+    :param path: directory where the values are stored, created if needed
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def _filename(self, key):
+        """Return the name of the file storing the value of `key`."""
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def get(self, key, default=None):
+        """Return the value stored for `key`, or `default`."""
+        try:
+            with open(self._filename(key), 'rb') as fd:
+                value = pickle.load(fd)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store `value` for `key`."""
+        filename = self._filename(key)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process in the meantime
+                pass
+        fd, temp_filename = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as temp_file:
+            pickle.dump(value, temp_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, filename)
+
+    def clear(self):
+        """Remove all the stored values and reset the counters."""
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.hits = self.misses = 0
@@ -1,6 +1,10 @@
 """Directives for Pynuts documents."""
 
+import re
+import hmac
 import json
+import base64
+import hashlib
 
 from docutils.parsers.rst import directives, Directive
 import docutils.core
@@ -8,18 +12,265 @@ import docutils.core
 from .git import NotFoundError
 
 
+_COMMIT_ID = re.compile('^[0-9a-f]{40}$')
+_FRAGMENT = re.compile(
+    '<!--pynuts-fragment:([A-Za-z0-9+/=]*):([0-9a-f]{40})-->')
+
+
+def _sha1(text):
+    """Return the hexadecimal SHA1 hash of the unicode `text`."""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _signature(key, payload):
+    """Return the signature of the `payload` of a fragment marker."""
+    return hmac.new(key, payload.encode('ascii'), hashlib.sha1).hexdigest()
+
+
+def fragment_setting(pynuts):
+    """Return the value of the ``pynuts_fragments`` docutils setting.
+
+    The value identifies the key signing the markers, so that documents
+    parsed with other keys are not shared by the caches.
+
+    """
+    return hashlib.sha1(pynuts.fragment_key).hexdigest()
+
+
+class DocumentRegistry(object):
+    """Documents and parts used by the directives of a render.
+
+    Each document version is created once, and each part is read once, even
+    when many directives refer to them. Parts are also kept across renders
+    in :attr:`pynuts.Pynuts.directive_cache`, with their blob SHAs, the HTML
+    of the default contents and the HTML of the fragments.
+
+    A registry is created for each render, and can be shared by many renders
+    with the ``_pynuts_registry`` docutils setting.
+
+    :param pynuts: the :class:`pynuts.Pynuts` application
+
+    """
+    def __init__(self, pynuts):
+        self._pynuts = pynuts
+        self._documents = {}
+        self._blobs = {}
+        self._contents = {}
+        self._fragments = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Return the registry of the docutils `settings`, created if
+        needed.
+
+        """
+        registry = getattr(settings, '_pynuts_registry', None)
+        if registry is None:
+            registry = settings._pynuts_registry = cls(settings._pynuts)
+        return registry
+
+    def document(self, document_type, document_id, version):
+        """Return the document of `version`, created once."""
+        key = (document_type, document_id, version)
+        if key not in self._documents:
+            cls = self._pynuts.documents[document_type]
+            self._documents[key] = cls(document_id, version)
+        return self._documents[key]
+
+    def blob_id(self, document_type, document_id, version, part):
+        """Return the blob SHA of `part` in the document of `version`, or
+        ``None`` if the document or the part does not exist.
+
+        """
+        key = (document_type, document_id, version, part)
+        if key not in self._blobs:
+            self._blobs[key] = self._blob_id(*key)
+        return self._blobs[key]
+
+    def read(self, document_type, document_id, version, part):
+        """Return the content of `part` in the document of `version`.
+
+        :raises: NotFoundError if the document or the part does not exist
+
+        """
+        blob_id = self.blob_id(document_type, document_id, version, part)
+        if blob_id is None:
+            raise NotFoundError('%s not found in %s/%s/%s.' % (
+                part, document_type, document_id, version))
+        if blob_id not in self._contents:
+            cache = self._pynuts.directive_cache
+            content = cache.get(('blob', blob_id))
+            if content is None:
+                document = self.document(document_type, document_id, version)
+                content = document.git.read(part).decode('utf-8')
+                cache.set(('blob', blob_id), content)
+            self._contents[blob_id] = content
+        return self._contents[blob_id]
+
+    def default_html(self, source):
+        """Return the HTML body of the ReST `source` of a default content.
+
+        Defaults are rendered once, and kept in
+        :attr:`pynuts.Pynuts.directive_cache` with a hash of their source.
+
+        """
+        cache = self._pynuts.directive_cache
+        key = ('default', _sha1(source))
+        html = cache.get(key)
+        if html is None:
+            html = docutils.core.publish_parts(
+                source, writer_name='html')['body']
+            cache.set(key, html)
+        return html
+
+    def fragment_html(self, spec, version=None):
+        """Return the HTML of the directive given by the JSON `spec` of a
+        fragment marker.
+
+        The HTML is kept in :attr:`pynuts.Pynuts.directive_cache`, keyed by
+        the spec and by the blob SHA of the part, so that it is only rendered
+        again when the part or the templates of its renderer change.
+
+        :param spec: JSON spec of the directive, where the version of the
+            rendered document is replaced by
+            :attr:`pynuts.Pynuts.version_token`
+        :param version: version of the rendered document, if any
+
+        """
+        if spec in self._fragments:
+            return self._fragments[spec]
+        token = self._pynuts.version_token
+        real_spec = spec.replace(token, version) if version else spec
+        directive = _Tag.from_spec(json.loads(real_spec))
+        if directive is None:
+            return ''
+        cache = self._pynuts.directive_cache
+        try:
+            part_key = directive.part_key()
+        except ValueError:
+            part_key = None
+        key = None
+        if part_key is not None:
+            key = ('fragment', _sha1(spec), self.blob_id(*part_key))
+            entry = cache.get(key)
+            if entry is not None:
+                templates, start_tag, content = entry
+                if not templates or self.document(
+                        *part_key[:3]).git.blobs_unchanged(templates):
+                    if version:
+                        start_tag = start_tag.replace(token, version)
+                    html = '%s%s</div>' % (start_tag, content)
+                    self._fragments[spec] = html
+                    return html
+        start_tag, content = directive.render_parts(self)
+        if key is not None:
+            cache.set(key, (
+                directive.templates,
+                start_tag.replace(version, token) if version
+                else start_tag, content))
+        html = '%s%s</div>' % (start_tag, content)
+        self._fragments[spec] = html
+        return html
+
+    def _blob_id(self, document_type, document_id, version, part):
+        """Return the blob SHA of `part`, or ``None`` if it does not exist.
+
+        The SHAs of the parts of commits are immutable, and are kept in
+        :attr:`pynuts.Pynuts.directive_cache`.
+
+        """
+        cache = self._pynuts.directive_cache
+        commit_key = None
+        if version and _COMMIT_ID.match(version):
+            commit_key = (version, part)
+            blob_id = cache.get(commit_key)
+            if blob_id is not None:
+                return blob_id or None
+        document = self.document(document_type, document_id, version)
+        try:
+            blob_id = document.git.find_entry(part)[1].decode('ascii')
+        except (NotFoundError, ValueError):
+            blob_id = ''
+        if commit_key:
+            cache.set(commit_key, blob_id)
+        return blob_id or None
+
+
 class _Tag(Directive):
-    """ReST abstact directive used for Editable and Content."""
+    """ReST abstact directive used for Editable and Content.
+
+    The directive is rendered as a ``div`` tag including the content of the
+    part given by its argument, or its own content if the part does not
+    exist.
+
+    When the ``pynuts_fragments`` docutils setting is set, the directive is
+    rendered as a signed marker, replaced by its HTML in
+    :func:`render_fragments`.
+
+    """
     required_arguments = 1
     optional_arguments = 0
     final_argument_whitespace = True
     has_content = True
 
+    #: Blob SHAs of the templates used to render the content, keyed by path
+    templates = {}
+
     def run(self):
+        settings = self.state.document.settings
+        if getattr(settings, 'pynuts_fragments', False):
+            content = self.fragment_marker(settings._pynuts.fragment_key)
+        else:
+            content = self.render(DocumentRegistry.from_settings(settings))
+        return [docutils.nodes.raw('', content, format='html')]
+
+    @staticmethod
+    def from_spec(spec):
+        """Return the directive given by the dict `spec` of a fragment
+        marker, or ``None`` if its class does not exist.
+
+        """
+        cls = _tag_classes().get(spec['directive'])
+        if cls is not None:
+            return cls(
+                spec['name'], spec['arguments'], spec['options'],
+                spec['content'], 0, 0, '', None, None)
+
+    def fragment_marker(self, key):
+        """Return the HTML comment marking the place of the directive,
+        signed with `key`.
+
+        """
+        spec = json.dumps({
+            'directive': '%s.%s' % (
+                type(self).__module__, type(self).__name__),
+            'name': self.name,
+            'arguments': self.arguments,
+            'options': self.options,
+            'content': list(self.content)}, sort_keys=True)
+        payload = base64.b64encode(spec.encode('utf-8')).decode('ascii')
+        return '<!--pynuts-fragment:%s:%s-->' % (
+            payload, _signature(key, payload))
+
+    def part_key(self):
+        """Return the document type, id, version and part of the argument.
+
+        :raises: ValueError if the argument is not valid
+
+        """
         document_type, document_id, version, part = \
             self.arguments[0].split('/')
-        cls = self.state.document.settings._pynuts.documents[document_type]
-        self.document = cls(document_id, version)
+        return document_type, document_id, version, part
+
+    def read(self, registry):
+        """Read the content of the part given by the directive.
+
+        :raises: NotFoundError if the document or the part does not exist
+
+        """
+        document_type, document_id, version, part = self.part_key()
+        self.registry = registry
+        self.document_key = (document_type, document_id, version)
         self.attributes = {
             'data-document-version': version,
             'data-part': part,
@@ -30,7 +281,30 @@ class _Tag(Directive):
             key: ' '.join(values) for key, values in self.options.items()})
         self.attributes = {
             key: value for key, value in self.attributes.items() if value}
-        self.parsed_content = self.document.git.read(part).decode('utf-8')
+        self.parsed_content = registry.read(
+            document_type, document_id, version, part)
+
+    def render(self, registry):
+        """Return the HTML of the directive."""
+        return '%s%s</div>' % self.render_parts(registry)
+
+    def render_parts(self, registry):
+        """Return the start tag and the inner HTML of the directive."""
+        try:
+            self.read(registry)
+        except NotFoundError:
+            self.parsed_content = '\n'.join(self.content)
+        return self.start_tag(), self.parsed_content or ''
+
+    def start_tag(self):
+        """Return the start tag of the directive, with its attributes."""
+        return '<div %s>' % ' '.join(
+            ('%s="%s"' % a) for a in self.attributes.items())
+
+    @property
+    def document(self):
+        """Document of the directive, created on first access."""
+        return self.registry.document(*self.document_key)
 
 
 class Editable(_Tag):
@@ -53,12 +327,12 @@ class Editable(_Tag):
         'contenteditable': directives.class_option,
     }
 
-    def run(self):
+    def render_parts(self, registry):
         try:
-            super(Editable, self).run()
+            self.read(registry)
         except NotFoundError:
-            self.parsed_content = docutils.core.publish_parts(
-                '\n'.join(self.content), writer_name='html')['body']
+            self.parsed_content = registry.default_html(
+                '\n'.join(self.content))
         for key in self.option_spec:
             if key == 'title':
                 self.attributes[key] = self.options.get(key)
@@ -66,10 +340,7 @@ class Editable(_Tag):
                 self.attributes[key] = ' '.join(self.options.get(key, ['true']))
             else:
                 self.attributes[key] = ' '.join(self.options.get(key, []))
-        content = '<div %s>%s</div>' % (
-            ' '.join(('%s="%s"' % a) for a in self.attributes.items()),
-            self.parsed_content or '')
-        return [docutils.nodes.raw('', content, format='html')]
+        return self.start_tag(), self.parsed_content or ''
 
 directives.register_directive('editable', Editable)
 
@@ -114,17 +385,78 @@ class Content(_Tag):
         'renderer': directives.unchanged,
     }
 
-    def run(self):
+    def render_parts(self, registry):
+        """Return the start tag and the HTML given by the renderer.
+
+        The blob SHAs of the templates loaded by the environment of the
+        document are stored in :attr:`templates`, so that the HTML is
+        rendered again when they change. Renderers must only depend on their
+        data and on these templates.
+
+        """
         try:
-            super(Content, self).run()
+            self.read(registry)
         except NotFoundError:
             self.parsed_content = '\n'.join(self.content)
         render = getattr(
-            self.document, 'render_%s' % self.options.pop('renderer'))
+            self.document, 'render_%s' % self.options['renderer'])
         self.attributes.pop('renderer', None)
-        content = '<div data-content="true" %s>%s</div>' % (
-            ' '.join(('%s="%s"' % a) for a in self.attributes.items()),
-            render(json.loads(self.parsed_content)) or '')
-        return [docutils.nodes.raw('', content, format='html')]
+        content = render(json.loads(self.parsed_content)) or ''
+        self.templates = dict(getattr(
+            self.document.jinja_environment, 'pynuts_templates', {}))
+        return self.start_tag(), content
+
+    def start_tag(self):
+        return '<div data-content="true" %s>' % ' '.join(
+            ('%s="%s"' % a) for a in self.attributes.items())
 
 directives.register_directive('content', Content)
+
+
+def _tag_classes():
+    """Return a dict of the directives rendered as fragments, keyed by
+    module and class name.
+
+    """
+    classes = {}
+    stack = [_Tag]
+    while stack:
+        cls = stack.pop()
+        classes['%s.%s' % (cls.__module__, cls.__name__)] = cls
+        stack.extend(cls.__subclasses__())
+    return classes
+
+
+def render_fragments(html, registry, version=None):
+    """Replace the fragment markers in `html` by the HTML of their
+    directives.
+
+    The version token is replaced in the rest of `html` before the
+    fragments are inserted, and markers without a valid signature are left
+    unchanged.
+
+    :param html: HTML rendered with the ``pynuts_fragments`` setting
+    :param registry: the :class:`DocumentRegistry` of the render
+    :param version: version of the document replaced by
+        :attr:`pynuts.Pynuts.version_token` in the ReST source, if any
+
+    """
+    key = registry._pynuts.fragment_key
+    token = registry._pynuts.version_token
+    pieces = _FRAGMENT.split(html)
+    output = []
+    for index in range(0, len(pieces), 3):
+        text = pieces[index]
+        if version:
+            text = text.replace(token, version)
+        output.append(text)
+        if index + 1 < len(pieces):
+            payload, signature = pieces[index + 1:index + 3]
+            if not hmac.compare_digest(
+                    _signature(key, payload), str(signature)):
+                output.append('<!--pynuts-fragment:%s:%s-->' % (
+                    payload, signature))
+                continue
+            spec = base64.b64decode(payload).decode('utf-8')
+            output.append(registry.fragment_html(spec, version))
+    return ''.join(output)
@@ -1,27 +1,51 @@
 """Document file for Pynuts."""
 
 import os
+import re
+import json
+import heapq
+import itertools
+import numbers
+import hashlib
 import datetime
-import docutils
 import jinja2
-import docutils.core
 import mimetypes
 from flask import (
-    Response, render_template, request, redirect, flash, url_for, jsonify)
+    Response, render_template, request, redirect, flash, url_for, jsonify,
+    stream_with_context, abort)
 from werkzeug.datastructures import Headers
-from flask_weasyprint import HTML
-from docutils_html5 import Writer
+from werkzeug.utils import cached_property
+from werkzeug.wsgi import wrap_file
 
 try:
     from urllib import quote, unquote
 except ImportError:
     from urllib.parse import quote, unquote
 
+try:
+    unicode
+except NameError:  # Python 3
+    unicode = str
+
 from .environment import create_environment
-from .git import Git, ConflictError
+from .git import (
+    Git, GitException, ConflictError, NotFoundError, RefIndex,
+    refresh_packed_refs)
+from .pdf import iter_zip
+from .rest import parts_key, publish_parts
+from .directives import (
+    DocumentRegistry, fragment_setting, render_fragments)
 from .helpers import with_metaclass
 
 
+def _data_key(value):
+    """Return the JSON-serializable key of ``value``, used in cache keys."""
+    cache_key = getattr(value, 'cache_key', None)
+    if cache_key is None:
+        raise TypeError('%r has no cache key' % (value,))
+    return cache_key()
+
+
 class InvalidId(ValueError):
     """The '/' character is not allowed in document identifiers."""
 
@@ -60,9 +84,6 @@ class Document(object, with_metaclass(MetaDocument)):
     :type version: str
 
     """
-    #: Jinja Environment
-    jinja_environment = None
-
     #: Docutils settings
     docutils_settings = None
 
@@ -86,16 +107,9 @@ class Document(object, with_metaclass(MetaDocument)):
             raise InvalidId("The '/' character is not allowed in "
                             "document identifiers.")
         self.document_id = document_id
-        self.git = Git(
-            self._pynuts.document_repository, branch=self.branch,
-            commit=version)
-        self.archive_git = Git(
-            self._pynuts.document_repository, branch=self.archive_branch)
-
-        loader = self.git.jinja_loader()
-        self.jinja_environment = create_environment(loader)
-        self.jinja_environment.globals['render_rest'] = \
-            self._pynuts.render_rest
+        # Git objects and the Jinja2 environment are created on first access
+        self._version = version
+        self._version_info = None
         # Take the class attribute
         docutils_settings = dict(self.docutils_settings or {})
         docutils_settings['_pynuts'] = self._pynuts
@@ -103,18 +117,181 @@ class Document(object, with_metaclass(MetaDocument)):
         self.docutils_settings = docutils_settings
         self.data = None
 
+    @cached_property
+    def git(self):
+        """:class:`Git` object of the document version, created on first
+        access.
+
+        """
+        return Git(
+            self.repository, branch=self.branch, commit=self._head_id(),
+            pack=self._app.config.get('PYNUTS_PACK_OBJECTS'),
+            merge_retries=self._app.config.get('PYNUTS_MERGE_RETRIES'))
+
+    @cached_property
+    def archive_git(self):
+        """:class:`Git` object of the document archives, created on first
+        access.
+
+        """
+        return Git(
+            self.repository, branch=self.archive_branch,
+            pack=self._app.config.get('PYNUTS_PACK_OBJECTS'),
+            merge_retries=self._app.config.get('PYNUTS_MERGE_RETRIES'))
+
+    @cached_property
+    def jinja_environment(self):
+        """Jinja2 environment of the document version, created on first
+        access.
+
+        """
+        return self._get_environment()
+
+    @cached_property
+    def repository(self):
+        """Repository storing the document, given by
+        :attr:`pynuts.Pynuts.repository_router`.
+
+        """
+        return self._pynuts.repository_router.repository(
+            self.type_name, self.document_id)
+
+    def _head_id(self):
+        """Return the SHA1 hash of the document version, or ``None``.
+
+        The branch is only read once, so that the document attributes and
+        its Git object all refer to the same version.
+
+        """
+        if 'git' in self.__dict__:
+            return self.git.head.id if self.git.head else None
+        if self._version is None:
+            refresh_packed_refs(self.repository)
+            self._version = self.repository.refs.read_ref(
+                ('refs/heads/' + self.branch).encode('utf-8'))
+        return self._version
+
+    def _head(self):
+        """Return the latest commit of the document, or a
+        :class:`pynuts.git.VersionInfo` record with the same attributes.
+
+        """
+        if 'git' not in self.__dict__ and self._version_info is not None:
+            return self._version_info
+        return self.git.head
+
+    def _get_environment(self):
+        """Return the Jinja2 environment of the document version.
+
+        As commits are immutable, environments are shared between the
+        documents of a same version, and their templates are only compiled
+        once. Their loaders use their own :class:`Git` object, so that writing
+        in ``self.git`` never alters the cached templates.
+
+        """
+        if not self.git.head:
+            return self._create_environment(self.git)
+        cache = self._pynuts.environment_cache
+        environment = cache.get(self.git.head.id)
+        if environment is None:
+            environment = self._create_environment(Git(
+                self.repository, commit=self.git.head.id))
+            cache.set(self.git.head.id, environment)
+        return environment
+
+    def _create_environment(self, git):
+        """Create a new Jinja2 environment loading templates from `git`."""
+        templates = {}
+        environment = create_environment(
+            git.jinja_loader(dependencies=templates),
+            self._pynuts.template_cache)
+        environment.globals['render_rest'] = self._pynuts.render_rest
+        # Blob SHAs of the templates loaded by the environment
+        environment.pynuts_templates = templates
+        return environment
+
     @classmethod
-    def list_document_ids(cls):
-        """Return a list of document ids."""
+    def _ref_indexes(cls):
+        """Return the list of the :class:`pynuts.git.RefIndex` of the
+        document branches, one for each repository storing documents.
+
+        """
         base = b'refs/heads/documents/' + quote(
-            cls.type_name.encode('utf-8')).encode('utf-8')
-        for doc_id in cls._pynuts.document_repository.refs.keys(base=base):
+            cls.type_name.encode('utf-8')).encode('utf-8') + b'/'
+        indexes = []
+        for repository in cls._pynuts.repository_router.repositories(
+                cls.type_name):
+            key = (repository.path, base)
+            index = cls._pynuts.ref_indexes.get(key)
+            if index is None or index.repository is not repository:
+                index = cls._pynuts.ref_indexes[key] = RefIndex(
+                    repository, base)
+            indexes.append(index)
+        return indexes
+
+    @classmethod
+    def list_document_ids(cls, prefix=None, after=None, offset=0, limit=None):
+        """Return a list of document ids, sorted by quoted id.
+
+        Ids are sorted by the bytes of their quoted form, used in branch
+        names, rather than by the ids themselves: ``'10'`` comes before
+        ``'9'``, and non-ASCII characters, quoted as ``%XX``, come before
+        digits and letters.
+
+        Ids are read from a cached index of the document branches, read
+        again when branches are added or removed.
+
+        :param prefix: only return the ids starting with `prefix`
+        :param after: only return the ids following the id `after`
+        :param offset: number of ids to skip
+        :param limit: maximum number of ids, ``None`` for no limit
+
+        """
+        prefix = cls._quote_id(prefix) if prefix else b''
+        after = cls._quote_id(after) if after is not None else None
+        indexes = cls._ref_indexes()
+        if len(indexes) == 1:
+            names = indexes[0].range(
+                prefix=prefix, after=after, offset=offset, limit=limit)
+        else:
+            # Merge the sorted names of the shards
+            names = heapq.merge(*[index.range(
+                prefix=prefix, after=after,
+                limit=None if limit is None else offset + limit)
+                for index in indexes])
+            names = itertools.islice(
+                names, offset, None if limit is None else offset + limit)
+        for doc_id in names:
             yield unquote(doc_id.decode('utf-8'))
 
     @classmethod
-    def list_documents(cls):
-        """Return the whole document list."""
-        return (cls(doc_id) for doc_id in cls.list_document_ids())
+    def count_documents(cls, prefix=None):
+        """Return the number of documents.
+
+        :param prefix: only count the ids starting with `prefix`
+
+        """
+        prefix = cls._quote_id(prefix) if prefix else b''
+        return sum(index.count(prefix) for index in cls._ref_indexes())
+
+    @staticmethod
+    def _quote_id(document_id):
+        """Return the document id as quoted in branch names."""
+        return quote(('%s' % document_id).encode('utf-8')).encode('utf-8')
+
+    @classmethod
+    def list_documents(cls, prefix=None, after=None, offset=0, limit=None):
+        """Return the whole document list.
+
+        :param prefix: only return the documents whose ids start with
+            `prefix`
+        :param after: only return the documents following the id `after`
+        :param offset: number of documents to skip
+        :param limit: maximum number of documents, ``None`` for no limit
+
+        """
+        return (cls(doc_id) for doc_id in cls.list_document_ids(
+            prefix=prefix, after=after, offset=offset, limit=limit))
 
     @property
     def branch(self):
@@ -133,7 +310,10 @@ class Document(object, with_metaclass(MetaDocument)):
     @property
     def version(self):
         """Actual git version of the document."""
-        return bytes(self.git.head.id).decode('ascii')
+        version = self._head_id()
+        if hasattr(version, 'decode'):
+            version = version.decode('ascii')
+        return version
 
     @property
     def datetime(self):
@@ -141,30 +321,96 @@ class Document(object, with_metaclass(MetaDocument)):
         object.
 
         """
-        return datetime.datetime.utcfromtimestamp(self.git.head.commit_time)
+        return datetime.datetime.utcfromtimestamp(self._head().commit_time)
 
     @property
     def author(self):
         """Author of the document latest commit."""
-        return self.git.head.author.decode('utf-8')
+        author = self._head().author
+        return author.decode('utf-8') if hasattr(author, 'decode') else author
 
     @property
     def message(self):
         """Message of the document latest commit."""
-        return self.git.head.message.decode('utf-8')
+        message = self._head().message
+        return (
+            message.decode('utf-8') if hasattr(message, 'decode')
+            else message)
 
     @property
     def history(self):
-        """Yield the parent documents."""
-        git = Git(self._pynuts.document_repository, branch=self.branch)
-        for version in git.history():
-            yield type(self)(self.document_id, version=version)
+        """Yield the parent documents.
+
+        Documents are built from the records of the commit index, and only
+        read their version when their Git object is needed.
+
+        """
+        for info in self.versions():
+            yield self._from_version_info(info)
 
     @property
     def archive_history(self):
         """Yield the parent documents stored as archives."""
-        for version in self.archive_git.history():
-            yield type(self)(self.document_id, version=version)
+        for info in self.versions(archive=True):
+            yield self._from_version_info(info)
+
+    def _from_version_info(self, info):
+        """Return a document of the same id at the version of `info`."""
+        document = type(self)(self.document_id, version=info.id)
+        document._version_info = info
+        return document
+
+    def versions(self, offset=0, limit=None, after=None, archive=False):
+        """Return the list of :class:`pynuts.git.VersionInfo` records of the
+        document versions, latest first.
+
+        Records give the version, time, author and message of the commits
+        without building documents, and are read from the commit index of the
+        repository.
+
+        :param offset: number of versions to skip
+        :param limit: maximum number of versions, ``None`` for no limit
+        :param after: version preceding the first returned version, for
+            paginated histories
+        :param archive: return the versions of the archives if `True`
+
+        """
+        git = Git(
+            self.repository,
+            branch=self.archive_branch if archive else self.branch)
+        return git.history(offset=offset, limit=limit, after=after)
+
+    def part_history(self, part, limit=None, archive=False):
+        """Return the list of :class:`pynuts.git.VersionInfo` records of the
+        document versions changing `part`, latest first.
+
+        :param part: path of the part in the document
+        :param limit: maximum number of versions, ``None`` for no limit
+        :param archive: return the versions of the archives if `True`
+
+        """
+        git = Git(
+            self.repository,
+            branch=self.archive_branch if archive else self.branch)
+        return git.path_history(part, limit=limit)
+
+    def diff(self, version_a, version_b=None):
+        """Return the list of the :class:`pynuts.git.Change` of the parts
+        between two versions of the document.
+
+        Only the changed parts are read, and text parts have a unified diff.
+        Versions are commits, archived versions given by
+        ``versions(archive=True)`` are compared as the other ones.
+
+        :param version_a: old version of the document
+        :param version_b: new version of the document, default is the
+            version of this document
+
+        """
+        git = Git(self.repository, commit=version_a)
+        if version_b is None:
+            version_b = self.git.head.id
+        return git.diff(version_b)
 
     @classmethod
     def from_data(cls, version=None, **kwargs):
@@ -186,14 +432,79 @@ class Document(object, with_metaclass(MetaDocument)):
     def static_route(cls, document_id, filename, version):
         """Serve static files for documents.
 
+        The version in the URL is a commit SHA, so that resources are
+        immutable: they are served with their blob SHA as ETag, with a
+        far-future ``Cache-Control`` header, private by default as documents
+        may be protected, and handle conditional and range requests. The
+        blob is found without building a document, and is streamed by
+        chunks.
+
         :param document_id: id of the document
         :param filename: name of the document
         :param version: version of the document
 
         """
+        if not re.match('^[0-9a-f]{40}$', version):
+            abort(404)
+        repository = cls._pynuts.repository_router.repository(
+            cls.type_name, document_id)
+        try:
+            commit = repository[version.encode('ascii')]
+            if commit.type_name != b'commit':
+                abort(404)
+            git = Git(repository, commit=commit.id)
+            _, sha = git.find_entry(filename)
+        except (KeyError, GitException):
+            abort(404)
+
+        etag = bytes(sha).decode('ascii')
         mimetype, _ = mimetypes.guess_type(filename)
-        return Response(
-            cls(document_id, version).git.read(filename), mimetype=mimetype)
+        headers = Headers()
+        headers['Cache-Control'] = '%s, max-age=%d, immutable' % (
+            cls._app.config.get('PYNUTS_RESOURCE_CACHE_CONTROL'),
+            cls._app.config.get('PYNUTS_RESOURCE_MAX_AGE'))
+        headers['Accept-Ranges'] = 'bytes'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+
+        try:
+            reader = git.open(filename)
+        except GitException:
+            abort(404)
+        if request.range and request.if_range.etag in (None, etag):
+            bounds = request.range.range_for_length(reader.size)
+            if bounds:
+                start, stop = bounds
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                    start, stop - 1, reader.size)
+                with reader:
+                    skipped = 0
+                    while skipped < start:
+                        chunk = reader.read(
+                            min(start - skipped, Git.chunk_size))
+                        if not chunk:
+                            break
+                        skipped += len(chunk)
+                    data = reader.read(stop - start)
+                response = Response(
+                    data, status=206, mimetype=mimetype, headers=headers)
+                response.set_etag(etag)
+                return response
+            elif len(request.range.ranges) == 1:
+                headers['Content-Range'] = 'bytes */%d' % reader.size
+                reader.close()
+                response = Response(
+                    status=416, mimetype=mimetype, headers=headers)
+                response.set_etag(etag)
+                return response
+        headers['Content-Length'] = reader.size
+        response = Response(
+            wrap_file(request.environ, reader, Git.chunk_size),
+            mimetype=mimetype, headers=headers, direct_passthrough=True)
+        response.set_etag(etag)
+        return response
 
     @classmethod
     def generate_rest(cls, part='index.rst.jinja2', archive=False,
@@ -217,12 +528,84 @@ class Document(object, with_metaclass(MetaDocument)):
             set this parameter to 'False'. For more info see :ref:`api`
         """
         part = 'index.rst' if archive else part
-        if archive:
-            return self.archive_git.read(part)
-        else:
-            template = self.jinja_environment.get_template(part)
-            return template.render(resource=self.resource_url, document=self,
-                                   editable=editable, **self.data)
+
+        def render(dependencies):
+            """Render the ReST source."""
+            if archive:
+                return self.archive_git.read(part)
+            return self._render_template(part, editable, dependencies)
+
+        return self._cached_render('rest', part, archive, editable, render)
+
+    def _render_template(self, part, editable, dependencies=None,
+                         accessed=None):
+        """Render the Jinja2 template of `part` with the document data.
+
+        :param part: template to render
+        :param editable: whether the editable parts are editable
+        :param dependencies: dict whose ``'documents'`` dict stores the
+            commit SHAs of the documents rendered by ``render_rest`` at their
+            branch head, or ``None``
+        :param accessed: set storing the names of the attributes of the
+            document read by the template that depend on its version, such
+            as ``datetime``, or ``None``
+
+        """
+        template = self.jinja_environment.get_template(part)
+        data = dict(self.data)
+        if dependencies is not None:
+            data['render_rest'] = self._tracking_render_rest(dependencies)
+        document = self if accessed is None else _SkeletonDocument(
+            self, accessed)
+        return template.render(resource=self.resource_url, document=document,
+                               editable=editable, **data)
+
+    def _tracking_render_rest(self, dependencies):
+        """Return a ``render_rest`` template function storing the versions
+        of the rendered documents in `dependencies`.
+
+        """
+        def render_rest(document_type, part='index.rst.jinja2', archive=False,
+                        version=None, editable=True, **kwargs):
+            """Return the generated ReST version of the document."""
+            document = self._pynuts.documents[document_type].from_data(
+                version=version, **kwargs)
+            if archive:
+                git = document.archive_git
+                key = (document_type, document.document_id, True)
+                dependencies['documents'][key] = (
+                    bytes(git.head.id).decode('ascii') if git.head else None)
+                return document._generate_rest(part='index.rst', archive=True)
+            if version is None:
+                key = (document_type, document.document_id, False)
+                head_id = document._head_id()
+                dependencies['documents'][key] = (
+                    head_id.decode('ascii') if isinstance(head_id, bytes)
+                    else head_id)
+            return document._render_template(part, editable, dependencies)
+
+        return render_rest
+
+    def _dependencies_unchanged(self, git, dependencies):
+        """Return whether the templates of `git` and the documents rendered
+        by ``render_rest`` are the ones given by `dependencies`.
+
+        """
+        if not git.blobs_unchanged(dependencies['templates']):
+            return False
+        for key, commit in dependencies['documents'].items():
+            document_type, document_id, archive = key
+            document = self._pynuts.documents[document_type](document_id)
+            if archive:
+                head = document.archive_git.head
+                head_id = bytes(head.id) if head else None
+            else:
+                head_id = document._head_id()
+            if isinstance(head_id, bytes):
+                head_id = head_id.decode('ascii')
+            if head_id != commit:
+                return False
+        return True
 
     @classmethod
     def generate_html(cls, part='index.rst.jinja2', archive=False,
@@ -232,7 +615,7 @@ class Document(object, with_metaclass(MetaDocument)):
             part=part, archive=archive, editable=editable)
 
     def _generate_html(self, part='index.rst.jinja2', archive=False,
-                       editable=True):
+                       editable=True, dependencies=None):
         """Generate the HTML samples of the document.
 
         The output is a dict corresponding to the different HTML samples as
@@ -244,6 +627,8 @@ class Document(object, with_metaclass(MetaDocument)):
             ReST directive and if you need to render html with
             'contenteditable="false"',
             set this parameter to 'False'. For more info see :ref:`api`
+        :param dependencies: dict whose ``'documents'`` dict stores the
+            commits of the nested documents, or ``None``
 
         .. seealso::
            `Docutils writer publish parts
@@ -252,15 +637,104 @@ class Document(object, with_metaclass(MetaDocument)):
 
         """
         part = 'index.rst' if archive else part
-        source = self._generate_rest(
-            part=part, archive=archive, editable=editable)
 
-        settings = dict(self.docutils_settings)
-        settings.setdefault('stylesheet', self.resource_url(self.stylesheet))
-        parts = docutils.core.publish_parts(
-            source=source, writer=Writer(),
-            settings_overrides=settings)
-        return parts
+        def render(dependencies):
+            """Render the HTML parts."""
+            settings = dict(self.docutils_settings)
+            settings.setdefault(
+                'stylesheet', self.resource_url(self.stylesheet))
+            return self._publish_parts(
+                part, archive, editable, settings, dependencies)
+
+        return self._cached_render(
+            'html', part, archive, editable, render, dependencies)
+
+    def _publish_parts(self, part, archive, editable, settings,
+                       dependencies=None):
+        """Return the HTML parts of the document version.
+
+        The ``editable`` and ``content`` directives are rendered as fragments
+        after the rest of the document, called its skeleton. The skeleton is
+        written with the version replaced by
+        :attr:`pynuts.Pynuts.version_token`, and kept in the render cache
+        with the blob SHAs of the templates and the commits of the documents
+        it depends on. A new version whose templates, nested documents and
+        data are unchanged, such as the version saved by
+        :meth:`update_content`, reuses the skeleton without rendering its
+        templates, and only renders its fragments whose parts have changed.
+        Skeletons whose templates read other attributes of the document
+        version, such as its ``datetime`` or its ``history``, are not kept.
+
+        :param part: part of the document to render
+        :param archive: whether the archive is rendered
+        :param editable: whether the editable parts are editable
+        :param settings: dict of docutils settings
+        :param dependencies: dict whose ``'documents'`` dict stores the
+            commits of the nested documents, or ``None``
+
+        """
+        git = self.archive_git if archive else self.git
+        version = bytes(git.head.id).decode('ascii') if git.head else None
+        token = self._pynuts.version_token
+        if version:
+            for key, value in settings.items():
+                # Settings such as the stylesheet URL include the version
+                if isinstance(value, (type(u''), str)):
+                    settings[key] = value.replace(version, token)
+        settings['pynuts_fragments'] = fragment_setting(self._pynuts)
+        cache = self._pynuts.render_cache
+        key = self._skeleton_key(part, archive, editable, settings)
+        entry = None if cache is None or key is None else cache.get(key)
+        if entry is not None and self._dependencies_unchanged(
+                git, entry['dependencies']):
+            parts = entry['parts']
+            skeleton_dependencies = entry['dependencies']
+        else:
+            skeleton_dependencies = {'templates': {}, 'documents': {}}
+            accessed = set()
+            if archive:
+                source = git.read(part)
+                skeleton_dependencies['templates'][part] = (
+                    git.find_entry(part)[1])
+            else:
+                source = self._render_template(
+                    part, editable, skeleton_dependencies, accessed)
+                skeleton_dependencies['templates'].update(
+                    self.jinja_environment.pynuts_templates)
+            if isinstance(source, bytes):
+                source = source.decode('utf-8')
+            if version:
+                source = source.replace(version, token)
+            parts = publish_parts(
+                source, settings, cache=self._pynuts.doctree_cache)
+            if cache is not None and key is not None and not accessed:
+                cache.set(key, {
+                    'dependencies': skeleton_dependencies, 'parts': parts})
+        if dependencies is not None:
+            dependencies['documents'].update(
+                skeleton_dependencies['documents'])
+        registry = DocumentRegistry(self._pynuts)
+        return dict(
+            (name, render_fragments(value, registry, version))
+            for name, value in parts.items())
+
+    def _skeleton_key(self, part, archive, editable, settings):
+        """Return the render cache key of the skeleton of the document, or
+        ``None`` if it cannot be cached.
+
+        The key does not depend on the version, but on the data, on the
+        docutils settings and on the URL of the document resources.
+
+        """
+        data_key = self.render_cache_key()
+        if data_key is None or not (archive or self.git.head):
+            return None
+        key = hashlib.sha1(repr((
+            data_key, parts_key(u'', settings),
+            self._resource_root())).encode('utf-8'))
+        return 'skeleton/%s/%s/%s/%s/%s' % (
+            self.type_name, part, bool(archive), bool(editable),
+            key.hexdigest())
 
     @classmethod
     def generate_pdf(cls, part='index.rst.jinja2', version=None, archive=False,
@@ -282,8 +756,98 @@ class Document(object, with_metaclass(MetaDocument)):
         """
 
         part = 'index.rst' if archive else part
-        html = self._generate_html(part=part, archive=archive)['whole']
-        return HTML(string=html, encoding='utf-8').write_pdf()
+
+        def render(dependencies):
+            """Render the PDF document."""
+            html = self._generate_html(
+                part=part, archive=archive,
+                dependencies=dependencies)['whole']
+            return self._pynuts.pdf_renderer.render(html)
+
+        return self._cached_render('pdf', part, archive, True, render)
+
+    def render_cache_key(self):
+        """Return a string identifying the data of the document.
+
+        This key is used with the document version to store the rendered
+        documents in the render cache and to identify the PDF jobs. It is a
+        hash of the data serialized as JSON, or ``None`` if the data cannot
+        be serialized, disabling the cache for this document. Objects having
+        a ``cache_key`` method, such as :class:`pynuts.view.ModelView`
+        instances, are serialized as the value returned by this method.
+
+        Override this method if your data includes other objects, such as
+        database rows, that can be identified by their primary key and
+        modification time. Templates must only depend on the document version
+        and on the data identified by this key. Templates reading other
+        attributes of the document, such as its ``datetime``, are rendered
+        again for each version.
+
+        """
+        try:
+            data = json.dumps(self.data, sort_keys=True, default=_data_key)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _cached_render(self, kind, part, archive, editable, render,
+                       dependencies=None):
+        """Return the output of `render`, using the render cache.
+
+        Outputs are keyed by the document version, part and data, by the
+        docutils settings and by the URL of the document resources. The
+        commits of the documents rendered by ``render_rest`` at their branch
+        head are stored with the output, rendered again when they change.
+
+        :param kind: kind of output, ``'rest'``, ``'html'`` or ``'pdf'``
+        :param part: part of the document to render
+        :param archive: whether the archive is rendered
+        :param editable: whether the editable parts are editable
+        :param render: function rendering the document, storing the commits
+            of the nested documents in the ``'documents'`` dict of its
+            ``dependencies`` argument
+        :param dependencies: dict whose ``'documents'`` dict stores the
+            commits of the nested documents, or ``None``
+
+        """
+        if dependencies is None:
+            dependencies = {'templates': {}, 'documents': {}}
+        cache = self._pynuts.render_cache
+        git = self.archive_git if archive else self.git
+        data_key = self.render_cache_key()
+        if cache is None or git.head is None or data_key is None:
+            return render(dependencies)
+        inputs = repr((
+            data_key, parts_key(u'', dict(self.docutils_settings)),
+            self._resource_root()))
+        key = '%s/%s/%s/%s/%s/%s' % (
+            kind, self.type_name, bytes(git.head.id).decode('ascii'), part,
+            bool(editable), hashlib.sha1(inputs.encode('utf-8')).hexdigest())
+        entry = cache.get(key)
+        if entry is None or not self._dependencies_unchanged(
+                git, entry['dependencies']):
+            # Templates of a given version never change
+            entry_dependencies = {'templates': {}, 'documents': {}}
+            entry = {
+                'dependencies': entry_dependencies,
+                'output': render(entry_dependencies)}
+            cache.set(key, entry)
+        dependencies['documents'].update(entry['dependencies']['documents'])
+        return entry['output']
+
+    def _resource_root(self):
+        """Return the URL of the resources of the document, with the
+        version replaced by :attr:`pynuts.Pynuts.version_token`, or
+        ``None`` if URLs cannot be built.
+
+        """
+        try:
+            return url_for(
+                '_pynuts_resource_%s' % self.type_name,
+                document_id=self.document_id, filename='_',
+                version=self._pynuts.version_token)
+        except RuntimeError:
+            return None
 
     @classmethod
     def download_pdf(cls, part='index.rst.jinja2', version=None, archive=False,
@@ -305,6 +869,113 @@ class Document(object, with_metaclass(MetaDocument)):
             part=part, version=version, archive=archive, **kwargs)
         return Response(pdf, mimetype='application/pdf', headers=headers)
 
+    @classmethod
+    def export_pdfs(cls, documents, part='index.rst.jinja2', version=None,
+                    archive=False, filename=None, workers=4):
+        """Generate many PDF documents and yield a ZIP file by chunks.
+
+        Documents are generated in parallel and added to the ZIP file as soon
+        as they are ready.
+
+        :param documents: iterable of document ids, or of dicts of data given
+            to :meth:`from_data`
+        :param part: part of the documents to render
+        :param version: version of the documents to render
+        :param archive: whether to render the archives of the documents
+        :param filename: function taking a document and returning the name
+            of its PDF file in the ZIP file, default is ``<document_id>.pdf``
+        :param workers: number of documents generated at the same time
+
+        """
+        part = 'index.rst' if archive else part
+
+        def render(item):
+            """Return the file name and the PDF content of a document."""
+            if isinstance(item, dict):
+                document = cls.from_data(version=version, **item)
+            else:
+                document = cls(item, version=version)
+                document.data = {}
+            name = filename(document) if filename else (
+                '%s.pdf' % document.document_id)
+            return name, document._generate_pdf(part=part, archive=archive)
+
+        return iter_zip(cls._app, documents, render, workers)
+
+    @classmethod
+    def download_pdfs(cls, documents, part='index.rst.jinja2', version=None,
+                      archive=False, filename=None, zip_filename=None,
+                      workers=4):
+        """Get a streamed HTTP response with a ZIP file of PDF documents.
+
+        :param documents: iterable of document ids, or of dicts of data given
+            to :meth:`from_data`
+        :param part: part of the documents to render
+        :param version: version of the documents to render
+        :param archive: whether to render the archives of the documents
+        :param filename: function taking a document and returning the name
+            of its PDF file in the ZIP file, default is ``<document_id>.pdf``
+        :param zip_filename: attachment filename, expect unicode
+        :param workers: number of documents generated at the same time
+
+        """
+        headers = Headers()
+        headers.add(
+            'Content-Disposition', 'attachment',
+            filename=(zip_filename.encode('utf-8') if zip_filename else None))
+        return Response(
+            stream_with_context(cls.export_pdfs(
+                documents, part=part, version=version, archive=archive,
+                filename=filename, workers=workers)),
+            mimetype='application/zip', headers=headers)
+
+    @classmethod
+    def enqueue_pdf(cls, part='index.rst.jinja2', version=None,
+                    archive=False, filename=None, **kwargs):
+        """Enqueue the generation of the PDF document and return a ticket.
+
+        The PDF document is generated in background, and is available at the
+        ``/_pynuts/jobs/<ticket>`` URL (``_pynuts-job`` endpoint) when done.
+        Asking many times for the same version, part and data only generates
+        the document once, but each call returns a new random ticket, so
+        that only the requesters of a document can download it. Check the
+        rights of the requester before calling this method.
+        :class:`ValueError` is raised if the data cannot be identified by
+        :meth:`render_cache_key`.
+
+        :param part: part of the document to render
+        :param version: version of the document to render
+        :param archive: whether to archive the given version of the document
+        :param filename: attachment filename, expect unicode
+
+        """
+        part = 'index.rst' if archive else part
+        document = cls.from_data(version=version, **kwargs)
+        return cls._pynuts.job_queue.enqueue(
+            document, part=part, archive=archive, filename=filename)
+
+    @classmethod
+    def async_download_pdf(cls, part='index.rst.jinja2', version=None,
+                           archive=False, filename=None, **kwargs):
+        """Get a HTTP response with the id and the URL of a PDF job.
+
+        The response is a JSON object with ``ticket`` and ``url`` keys, the
+        URL giving the status of the job and then the PDF document.
+
+        :param part: part of the document to render
+        :param version: version of the document to render
+        :param archive: whether to archive the given version of the document
+        :param filename: attachment filename, expect unicode
+
+        """
+        ticket = cls.enqueue_pdf(
+            part=part, version=version, archive=archive, filename=filename,
+            **kwargs)
+        response = jsonify(
+            ticket=ticket, url=url_for('_pynuts-job', ticket=ticket))
+        response.status_code = 202
+        return response
+
     @classmethod
     def archive(cls, part='index.rst.jinja2', version=None,
                 author_name=None, author_email=None, message=None, **kwargs):
@@ -321,6 +992,8 @@ class Document(object, with_metaclass(MetaDocument)):
         document.git.write(
             os.path.splitext(part)[0],
             document.generate_rest(part=part, **kwargs).encode('utf-8'))
+        # The archive commit references the objects of the document tree
+        document.git.flush()
         git = document.archive_git
         git.tree = document.git.tree
         git.commit(
@@ -355,12 +1028,38 @@ class Document(object, with_metaclass(MetaDocument)):
         """
         document = cls.from_data(**kwargs)
         git = document.git
-        git.tree = git.store_directory(cls.model_path)
+        git.tree = git._get_object(cls._model_tree_id(git))
         git.commit(
             author_name or 'Pynuts',
             author_email or 'pynut@pynuts.org',
             message or 'Create %s' % document.document_id)
 
+    @classmethod
+    def _model_tree_id(cls, git):
+        """Return the id of the tree storing the model directory.
+
+        The model directory is only stored once, and stored again when the
+        modification times or sizes of its files change, so that creating a
+        document only stores its commit.
+
+        :param git: the :class:`Git` object storing the tree if needed
+
+        """
+        signature = _directory_signature(cls.model_path)
+        key = (git.repository.path, cls.model_path)
+        model_tree = cls._pynuts.model_trees.get(key)
+        if model_tree is not None:
+            tree_signature, tree_id = model_tree
+            # The repository may have been replaced since the tree was stored
+            if tree_signature == signature and (
+                    tree_id in git.repository.object_store):
+                # Keep it from being pruned while the commit is written
+                git.freshen(tree_id)
+                return tree_id
+        tree_id = git.store_directory(cls.model_path).id
+        cls._pynuts.model_trees[key] = signature, tree_id
+        return tree_id
+
     @classmethod
     def edit(cls, template, part='index.rst.jinja2', version=None,
              author_name=None, author_email=None, message=None, archive=False,
@@ -474,6 +1173,46 @@ class Document(object, with_metaclass(MetaDocument)):
         return Content(self.git, part)
 
 
+def _directory_signature(root):
+    """Return a tuple of the paths, sizes and modification times of the
+    files and directories in `root`, following symbolic links.
+
+    """
+    signature = []
+    for path, directories, filenames in os.walk(root, followlinks=True):
+        directories.sort()
+        for name in [''] + sorted(filenames):
+            fullname = os.path.join(path, name)
+            try:
+                stat = os.stat(fullname)
+            except OSError:
+                continue
+            signature.append((fullname, stat.st_size, stat.st_mtime))
+    return tuple(signature)
+
+
+class _SkeletonDocument(object):
+    """Document given to the templates of a skeleton, recording the names of
+    the attributes read that depend on the version in `accessed`.
+
+    The version itself is replaced by a token in the skeleton, and is not
+    recorded.
+
+    """
+    unversioned = frozenset((
+        'type_name', 'document_id', 'version', 'data', 'resource_url',
+        'branch', 'archive_branch'))
+
+    def __init__(self, document, accessed):
+        self._document = document
+        self._accessed = accessed
+
+    def __getattr__(self, name):
+        if name not in self.unversioned:
+            self._accessed.add(name)
+        return getattr(self._document, name)
+
+
 class Content(object):
     """The content class.
     It allows you to read/write any content in a git repository.
@@ -515,30 +1254,116 @@ class Content(object):
             return True
 
 
+def apply_ops(text, ops):
+    """Return `text` with the `ops` applied.
+
+    `ops` is a list of ``[start, end, replacement]`` lists, replacing the
+    range from `start` to `end` of the original `text` by `replacement`.
+    Ranges are sorted, do not overlap, and are given in UTF-16 code units,
+    as the indexes of JavaScript strings.
+
+    :raises: ValueError for invalid ranges and replacements
+
+    """
+    data = text.encode('utf-16-le')
+    pieces = []
+    position = 0
+    if not isinstance(ops, list):
+        raise ValueError('Invalid operations %r.' % (ops,))
+    for op in ops:
+        if not isinstance(op, list) or len(op) != 3:
+            raise ValueError('Invalid operation %r.' % (op,))
+        start, end, replacement = op
+        # Booleans are integers for Python, not for JSON
+        if not all(
+                isinstance(bound, numbers.Integral) and
+                not isinstance(bound, bool) for bound in (start, end)) or (
+                    not position <= start <= end <= len(data) // 2):
+            raise ValueError('Invalid range %r-%r.' % (start, end))
+        if not isinstance(replacement, unicode):
+            raise ValueError('Invalid replacement %r.' % (replacement,))
+        pieces.append(data[2 * position:2 * start])
+        pieces.append(replacement.encode('utf-16-le'))
+        position = end
+    pieces.append(data[2 * position:])
+    return b''.join(pieces).decode('utf-16-le')
+
+
+def _delta_content(document, values):
+    """Return the content of a part saved as a delta, or ``None`` if the
+    part of the document version is not the base of the delta.
+
+    :raises: BadRequest if the base is missing or the delta is invalid
+
+    """
+    if not isinstance(values.get('base'), unicode):
+        abort(400)
+    try:
+        _, sha = document.git.find_entry(values['part'])
+    except NotFoundError:
+        return None
+    if bytes(sha).decode('ascii') != values['base']:
+        return None
+    base = document.git.get_blob(values['part']).data.decode('utf-8')
+    try:
+        return apply_ops(base, values['ops'])
+    except (TypeError, ValueError):
+        abort(400)
+
+
 def update_content(pynuts):
+    """Save the parts posted by ``save.js`` and return the new versions.
+
+    Each part is given by its full ``content``, or by ``ops`` to apply to
+    its ``base`` blob in the posted version (see :func:`apply_ops`). When the
+    base of a delta has changed, nothing is saved and the parts to send
+    again with their full content are returned with a 409 status.
+
+    """
     contents = request.json['data']
     author_name = request.json['author']
     author_email = request.json['author_email']
     message = request.json['message']
 
     documents = {}
+    parts = {}
+    resend = []
     for values in contents:
         key = (values['document_type'], values['document_id'])
-        if key in documents:
-            document = documents[key]
-        else:
+        if key not in documents:
             cls = pynuts.documents[values['document_type']]
-            document = cls(values['document_id'], values['version'])
-            documents[key] = document
-        document.git.write(values['part'],
-                           values['content'].encode('utf-8'))
+            documents[key] = cls(values['document_id'], values['version'])
+            parts[key] = {}
+        if 'ops' in values:
+            content = _delta_content(documents[key], values)
+            if content is None:
+                resend.append({
+                    'document_type': values['document_type'],
+                    'document_id': values['document_id'],
+                    'part': values['part']})
+                continue
+        else:
+            content = values['content']
+        parts[key][values['part']] = content.encode('utf-8')
+    if resend:
+        response = jsonify(resend=resend)
+        response.status_code = 409
+        return response
+    for key, document in documents.items():
+        document.git.write_many(parts[key])
     for document in list(documents.values()):
-        document.git.commit(
+        git = document.git
+        if git.head and git.tree.id == git.head.tree:
+            continue  # Nothing changed
+        git.commit(
             author_name or 'Pynuts',
             author_email or 'pynut@pynuts.org',
             message or 'Edit %s' % document.document_id)
     return jsonify(documents=[{
         'document_type': document.type_name,
         'document_id': document.document_id,
-        'version': document.version}
-        for document in list(documents.values())])
+        'version': document.version,
+        'parts': dict(
+            (part, bytes(document.git.find_entry(part)[1]).decode('ascii'))
+            for part in parts[key])}
+        for key, document in documents.items()])
@@ -6,6 +6,7 @@ Set the jinja2 environment by defining templates location and globals.
 
 import flask
 from jinja2 import nodes, Environment, PackageLoader, ChoiceLoader
+from jinja2.bccache import BytecodeCache, Bucket
 from jinja2.ext import Extension
 
 from . import filters
@@ -76,11 +77,40 @@ class ShowOnMatch(Extension):
         return [body_expr, assign_node, if_node]
 
 
-def create_environment(loader):
+class TemplateCache(BytecodeCache):
+    """Cache of the compiled templates, keyed by name and source.
+
+    Templates are stored in Git, and the environments of the documents are
+    created for each version. Keying the compiled templates by their source
+    instead of their file name lets the versions share the templates that
+    have not changed.
+
+    :param cache: cache storing the code objects, such as a
+        :class:`pynuts.cache.LRUCache`
+
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        bucket = Bucket(environment, '%s|%s' % (name, checksum), checksum)
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket):
+        bucket.code = self.cache.get(bucket.key)
+
+    def dump_bytecode(self, bucket):
+        self.cache.set(bucket.key, bucket.code)
+
+
+def create_environment(loader, bytecode_cache=None):
     """Create a new Jinja2 environment with Pynuts helpers."""
     loaders = (loader, PackageLoader('pynuts', 'templates'))
     environment = Environment(
-        loader=ChoiceLoader(loaders), extensions=[ShowOnMatch])
+        loader=ChoiceLoader(loaders), extensions=[ShowOnMatch],
+        bytecode_cache=bytecode_cache)
     environment.globals.update({'url_for': flask.url_for})
     environment.filters['data'] = filters.data
     environment.filters['base64'] = filters.base64
@@ -1,12 +1,37 @@
 # coding: utf8
 
 """Git file for Pynuts."""
+import io
 import os
+import stat
 import time
+import zlib
+import difflib
+import bisect
+import sqlite3
+import hashlib
+import datetime
+import tempfile
+import threading
+import weakref
+from contextlib import contextmanager, closing
+from multiprocessing.pool import ThreadPool
 
 import jinja2
+from dulwich.file import FileLocked
+from dulwich.refs import DiskRefsContainer
 from dulwich.repo import Blob, Tree, Commit
 
+from .cache import LRUCache
+
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 class GitException(Exception):
     """Base class for git-related exceptions."""
@@ -24,6 +49,548 @@ class ConflictError(GitException):
     """Operation on a branch that does not exist."""
 
 
+class StoredBlob(object):
+    """Blob stored in the repository, whose data is not loaded.
+
+    :param sha: SHA1 hash of the blob
+    :param mode: mode of the tree entries written with the blob
+
+    """
+    type_name = b'blob'
+
+    def __init__(self, sha, mode=0o100644):
+        self.id = sha
+        self.mode = mode
+
+
+class BlobReader(object):
+    """File-like object reading the content of a blob by chunks.
+
+    :param fd: file object of a zlib-compressed loose object, or of the raw
+        content if `size` is given
+    :param size: size of the raw content
+    :param chunk_size: size of the compressed chunks read in `fd`
+    :param compressed: whether `fd` is positioned at the zlib-compressed
+        content of `size` bytes, as stored in a pack
+
+    The ``size`` attribute is the size of the content.
+
+    """
+    def __init__(self, fd, size=None, chunk_size=65536, compressed=False):
+        self._fd = fd
+        self.chunk_size = chunk_size
+        self._buffer = b''
+        self._eof = False
+        if compressed:
+            self._decompressor = zlib.decompressobj()
+        elif size is None:
+            self._decompressor = zlib.decompressobj()
+            while b'\0' not in self._buffer and not self._eof:
+                self._fill(len(self._buffer) + 1)
+            header, self._buffer = self._buffer.split(b'\0', 1)
+            type_name, size = header.split(b' ')
+            if type_name != b'blob':
+                raise ObjectTypeError('Found a %s, expected a blob.' % (
+                    type_name.decode('ascii')))
+        else:
+            self._decompressor = None
+        self.size = int(size)
+
+    def _fill(self, size):
+        """Decompress data until the buffer has `size` bytes."""
+        while (size < 0 or len(self._buffer) < size) and not self._eof:
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self._fd.read(self.chunk_size)
+                if not data:
+                    self._buffer += self._decompressor.flush()
+                    self._eof = True
+                    break
+            # Limit the size of decompressed data kept in memory
+            self._buffer += self._decompressor.decompress(
+                data, self.chunk_size)
+            if self._decompressor.unused_data:
+                # End of a packed object, followed by other objects
+                self._eof = True
+
+    def read(self, size=-1):
+        """Read at most `size` bytes, or everything if `size` is negative."""
+        if self._decompressor is None:
+            return self._fd.read(size)
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        """Close the underlying file."""
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class VersionInfo(object):
+    """Lightweight record of a commit, yielded by :meth:`Git.history`.
+
+    :param id: SHA1 hash of the commit, as an ASCII byte string
+    :param parent: SHA1 hash of the first parent, or ``None``
+    :param generation: number of commits in the first-parent history ending
+        with this commit
+    :param commit_time: commit time, as a timestamp
+    :param author: author of the commit
+    :param message: message of the commit
+
+    """
+    __slots__ = (
+        'id', 'parent', 'generation', 'commit_time', 'author', 'message')
+
+    def __init__(self, id, parent, generation, commit_time, author, message):
+        self.id = id
+        self.parent = parent
+        self.generation = generation
+        self.commit_time = commit_time
+        self.author = author
+        self.message = message
+
+    @classmethod
+    def from_commit(cls, commit, generation=None):
+        """Create a record from a dulwich commit object."""
+        return cls(
+            commit.id, commit.parents[0] if commit.parents else None,
+            generation, commit.commit_time,
+            commit.author.decode('utf-8', 'replace'),
+            commit.message.decode('utf-8', 'replace'))
+
+    @property
+    def version(self):
+        """SHA1 hash of the commit, as a string."""
+        return bytes(self.id).decode('ascii')
+
+    @property
+    def datetime(self):
+        """Commit time as an UTC naive datetime object."""
+        return datetime.datetime.utcfromtimestamp(self.commit_time)
+
+    def __repr__(self):
+        return '<VersionInfo %s>' % self.version
+
+
+class Change(object):
+    """Change of a file between two commits, returned by :meth:`Git.diff`.
+
+    :param path: path of the file
+    :param old_id: SHA1 hash of the old blob, ``None`` if the file is added
+    :param new_id: SHA1 hash of the new blob, ``None`` if the file is
+        removed
+    :param diff: unified diff of the file, ``None`` for binary files or when
+        not computed
+
+    """
+    __slots__ = ('path', 'old_id', 'new_id', 'diff')
+
+    def __init__(self, path, old_id, new_id, diff=None):
+        self.path = path
+        self.old_id = old_id
+        self.new_id = new_id
+        self.diff = diff
+
+    @property
+    def status(self):
+        """``'added'``, ``'removed'`` or ``'modified'``."""
+        if self.old_id is None:
+            return 'added'
+        elif self.new_id is None:
+            return 'removed'
+        return 'modified'
+
+    def __repr__(self):
+        return '<Change %s %s>' % (self.status, self.path)
+
+
+class CommitIndex(object):
+    """SQLite index of the first-parent commit graph of a repository.
+
+    Each indexed commit is stored with its first parent, its generation
+    number, its time, its author, its message and its tree, so that
+    histories are read without loading and parsing commit objects. As
+    commits are immutable, the index only grows: when a commit is indexed,
+    its whole first-parent history is indexed too.
+
+    :param path: path of the SQLite database, created if needed
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        """Return a new connection to the database."""
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS commits ('
+            'id TEXT PRIMARY KEY, parent TEXT, generation INTEGER, '
+            'time INTEGER, author TEXT, message TEXT)')
+        # Trees are in their own table, missing for older indexes
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS trees ('
+            'id TEXT PRIMARY KEY, tree TEXT)')
+        return connection
+
+    @staticmethod
+    def _version_info(row):
+        """Return a :class:`VersionInfo` from a database row."""
+        sha, parent, generation, commit_time, author, message = row
+        return VersionInfo(
+            sha.encode('ascii'), parent.encode('ascii') if parent else None,
+            generation, commit_time, author, message)
+
+    def get(self, sha):
+        """Return the :class:`VersionInfo` of `sha`, or ``None``."""
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                'SELECT id, parent, generation, time, author, message '
+                'FROM commits WHERE id = ?',
+                (bytes(sha).decode('ascii'),)).fetchone()
+        return self._version_info(row) if row else None
+
+    def update(self, repository, sha):
+        """Index the first-parent history ending with the commit `sha`."""
+        with closing(self._connect()) as connection:
+            missing = []
+            generation = 0
+            while sha is not None:
+                row = connection.execute(
+                    'SELECT generation FROM commits WHERE id = ?',
+                    (bytes(sha).decode('ascii'),)).fetchone()
+                if row:
+                    generation = row[0]
+                    break
+                commit = repository[sha]
+                missing.append(commit)
+                sha = commit.parents[0] if commit.parents else None
+            rows = []
+            trees = []
+            for commit in reversed(missing):
+                generation += 1
+                info = VersionInfo.from_commit(commit, generation)
+                rows.append((
+                    info.version,
+                    bytes(info.parent).decode('ascii') if info.parent
+                    else None,
+                    generation, info.commit_time, info.author, info.message))
+                trees.append((info.version, commit.tree.decode('ascii')))
+            # Add the whole history at once, so that the indexed commits
+            # always have their first-parent history indexed
+            with connection:
+                connection.executemany(
+                    'INSERT OR IGNORE INTO commits VALUES (?, ?, ?, ?, ?, ?)',
+                    rows)
+                connection.executemany(
+                    'INSERT OR IGNORE INTO trees VALUES (?, ?)', trees)
+
+    def history(self, sha, offset=0, limit=None):
+        """Return the list of :class:`VersionInfo` of the first-parent
+        history starting with the indexed commit `sha`.
+
+        Only the ``offset + limit`` first commits are read.
+
+        """
+        depth = -1 if limit is None else offset + limit
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                'WITH RECURSIVE chain(id, depth) AS ('
+                '  SELECT ?, 0'
+                '  UNION ALL'
+                '  SELECT commits.parent, chain.depth + 1'
+                '  FROM commits JOIN chain ON commits.id = chain.id'
+                '  WHERE commits.parent IS NOT NULL'
+                '  AND (? < 0 OR chain.depth + 1 < ?)) '
+                'SELECT commits.id, parent, generation, time, author, message '
+                'FROM chain JOIN commits ON commits.id = chain.id '
+                'WHERE chain.depth >= ? ORDER BY chain.depth',
+                (bytes(sha).decode('ascii'), depth, depth, offset)).fetchall()
+        return [self._version_info(row) for row in rows]
+
+    def tree_history(self, sha):
+        """Yield the ``(version_info, tree)`` tuples of the first-parent
+        history starting with the indexed commit `sha`.
+
+        Commits are read one by one, as long as the generator is used. The
+        tree is ``None`` for the commits indexed before trees were.
+
+        """
+        with closing(self._connect()) as connection:
+            cursor = connection.execute(
+                'WITH RECURSIVE chain(id, depth) AS ('
+                '  SELECT ?, 0'
+                '  UNION ALL'
+                '  SELECT commits.parent, chain.depth + 1'
+                '  FROM commits JOIN chain ON commits.id = chain.id'
+                '  WHERE commits.parent IS NOT NULL) '
+                'SELECT commits.id, parent, generation, time, author, '
+                'message, trees.tree '
+                'FROM chain JOIN commits ON commits.id = chain.id '
+                'LEFT JOIN trees ON trees.id = chain.id '
+                'ORDER BY chain.depth', (bytes(sha).decode('ascii'),))
+            for row in cursor:
+                yield (
+                    self._version_info(row[:-1]),
+                    row[-1].encode('ascii') if row[-1] else None)
+
+
+def _pack_path(pack):
+    """Return the path of the data file of the dulwich `pack`."""
+    return os.path.splitext(pack.index.path)[0] + '.pack'
+
+
+#: Signatures of the packed refs files read by the refs of the repositories
+_packed_refs_signatures = weakref.WeakKeyDictionary()
+_packed_refs_lock = threading.Lock()
+
+
+def refresh_packed_refs(repository):
+    """Replace the refs of `repository` if its packed refs file has changed.
+
+    Dulwich reads the packed refs file once, but refs can be packed by
+    another process (see :mod:`pynuts.maintenance`), removing their loose
+    files. A new refs container is created when the file has changed since
+    the last call, and on the first call. It does not write reflogs, that
+    Pynuts does not use.
+
+    """
+    refs = repository.refs
+    if not isinstance(refs, DiskRefsContainer):
+        return  # Not stored on disk
+    try:
+        name = b'packed-refs' if isinstance(refs.path, bytes) else 'packed-refs'
+        info = os.stat(os.path.join(refs.path, name))
+        signature = (info.st_mtime, info.st_size, info.st_ino)
+    except OSError:
+        signature = None
+    with _packed_refs_lock:
+        if _packed_refs_signatures.get(repository, False) != signature:
+            repository.refs = DiskRefsContainer(refs.path, refs.worktree_path)
+            _packed_refs_signatures[repository] = signature
+
+
+class RefIndex(object):
+    """Cached sorted list of the names of the refs under a base.
+
+    The list is read again only when the packed refs file or the
+    directories of the loose refs are modified, so that listing, counting
+    and paginating refs does not read the refs each time. Refs written by
+    :class:`Git` in this process are added to the live indexes without
+    reading the other refs again (see :meth:`write_ref`), the modification
+    times only detecting the refs written by other processes.
+
+    :param repository: the dulwich repository
+    :param base: prefix of the refs, such as ``b'refs/heads/documents/'``
+
+    """
+    #: Number of seconds during which modification times are not trusted,
+    #: as files may be modified again in the same clock tick
+    racy_delay = 2
+
+    #: Live indexes, updated by the refs written by :meth:`write_ref`
+    _instances = weakref.WeakSet()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, repository, base):
+        self.repository = repository
+        self.base = base
+        self._names = None
+        self._signature = None
+        self._lock = threading.Lock()
+        with self._instances_lock:
+            self._instances.add(self)
+
+    @classmethod
+    def write_ref(cls, repository, ref, write):
+        """Call `write`, writing `ref` in `repository`, and return its
+        result, telling whether the ref has been written.
+
+        The live indexes including `ref` whose names were up to date before
+        the write get the new name and the new signature of the refs, and
+        are not read again. The other ones are read again on next access. A
+        ref written by another process between the check and the write is
+        only found when the refs are modified again.
+
+        """
+        if not hasattr(repository.refs, 'path'):
+            return write()
+        controldir = repository.controldir()
+        with cls._instances_lock:
+            indexes = [
+                index for index in cls._instances
+                if ref.startswith(index.base) and
+                index.repository.controldir() == controldir]
+        fresh = []
+        for index in indexes:
+            with index._lock:
+                fresh.append(index._is_fresh())
+        written = write()
+        if written:
+            for index, index_fresh in zip(indexes, fresh):
+                index._add(ref[len(index.base):], index_fresh)
+        return written
+
+    def _paths(self):
+        """Return the packed refs file name and the loose refs directory."""
+        controldir = self.repository.controldir()
+        return (
+            os.path.join(controldir, 'packed-refs'),
+            os.path.join(controldir, *(
+                part for part in self.base.decode('utf-8').split('/')
+                if part)))
+
+    @staticmethod
+    def _stat(path):
+        """Return the modification time and size of `path`, or ``None``."""
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return None
+        return stat_result.st_mtime, stat_result.st_size
+
+    def _read(self):
+        """Return the sorted names and the signature of the refs."""
+        packed_path, loose_path = self._paths()
+        signature = [self._stat(packed_path)]
+        names = set()
+        for root, directories, filenames in os.walk(loose_path):
+            signature.append((root, self._stat(root)))
+            directory = os.path.relpath(root, loose_path).replace(os.sep, '/')
+            for filename in filenames:
+                if not filename.endswith('.lock'):
+                    name = filename if directory == '.' else (
+                        directory + '/' + filename)
+                    names.add(name.encode('utf-8'))
+        if signature[0] is not None:
+            with open(packed_path, 'rb') as fd:
+                for line in fd:
+                    if line.startswith((b'#', b'^')):
+                        continue
+                    name = line.rstrip(b'\n').split(b' ', 1)[-1]
+                    if name.startswith(self.base):
+                        names.add(name[len(self.base):])
+        return sorted(names), signature
+
+    def _signature_is_fresh(self, signature, read_time):
+        """Whether `signature` has not been modified near `read_time`.
+
+        A ``None`` read time means that the signature has been taken after a
+        write of this process, and is trusted.
+
+        """
+        return read_time is None or all(
+            stat_result is None or stat_result[0] < read_time - self.racy_delay
+            for stat_result in [signature[0]] + [
+                stat_result for _, stat_result in signature[1:]])
+
+    def _current_signature(self, roots):
+        """Return the signature of the packed refs and of the `roots`."""
+        packed_path, _ = self._paths()
+        return [self._stat(packed_path)] + [
+            (root, self._stat(root)) for root in roots]
+
+    def _is_fresh(self):
+        """Return whether the cached names are up to date.
+
+        The lock of the index must be held by the caller.
+
+        """
+        if self._names is None:
+            return False
+        signature, read_time = self._signature
+        if not self._signature_is_fresh(signature, read_time):
+            return False
+        _, loose_path = self._paths()
+        # New sub-directories change the mtime of their parents, a new base
+        # directory has to be checked
+        return self._current_signature(
+            root for root, _ in signature[1:]) == signature and (
+                len(signature) > 1 or not os.path.isdir(loose_path))
+
+    def _add(self, name, fresh):
+        """Add `name`, just written, to the names if they were `fresh`
+        before, or mark the names as outdated.
+
+        """
+        with self._lock:
+            if self._names is None:
+                return
+            if not fresh:
+                self._names = None
+                return
+            names = self._names
+            index = bisect.bisect_left(names, name)
+            if index == len(names) or names[index] != name:
+                # Copy the list, as ranges may be read by other threads
+                names = names[:index] + [name] + names[index:]
+            _, loose_path = self._paths()
+            roots = [root for root, _ in self._signature[0][1:]]
+            parts = name.decode('utf-8').split('/')[:-1]
+            for i in range(len(parts) + 1):
+                root = os.path.join(loose_path, *parts[:i])
+                if root not in roots and os.path.isdir(root):
+                    roots.append(root)
+            self._names = names
+            self._signature = self._current_signature(roots), None
+
+    def names(self):
+        """Return the sorted list of the ref names, relative to the base."""
+        if not hasattr(self.repository.refs, 'path'):
+            return sorted(self.repository.refs.keys(base=self.base))
+        with self._lock:
+            if self._is_fresh():
+                return self._names
+            read_time = time.time()
+            self._names, signature = self._read()
+            self._signature = signature, read_time
+            return self._names
+
+    def range(self, prefix=b'', after=None, offset=0, limit=None):
+        """Return a sorted list of ref names.
+
+        :param prefix: only return the names starting with `prefix`
+        :param after: only return the names following `after`
+        :param offset: number of names to skip
+        :param limit: maximum number of names, ``None`` for no limit
+
+        """
+        names = self.names()
+        start = bisect.bisect_left(names, prefix)
+        if after is not None:
+            start = max(start, bisect.bisect_right(names, after))
+        end = self._prefix_end(names, prefix)
+        start += offset
+        if limit is not None:
+            end = min(end, start + limit)
+        return names[start:end]
+
+    def count(self, prefix=b''):
+        """Return the number of ref names starting with `prefix`."""
+        names = self.names()
+        return self._prefix_end(names, prefix) - bisect.bisect_left(
+            names, prefix)
+
+    @staticmethod
+    def _prefix_end(names, prefix):
+        """Return the index following the names starting with `prefix`.
+
+        Ref names are ASCII, and are lower than ``prefix + b'\\xff'``.
+
+        """
+        if not prefix:
+            return len(names)
+        return bisect.bisect_left(names, prefix + b'\xff')
+
+
 class Git(object):
     """Represents a commit and its tree in a git repository.
 
@@ -40,19 +607,56 @@ class Git(object):
         The SHA1 hash of the commit to use. If given, no check is made that
         the commit is actually reachable from `branch`. If not given,
         use the latest commit in `branch`.
+    :param pack:
+        If `True`, new objects are kept in memory and written in a single
+        pack file by :meth:`flush`, called by :meth:`commit`, instead of
+        being written as loose objects.
+    :param merge_retries:
+        Number of times :meth:`commit` merges the changes into the branch
+        when another commit has been added in the meantime, ``0`` raising
+        :class:`ConflictError` at once.
 
     """
 
     committer = 'Pynuts <pynuts@pynuts.org>'
 
-    def __init__(self, repository, branch=None, commit=None):
+    #: Size of the chunks used to store and read big files
+    chunk_size = 65536
+
+    #: Number of threads storing the files of a directory
+    store_threads = 4
+
+    #: Delays in seconds between the attempts to write a locked ref
+    lock_delays = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1)
+
+    #: Whether histories are read from a :class:`CommitIndex` stored in
+    #: the repository
+    index_commits = True
+
+    #: Cache of the parsed trees, shared by all the instances
+    tree_cache = LRUCache(1024)
+
+    #: Cache of the ``(mode, sha)`` entries found for ``(tree sha, path)``
+    #: keys, shared by all the instances
+    path_cache = LRUCache(4096)
+
+    def __init__(self, repository, branch=None, commit=None, pack=False,
+                 merge_retries=0):
         self.repository = repository
-        self._add_object = repository.object_store.add_object
-        self._get_object = repository.get_object
+        self.merge_retries = merge_retries
+        self._staged = None
+        if pack:
+            self._pending = {}
+            self._add_object = self._add_pending_object
+        else:
+            self._pending = None
+            self._add_object = self._add_loose_object
 
         if branch:
             self.ref = b'refs/heads/' + branch.encode('utf-8')
-            commit = commit or repository.refs.read_ref(self.ref)
+            if not commit:
+                refresh_packed_refs(repository)
+                commit = repository.refs.read_ref(self.ref)
         else:
             self.ref = None
 
@@ -65,11 +669,90 @@ class Git(object):
             self.head = None
             self.tree = Tree()
 
-    def jinja_loader(self, sub_directory=None):
+    def _add_pending_object(self, obj):
+        """Keep ``obj`` in memory until the next :meth:`flush`."""
+        self._pending[obj.id] = obj
+
+    def _add_loose_object(self, obj):
+        """Store ``obj`` as a loose object, or freshen it if it exists."""
+        if not self._freshen_loose(obj.id):
+            self.repository.object_store.add_object(obj)
+
+    def _freshen_loose(self, sha):
+        """Update the modification time of the loose object `sha`, and
+        return whether it exists.
+
+        """
+        object_store = self.repository.object_store
+        if not hasattr(object_store, 'path'):
+            return False
+        hexsha = sha.decode('ascii') if isinstance(sha, bytes) else sha
+        try:
+            os.utime(os.path.join(object_store.path, hexsha[:2], hexsha[2:]),
+                     None)
+        except OSError:
+            return False
+        return True
+
+    def freshen(self, sha):
+        """Mark the stored object `sha`, reused by a new tree or commit, as
+        recent.
+
+        The modification time of its loose file, or of its pack, is updated,
+        so that :mod:`pynuts.maintenance` keeps it, with the objects it
+        references, during the grace period.
+
+        """
+        if self._freshen_loose(sha):
+            return
+        pack = self._find_pack(sha)
+        if pack is not None:
+            try:
+                os.utime(_pack_path(pack), None)
+            except OSError:
+                pass
+
+    def _find_pack(self, sha):
+        """Return the pack of the object store storing `sha`, or ``None``."""
+        object_store = self.repository.object_store
+        if not hasattr(object_store, 'pack_dir'):
+            return None
+        for pack in object_store.packs:
+            if sha in pack:
+                return pack
+        return None
+
+    def _get_object(self, sha):
+        """Return the object of `sha`, stored or pending."""
+        if self._pending and sha in self._pending:
+            # Return a copy, as trees may be modified
+            return self._pending[sha].copy()
+        return self.repository.get_object(sha)
+
+    def flush(self):
+        """Write the pending objects in a single pack file.
+
+        This is only needed with ``pack=True``, when objects are stored
+        without calling :meth:`commit`, or before using this instance's tree
+        in another instance.
+
+        """
+        if self._pending:
+            object_store = self.repository.object_store
+            # Empty directories may be lost when repositories are copied
+            if not os.path.isdir(object_store.pack_dir):
+                os.makedirs(object_store.pack_dir)
+            object_store.add_objects(
+                [(obj, None) for obj in self._pending.values()])
+            self._pending = {}
+
+    def jinja_loader(self, sub_directory=None, dependencies=None):
         """Return a jinja2.BaseLoader object with a `get_source` method
         adapted to Git commits.
 
         :param sub_directory: the name of a sub_directory located in the template environment
+        :param dependencies: dict where the blob SHA of each loaded template
+            is stored, keyed by path, or ``None``
         """
         prefix = sub_directory + '/' if sub_directory else ''
 
@@ -91,6 +774,8 @@ class Git(object):
                 source = self.read(path).decode('utf-8')
             except NotFoundError:
                 raise jinja2.TemplateNotFound(template)
+            if dependencies is not None:
+                dependencies[path] = self.find_entry(path)[1]
             # Fake filename for tracebacks:
             filename = '%s/<git commit %s>/%s' % (
                 self.repository.path, self.head.id, path)
@@ -102,66 +787,382 @@ class Git(object):
         loader.get_source = get_source
         return loader
 
-    def history(self):
-        """Return an iterable of commit IDs, starting from this one.
+    @property
+    def commit_index(self):
+        """Return the :class:`CommitIndex` of the repository, or ``None``
+        for repositories that are not stored on disk.
+
+        """
+        if self.index_commits and hasattr(
+                self.repository.object_store, 'path'):
+            return CommitIndex(os.path.join(
+                self.repository.controldir(), 'pynuts-commits.sqlite'))
+
+    def history(self, offset=0, limit=None, after=None):
+        """Return an iterable of :class:`VersionInfo`, starting from this
+        commit.
 
         For merge commits, only the first parent is followed.
         The history is empty if the branch does not exist yet.
 
+        The history is read from the :attr:`commit_index`, updated with the
+        commits missing since the last call. Only the requested commits are
+        read, so that paginating with `after` costs the size of the page.
+
+        :param offset: number of commits to skip
+        :param limit: maximum number of commits, ``None`` for no limit
+        :param after: start with the parent of this commit instead of this
+            commit, the commit being in this history
+
+        """
+        if after is not None:
+            if hasattr(after, 'encode'):
+                after = after.encode('ascii')
+            index = self.commit_index
+            info = index.get(after) if index is not None else None
+            if info is None:
+                info = VersionInfo.from_commit(self.repository[after])
+            sha = info.parent
+        else:
+            sha = self.head.id if self.head else None
+        if sha is None or limit == 0:
+            return []
+
+        index = self.commit_index
+        if index is not None:
+            if index.get(sha) is None:
+                index.update(self.repository, sha)
+            return index.history(sha, offset, limit)
+
+        versions = []
+        position = 0
+        while sha is not None:
+            if limit is not None and position >= offset + limit:
+                break
+            commit = self.repository[sha]
+            if position >= offset:
+                versions.append(VersionInfo.from_commit(commit))
+            position += 1
+            sha = commit.parents[0] if commit.parents else None
+        return versions
+
+    def path_history(self, path, limit=None):
+        """Return the list of :class:`VersionInfo` of the commits changing
+        the file or directory at `path`, starting from this commit.
+
+        For merge commits, only the first parent is followed. Commits adding
+        and removing `path` are included. Parents and trees are read from
+        the :attr:`commit_index`, without loading commit objects, and
+        subtrees are only read when they differ from the ones of the child
+        commit, so that commits not touching the directories of `path` cost
+        an index row.
+
+        :param path: path of the file or directory
+        :param limit: maximum number of commits, ``None`` for no limit
+
+        :raises ValueError
+
+        """
+        parts = self._split(path)
+        versions = []
+        if self.head is None or limit == 0:
+            return versions
+        index = self.commit_index
+        if index is not None:
+            if index.get(self.head.id) is None:
+                index.update(self.repository, self.head.id)
+            commits = index.tree_history(self.head.id)
+        else:
+            commits = self._tree_history()
+        info = shas = None
+        with closing(commits):
+            for parent_info, tree in commits:
+                if tree is None:
+                    tree = self.repository[parent_info.id].tree
+                parent_shas = self._path_shas(tree, parts, shas)
+                if info is not None and shas[-1] != parent_shas[-1]:
+                    versions.append(info)
+                    if limit is not None and len(versions) >= limit:
+                        return versions
+                info, shas = parent_info, parent_shas
+        # The root commit adds the path if it exists
+        if shas[-1] is not None:
+            versions.append(info)
+        return versions
+
+    def _tree_history(self):
+        """Yield the ``(version_info, tree)`` tuples of the first-parent
+        history starting with this commit, loading the commits.
+
         """
         commit = self.head
-        if not commit:
+        while commit is not None:
+            yield VersionInfo.from_commit(commit), commit.tree
+            commit = (
+                self.repository[commit.parents[0]] if commit.parents
+                else None)
+
+    def diff(self, other_commit, text=True, context=3):
+        """Return the list of the :class:`Change` of the files between this
+        commit and `other_commit`, sorted by path.
+
+        Trees are compared recursively, and subtrees with identical SHAs are
+        skipped, so that the cost of the comparison depends on the size of
+        the changes, not on the size of the trees.
+
+        :param other_commit: SHA1 hash of the commit to compare with
+        :param text: whether to compute the unified diffs of the text files
+        :param context: number of context lines of the unified diffs
+
+        """
+        if hasattr(other_commit, 'encode'):
+            other_commit = other_commit.encode('ascii')
+        other_tree = self.repository[other_commit].tree
+        changes = []
+        self._diff_trees(
+            self.tree.id if len(self.tree) else None, other_tree, b'', changes)
+        if text:
+            for change in changes:
+                change.diff = self._unified_diff(change, context)
+        return changes
+
+    def _diff_trees(self, old_id, new_id, prefix, changes, modes=None):
+        """Append the changes between the trees `old_id` and `new_id`, one
+        of them being possibly ``None``, to `changes`.
+
+        The new modes of the changed files are stored in the `modes` dict,
+        keyed by path, if given.
+
+        """
+        if old_id == new_id:
             return
-        while 1:
-            yield commit.id
-            if not commit.parents:
-                break
-            commit = self.repository[commit.parents[0]]
+        old = self._get_tree(old_id) if old_id else Tree()
+        new = self._get_tree(new_id) if new_id else Tree()
+        for name in sorted(set(old) | set(new)):
+            old_mode, old_sha = old[name] if name in old else (None, None)
+            new_mode, new_sha = new[name] if name in new else (None, None)
+            if (old_mode, old_sha) == (new_mode, new_sha):
+                continue
+            path = prefix + name
+            old_is_tree = old_mode is not None and stat.S_ISDIR(old_mode)
+            new_is_tree = new_mode is not None and stat.S_ISDIR(new_mode)
+            if old_is_tree or new_is_tree:
+                # A file may be replaced by a tree, or a tree by a file
+                if old_sha is not None and not old_is_tree:
+                    changes.append(Change(path.decode('utf-8'), old_sha, None))
+                self._diff_trees(
+                    old_sha if old_is_tree else None,
+                    new_sha if new_is_tree else None, path + b'/', changes,
+                    modes)
+                if new_sha is not None and not new_is_tree:
+                    changes.append(Change(path.decode('utf-8'), None, new_sha))
+            else:
+                changes.append(Change(path.decode('utf-8'), old_sha, new_sha))
+            if modes is not None and new_sha is not None and not new_is_tree:
+                modes[path.decode('utf-8')] = new_mode
+
+    def _unified_diff(self, change, context):
+        """Return the unified diff of `change`, or ``None`` if one of the
+        blobs is not UTF-8 text.
 
-    def _lookup(self, path, create_trees=False):
         """
-        :raises ValueError, NotFoundError, ObjectTypeError
+        lines = []
+        for sha in (change.old_id, change.new_id):
+            data = self._get_object(sha).data if sha else b''
+            if b'\0' in data:
+                return None
+            try:
+                lines.append(data.decode('utf-8').splitlines())
+            except UnicodeDecodeError:
+                return None
+        return '\n'.join(difflib.unified_diff(
+            lines[0], lines[1],
+            'a/' + change.path if change.old_id else '/dev/null',
+            'b/' + change.path if change.new_id else '/dev/null',
+            n=context, lineterm=''))
+
+    def _path_shas(self, tree_id, parts, previous=None):
+        """Return the list of the SHAs of the trees and of the entry along
+        the `parts` of a path, starting with `tree_id`.
+
+        SHAs are ``None`` after a missing entry. When a tree is the same as
+        in the `previous` list, the following SHAs are taken from it.
+
+        """
+        shas = [tree_id]
+        for i, name in enumerate(parts):
+            if previous is not None and previous[i] == shas[i]:
+                return shas + previous[i + 1:]
+            tree = self._get_tree(shas[i]) if shas[i] else None
+            if tree is None or tree.type_name != b'tree' or name not in tree:
+                return shas + [None] * (len(parts) - i)
+            shas.append(tree[name][1])
+        return shas
+
+    @staticmethod
+    def _split(path):
+        """Return the list of the encoded parts of `path`.
+
+        :raises ValueError
+
         """
         parts = [
             part.encode('utf-8')
             for part in path.split('/') if part]
         if not parts:
             raise ValueError('empty path: %r' % path)
+        return parts
 
-        last_i = len(parts) - 1
-        tree = self.tree
-        steps = []
-        for i, name in enumerate(parts):
-            if name in tree:
-                _mode, sha = tree[name]
-                obj = self._get_object(sha)
-                # All but the last part must be trees
-                if i < last_i and obj.type_name != b'tree':
-                    path = b'/'.join(name for _, name, _ in steps)
-                    raise ObjectTypeError("'%s' is a %s, expected a tree."
-                                          % (path, obj.type_name))
-            elif create_trees:
-                obj = Tree() if i < last_i else None
-            else:
-                raise NotFoundError(path)
-            steps.append((tree, name, obj))
-            tree = obj
-        return steps, obj
+    def _get_tree(self, sha):
+        """Return the object of `sha`, trees coming from the shared cache.
 
-    def read(self, path):
-        """Return as a byte string the content of the blob at `path`.
+        Cached trees are shared by all the instances and must not be
+        modified.
+
+        """
+        obj = self.tree_cache.get(sha)
+        if obj is None:
+            obj = self._get_object(sha)
+            if obj.type_name == b'tree':
+                self.tree_cache.set(sha, obj)
+        return obj
+
+    def find_entry(self, path):
+        """Return the ``(mode, sha)`` tree entry at `path`.
+
+        As trees are immutable, the entry found for a path in a given tree
+        is cached, and the next lookups cost a dictionary lookup.
+
+        :raises ValueError, NotFoundError, ObjectTypeError
+
+        """
+        parts = self._split(path)
+        key = (self.tree.id, tuple(parts))
+        entry = self.path_cache.get(key)
+        if entry is None:
+            last_i = len(parts) - 1
+            tree = self.tree
+            for i, name in enumerate(parts):
+                if name not in tree:
+                    raise NotFoundError(path)
+                entry = tree[name]
+                if i < last_i:
+                    tree = self._get_tree(entry[1])
+                    # All but the last part must be trees
+                    if tree.type_name != b'tree':
+                        raise ObjectTypeError(
+                            "'%s' is a %s, expected a tree." % (
+                                b'/'.join(parts[:i + 1]), tree.type_name))
+            self.path_cache.set(key, entry)
+        return entry
+
+    def _find(self, path):
+        """Return the object at `path`, using the shared caches.
+
+        :raises ValueError, NotFoundError, ObjectTypeError
+
+        """
+        mode, sha = self.find_entry(path)
+        if stat.S_ISDIR(mode):
+            return self._get_tree(sha)
+        return self._get_object(sha)
+
+    def get_blob(self, path):
+        """Return the blob object at `path`.
 
         :raises: ObjectTypeError
 
         """
-        _, blob = self._lookup(path)
+        blob = self._find(path)
         if blob.type_name != b'blob':
             raise ObjectTypeError(
                 "'%s' is a %s, expected a blob." % (path, blob.type_name))
-        return blob.data
+        return blob
+
+    def blobs_unchanged(self, blobs):
+        """Return whether the blobs at the paths of the `blobs` dict have
+        the SHAs given as values.
+
+        """
+        for path, sha in blobs.items():
+            try:
+                if self.find_entry(path)[1] != sha:
+                    return False
+            except (ValueError, NotFoundError, ObjectTypeError):
+                return False
+        return True
+
+    def read(self, path):
+        """Return as a byte string the content of the blob at `path`.
+
+        :raises: ObjectTypeError
+
+        """
+        return self.get_blob(path).data
+
+    def open(self, path):
+        """Return a :class:`BlobReader` reading the blob at `path` by chunks.
+
+        Loose objects and blobs stored whole in packs are decompressed by
+        chunks and never fully loaded in memory. Deltified and pending
+        objects are loaded before being read.
+
+        :raises: ObjectTypeError
+
+        """
+        mode, sha = self.find_entry(path)
+        if stat.S_ISDIR(mode):
+            raise ObjectTypeError("'%s' is a tree, expected a blob." % path)
+        object_store = self.repository.object_store
+        if hasattr(object_store, 'path') and not (
+                self._pending and sha in self._pending):
+            hexsha = bytes(sha).decode('ascii')
+            try:
+                fd = open(os.path.join(
+                    object_store.path, hexsha[:2], hexsha[2:]), 'rb')
+            except IOError:
+                pass  # Packed object
+            else:
+                return BlobReader(fd, chunk_size=self.chunk_size)
+            reader = self._open_packed(sha)
+            if reader is not None:
+                return reader
+        data = self._get_object(sha).data
+        return BlobReader(io.BytesIO(data), size=len(data))
+
+    def _open_packed(self, sha):
+        """Return a :class:`BlobReader` reading the blob `sha` stored whole
+        in a pack, or ``None``.
+
+        """
+        pack = self._find_pack(sha)
+        if pack is None:
+            return None
+        fd = open(_pack_path(pack), 'rb')
+        try:
+            fd.seek(pack.index.object_index(sha))
+            byte = ord(fd.read(1))
+            type_num, size, shift = (byte >> 4) & 7, byte & 15, 4
+            while byte & 0x80:
+                byte = ord(fd.read(1))
+                size |= (byte & 0x7f) << shift
+                shift += 7
+        except Exception:
+            fd.close()
+            raise
+        if type_num != Blob.type_num:
+            fd.close()
+            if type_num in (Tree.type_num, Commit.type_num):
+                raise ObjectTypeError('Found a %s, expected a blob.' % (
+                    'tree' if type_num == Tree.type_num else 'commit'))
+            return None  # Deltified object
+        return BlobReader(
+            fd, size, chunk_size=self.chunk_size, compressed=True)
 
     def write(self, path, bytestring):
-        """Update in place self.tree and make sure everything is stored.
+        """Update self.tree and make sure everything is stored.
+
+        In a :meth:`transaction`, the file is only staged.
 
         :param path: path to the file to write
         :param bytestring: content of the file to write
@@ -169,19 +1170,111 @@ class Git(object):
         :raises ObjectTypeError
 
         """
-        steps, _ = self._lookup(path, create_trees=True)
-        tree, name, obj = steps.pop()
-        if obj and obj.type_name != b'blob':
-            raise ObjectTypeError('Will not overwrite a %s at %s'
-                                  % (obj.type_name, path))
+        if self._staged is None:
+            self.write_many({path: bytestring})
+        else:
+            self._split(path)
+            self._staged[path] = bytestring
+
+    def write_many(self, files):
+        """Write many files, storing each modified tree only once.
+
+        :param files: dict of byte strings, keyed by path
+
+        :raises ObjectTypeError
+
+        """
+        if files:
+            self.tree = self._apply(self.tree, files)
+
+    def _apply(self, tree, files):
+        """Return a copy of ``tree`` with the ``files`` written and store it.
+
+        Values of ``files`` are byte strings, :class:`StoredBlob` objects
+        for blobs already stored, or ``None`` for files to remove.
 
-        tree[name] = 0o100644, self.store_bytes(bytestring).id
+        """
+        # Build nested dicts of the changes, keyed by tree entry name
+        changes = {}
+        for path, bytestring in files.items():
+            parts = self._split(path)
+            node = changes
+            for name in parts[:-1]:
+                node = node.setdefault(name, {})
+                if not isinstance(node, dict):
+                    raise ObjectTypeError(
+                        'Will not write both a file and a tree at %s' % path)
+            if isinstance(node.get(parts[-1]), dict):
+                raise ObjectTypeError(
+                    'Will not write both a file and a tree at %s' % path)
+            node[parts[-1]] = bytestring
+        # Work on a copy, so that the tree is unchanged in case of error
+        tree = tree.copy()
+        self._write_changes(tree, changes, b'')
+        return tree
+
+    def _write_changes(self, tree, changes, prefix):
+        """Apply the nested dict of ``changes`` to ``tree`` and store it."""
+        for name, change in changes.items():
+            path = prefix + name
+            if name in tree:
+                mode, sha = tree[name]
+                is_tree = stat.S_ISDIR(mode)
+            else:
+                sha, is_tree = None, None
+            if isinstance(change, dict):
+                if sha is None:
+                    sub_tree = Tree()
+                elif is_tree:
+                    # Not from the shared cache, as it is modified
+                    sub_tree = self._get_object(sha)
+                else:
+                    raise ObjectTypeError(
+                        "'%s' is a blob, expected a tree."
+                        % path.decode('utf-8'))
+                self._write_changes(sub_tree, change, path + b'/')
+                if len(sub_tree):
+                    tree[name] = 0o40000, sub_tree.id
+                elif sha is not None:
+                    # Git does not store empty trees
+                    del tree[name]
+            else:
+                if is_tree:
+                    raise ObjectTypeError(
+                        'Will not overwrite a tree at %s'
+                        % path.decode('utf-8'))
+                if change is None:
+                    if sha is not None:
+                        del tree[name]
+                elif isinstance(change, StoredBlob):
+                    self.freshen(change.id)
+                    tree[name] = change.mode, change.id
+                else:
+                    tree[name] = 0o100644, self.store_bytes(change).id
         self._add_object(tree)
 
-        for tree, name, sub_tree in reversed(steps):
-            tree[name] = 0o40000, sub_tree.id
-            self._add_object(tree)
-        # self.tree ends up updated in-place.
+    @contextmanager
+    def transaction(self):
+        """Stage the files written in the block, and write them at once.
+
+        Each tree modified by the files written in the block is stored only
+        once, when the block ends. Staged files cannot be read before.
+
+        .. sourcecode:: python
+
+            with git.transaction():
+                for path, content in parts.items():
+                    git.write(path, content)
+            git.commit('Pynuts', 'pynuts@pynuts.org', 'Edit parts')
+
+        """
+        self._staged = {}
+        try:
+            yield self
+            staged = self._staged
+        finally:
+            self._staged = None
+        self.write_many(staged)
 
     def commit(self, author_name, author_email, message):
         """Add a new commit in the current branch with this one (if any)
@@ -199,16 +1292,121 @@ class Git(object):
         new_commit = self.store_commit(
             self.tree.id, author_name, author_email, message,
             parents=[self.head.id] if self.head else [])
+        # Objects must be stored before being referenced by the branch
+        self.flush()
+        refresh_packed_refs(self.repository)
         refs = self.repository.refs
         if self.head:
-            if not refs.set_if_equals(self.ref, self.head.id, new_commit.id):
-                raise ConflictError('%s is not the last commit in %s.'
-                                    % (self.head.id, self.ref))
+            head, tree = self.head, self.tree
+            retries = self.merge_retries
+            while not self._set_ref(head.id, new_commit.id):
+                if retries <= 0:
+                    raise ConflictError('%s is not the last commit in %s.'
+                                        % (head.id, self.ref))
+                retries -= 1
+                other_id = refs.read_ref(self.ref)
+                if other_id is None:
+                    raise ConflictError('%s has been deleted.' % self.ref)
+                head, tree = self._merge(head, tree, other_id)
+                new_commit = self.store_commit(
+                    tree.id, author_name, author_email, message,
+                    parents=[head.id])
+                self.flush()
+            self.tree = tree
         else:
-            if not refs.add_if_new(self.ref, new_commit.id):
+            def write():
+                """Create the ref, return whether it has been created."""
+                return self._retry_locked(
+                    lambda: refs.add_if_new(self.ref, new_commit.id))
+
+            if not RefIndex.write_ref(self.repository, self.ref, write):
                 raise ConflictError('%s already exists.' % self.ref)
         self.head = new_commit
 
+    def _set_ref(self, old_id, new_id):
+        """Set the branch to `new_id` if it is `old_id`, return whether the
+        branch has been set.
+
+        A ref locked by another save or by the maintenance is written again
+        once unlocked (see :meth:`_retry_locked`).
+
+        """
+        def write():
+            """Set the ref, return whether it has been set."""
+            return self._retry_locked(
+                lambda: self.repository.refs.set_if_equals(
+                    self.ref, old_id, new_id))
+
+        return RefIndex.write_ref(self.repository, self.ref, write)
+
+    def _retry_locked(self, write):
+        """Call `write`, writing the ref of the branch, and return its
+        result. It is called again after the :attr:`lock_delays` while the
+        ref is locked.
+
+        :raises: GitException if the ref is still locked
+
+        """
+        for delay in self.lock_delays:
+            try:
+                return write()
+            except FileLocked:
+                time.sleep(delay)
+        try:
+            return write()
+        except FileLocked:
+            raise GitException('%s is locked.' % self.ref.decode('utf-8'))
+
+    def _merge(self, base, tree, other_id):
+        """Apply the changes between the `base` commit and `tree` to the
+        commit `other_id`, and return this commit and the merged tree.
+
+        :raises: ConflictError if both sides changed the same paths
+
+        """
+        other = self.repository[other_id]
+        changes, other_changes = [], []
+        modes, other_modes = {}, {}
+        self._diff_trees(base.tree, tree.id, b'', changes, modes)
+        self._diff_trees(
+            base.tree, other.tree, b'', other_changes, other_modes)
+
+        other_paths = dict(
+            (change.path, (change.new_id, other_modes.get(change.path)))
+            for change in other_changes)
+        other_dirs = set()
+        for path in other_paths:
+            parts = path.split('/')
+            for i in range(1, len(parts)):
+                other_dirs.add('/'.join(parts[:i]))
+        conflicts = []
+        for change in changes:
+            parts = change.path.split('/')
+            if change.path in other_paths:
+                # Identical changes on both sides are not conflicts
+                if other_paths[change.path] != (
+                        change.new_id, modes.get(change.path)):
+                    conflicts.append(change.path)
+            elif change.path in other_dirs or any(
+                    '/'.join(parts[:i]) in other_paths
+                    for i in range(1, len(parts))):
+                conflicts.append(change.path)
+        if conflicts:
+            raise ConflictError('Concurrent changes in %s.' % ', '.join(
+                sorted(conflicts)))
+
+        files = dict(
+            (change.path,
+             StoredBlob(change.new_id, modes[change.path])
+             if change.new_id else None)
+            for change in changes)
+        # A file replaced by a tree is removed by writing the tree
+        for path in list(files):
+            if files[path] is None and any(
+                    other.startswith(path + '/') for other in files):
+                del files[path]
+        return other, self._apply(self.repository[other.tree], files)
+
     def store_commit(self, tree_id, author_name, author_email,
                      message, parents, timezone=None):
         """Store a new commit and return its ID.
@@ -239,36 +1437,179 @@ class Git(object):
         self._add_object(commit)
         return commit
 
-    def store_directory(self, root):
+    def store_directory(self, root, threads=None):
         """Recursively store a directory and its content as a tree and
-        return its ID.
+        return it.
 
-        Symbolic links are followed. Other special files are ignored
+        Symbolic links are followed. Other special files are ignored.
+
+        Files are read, hashed and compressed in parallel threads, as zlib
+        and hashlib release the GIL.
 
         :param root: git tree root
+        :param threads: number of threads storing the files, default is
+            :attr:`store_threads`
 
         """
-        tree = Tree()
-        for name in os.listdir(root):
-            fullname = os.path.join(root, name)
-            if os.path.isdir(fullname):
-                tree.add(name.encode('utf-8'), 0o40000, self.store_directory(fullname).id)
-            elif os.path.isfile(fullname):
-                tree.add(name.encode('utf-8'), 0o100644, self.store_file(fullname).id)
+        filenames = []
+        layout = self._scan_directory(root, filenames)
+        ids = self._store_files(
+            filenames, self.store_threads if threads is None else threads)
+        return self._store_layout(layout, ids)
+
+    @staticmethod
+    def _scan_directory(root, filenames):
+        """Return the list of ``(name, fullname, layout)`` tuples of the
+        entries in `root`, ``layout`` being ``None`` for files and the list of
+        the sub-directory entries for directories.
+
+        The names of the files found are appended to `filenames`.
+
+        """
+        if scandir is None:
+            entries = [
+                (name, os.path.join(root, name)) for name in os.listdir(root)]
+            entries = [
+                (name, fullname, os.path.isdir(fullname),
+                 os.path.isfile(fullname))
+                for name, fullname in entries]
+        else:
+            entries = [
+                (entry.name, entry.path, entry.is_dir(), entry.is_file())
+                for entry in scandir(root)]
+        layout = []
+        for name, fullname, is_dir, is_file in entries:
+            if is_dir:
+                layout.append((name, fullname, Git._scan_directory(
+                    fullname, filenames)))
+            elif is_file:
+                layout.append((name, fullname, None))
+                filenames.append(fullname)
             #else: Ignore special files.
+        return layout
+
+    def _store_files(self, filenames, threads):
+        """Store the files and return a dict of their blob ids, keyed by
+        file name.
+
+        """
+        if threads <= 1 or len(filenames) <= 1:
+            return dict(
+                (filename, self.store_file(filename).id)
+                for filename in filenames)
+
+        lock = threading.Lock()
+        stored = set()
+
+        def store(filename):
+            """Store a file, only once for identical files."""
+            blob = self._read_file(filename)
+            blob_id = blob.id
+            with lock:
+                is_new = blob_id not in stored
+                stored.add(blob_id)
+            if is_new and not isinstance(blob, StoredBlob):
+                self._add_object(blob)
+            return blob_id
+
+        pool = ThreadPool(min(threads, len(filenames)))
+        try:
+            return dict(zip(filenames, pool.map(store, filenames)))
+        finally:
+            pool.terminate()
+
+    def _store_layout(self, layout, ids):
+        """Store the trees of `layout` with the blob `ids` and return the
+        root tree.
+
+        """
+        tree = Tree()
+        for name, fullname, sub_layout in layout:
+            if sub_layout is None:
+                tree.add(name.encode('utf-8'), 0o100644, ids[fullname])
+            else:
+                tree.add(
+                    name.encode('utf-8'), 0o40000,
+                    self._store_layout(sub_layout, ids).id)
         self._add_object(tree)
         return tree
 
     def store_file(self, filename):
-        """Store a file as a blob and return its ID.
+        """Store a file as a blob and return it.
+
+        Files bigger than :attr:`chunk_size` are hashed, compressed and
+        written by chunks in a loose object, without being read in memory.
+        The returned blob is then a :class:`StoredBlob`, with no data. They
+        are kept loose with ``pack=True`` too, as pending objects are held
+        in memory, until :mod:`pynuts.maintenance` packs them; :meth:`open`
+        reads them by chunks in both cases.
 
         :param filename: name of the file to store
 
         """
-        # TODO: store by chunks without reading everything in memory?
+        blob = self._read_file(filename)
+        if not isinstance(blob, StoredBlob):
+            self._add_object(blob)
+        return blob
+
+    def _read_file(self, filename):
+        """Return the blob of a file.
 
+        Big files are stored by chunks and returned as a
+        :class:`StoredBlob`, other blobs are not stored.
+
+        """
         with open(filename, 'rb') as bytes_file:
-            return self.store_bytes(bytes_file.read())
+            size = os.fstat(bytes_file.fileno()).st_size
+            if size <= self.chunk_size or not hasattr(
+                    self.repository.object_store, 'path'):
+                return Blob.from_string(bytes_file.read())
+            return self._store_stream(bytes_file, size)
+
+    def _store_stream(self, bytes_file, size):
+        """Store ``size`` bytes of ``bytes_file`` in a loose object by chunks,
+        and return a :class:`StoredBlob`.
+
+        """
+        objects_path = self.repository.object_store.path
+        fd, temp_filename = tempfile.mkstemp(dir=objects_path)
+        try:
+            sha = hashlib.sha1()
+            compressor = zlib.compressobj()
+            stored_size = 0
+            with os.fdopen(fd, 'wb') as temp_file:
+                header = ('blob %d' % size).encode('ascii') + b'\0'
+                sha.update(header)
+                temp_file.write(compressor.compress(header))
+                while True:
+                    chunk = bytes_file.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    stored_size += len(chunk)
+                    sha.update(chunk)
+                    temp_file.write(compressor.compress(chunk))
+                temp_file.write(compressor.flush())
+            if stored_size != size:
+                raise GitException(
+                    '%s changed while being stored.' % bytes_file.name)
+            hexsha = sha.hexdigest()
+            filename = os.path.join(objects_path, hexsha[:2], hexsha[2:])
+            if self._freshen_loose(hexsha):
+                os.remove(temp_filename)
+            else:
+                if not os.path.isdir(os.path.dirname(filename)):
+                    try:
+                        os.makedirs(os.path.dirname(filename))
+                    except OSError:
+                        # Created by another thread in the meantime
+                        pass
+                os.chmod(temp_filename, 0o444)
+                os.rename(temp_filename, filename)
+        except Exception:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+        return StoredBlob(hexsha.encode('ascii'))
 
     def store_bytes(self, bytestring):
         """Store a byte string as a blob and return its ID.
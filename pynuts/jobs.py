@@ -0,0 +1,270 @@
+"""Background PDF jobs for Pynuts.
+
+PDF documents can be rendered in background threads, their status and
+result being stored in a SQLite database. Jobs are identified by the
+document type, version, part and data, so that asking many times for the
+same document only renders it once, even from many processes sharing the
+database.
+
+Job ids can be guessed, and are never given to clients. Each request for a
+job gets a random ticket instead, storing its attachment filename, and
+only the holders of a ticket get the PDF.
+
+"""
+
+import os
+import time
+import binascii
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+
+import flask
+from flask import Response, jsonify
+from werkzeug.datastructures import Headers
+
+
+class JobStore(object):
+    """SQLite store of the PDF jobs and of their results.
+
+    :param path: path of the SQLite database, created if needed
+
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, status TEXT, error TEXT, pdf BLOB, '
+            'updated REAL)')
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS tickets ('
+            'id TEXT PRIMARY KEY, job TEXT, filename TEXT, created REAL)')
+
+    def _execute(self, query, parameters=()):
+        """Execute ``query`` in a transaction and return the fetched rows."""
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            with connection:
+                return connection.execute(query, parameters).fetchall()
+
+    def get(self, job_id):
+        """Return the job as a dict, or ``None`` if it does not exist."""
+        rows = self._execute(
+            'SELECT id, status, error, pdf, updated '
+            'FROM jobs WHERE id = ?', (job_id,))
+        if rows:
+            return dict(zip(
+                ('id', 'status', 'error', 'pdf', 'updated'), rows[0]))
+
+    def add_ticket(self, job_id, filename=None):
+        """Return a new random ticket giving access to the job.
+
+        :param job_id: id of the job
+        :param filename: attachment filename of the PDF, expect unicode
+
+        """
+        ticket = binascii.hexlify(os.urandom(20)).decode('ascii')
+        self._execute(
+            'INSERT INTO tickets (id, job, filename, created) '
+            'VALUES (?, ?, ?, ?)', (ticket, job_id, filename, time.time()))
+        return ticket
+
+    def get_ticket(self, ticket):
+        """Return the ticket as a dict with its ``job`` id and its
+        ``filename``, or ``None`` if it does not exist.
+
+        """
+        rows = self._execute(
+            'SELECT id, job, filename FROM tickets WHERE id = ?', (ticket,))
+        if rows:
+            return dict(zip(('id', 'job', 'filename'), rows[0]))
+
+    def claim(self, job_id, stale_after=None):
+        """Mark the job as pending and return whether the caller must run it.
+
+        The job is claimed if it does not exist or if it failed. Jobs pending
+        or running for more than ``stale_after`` seconds are considered lost,
+        for example after a restart of their process, and are claimed again.
+        Concurrent claims of the same job, even from other processes, only
+        succeed once.
+
+        """
+        now = time.time()
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            with connection:
+                claimed = connection.execute(
+                    'INSERT OR IGNORE INTO jobs (id, status, updated) '
+                    'VALUES (?, ?, ?)', (job_id, 'pending', now)).rowcount
+                if not claimed:
+                    limit = now - stale_after if stale_after else 0
+                    claimed = connection.execute(
+                        'UPDATE jobs SET status = ?, error = NULL, '
+                        'pdf = NULL, updated = ? '
+                        'WHERE id = ? AND (status = ? OR ('
+                        'status IN (?, ?) AND updated < ?))',
+                        ('pending', now, job_id, 'failed',
+                         'pending', 'running', limit)).rowcount
+        return claimed == 1
+
+    def update(self, job_id, status, error=None, pdf=None):
+        """Update the status, the error message and the PDF of the job."""
+        self._execute(
+            'UPDATE jobs SET status = ?, error = ?, pdf = ?, updated = ? '
+            'WHERE id = ?',
+            (status, error, sqlite3.Binary(pdf) if pdf else None, time.time(),
+             job_id))
+
+    def purge(self, max_age):
+        """Remove the jobs not updated and the tickets created more than
+        ``max_age`` seconds ago.
+
+        """
+        limit = time.time() - max_age
+        self._execute('DELETE FROM jobs WHERE updated < ?', (limit,))
+        self._execute('DELETE FROM tickets WHERE created < ?', (limit,))
+
+
+class JobQueue(object):
+    """Queue rendering PDF documents in background threads.
+
+    Jobs are rendered in a request context similar to the one where they
+    have been enqueued, so that resources are fetched from the application.
+
+    :param app: the Flask application
+    :param store: the :class:`JobStore` of the jobs
+    :param threads: number of rendering threads
+    :param timeout: number of seconds after which pending and running jobs
+                    are considered lost and are enqueued again, ``None``
+                    for no limit
+    :param max_age: number of seconds the jobs are kept after their last
+                    update, ``None`` to keep them forever
+
+    """
+    def __init__(self, app, store, threads=2, timeout=600, max_age=86400):
+        self.app = app
+        self.store = store
+        self.threads = threads
+        self.timeout = timeout
+        self.max_age = max_age
+        self._pool = None
+        self._purged = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """Thread pool, created on first use."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+            return self._pool
+
+    @staticmethod
+    def job_id(document, part, archive):
+        """Return the id of the job rendering ``part`` of ``document``.
+
+        The id depends on the document type, version, part and data.
+        :class:`ValueError` is raised when the document data has no
+        :meth:`pynuts.document.Document.render_cache_key`, as identical
+        jobs could not be recognized.
+
+        """
+        git = document.archive_git if archive else document.git
+        data_key = document.render_cache_key()
+        if data_key is None:
+            raise ValueError(
+                'The data of %s documents cannot be identified, override '
+                'render_cache_key to enqueue them' % document.type_name)
+        version = bytes(git.head.id).decode('ascii') if git.head else ''
+        key = '%s/%s/%s/%s/%s' % (
+            document.type_name, version, part, bool(archive), data_key)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def enqueue(self, document, part='index.rst.jinja2', archive=False,
+                filename=None):
+        """Enqueue the rendering of ``part`` of ``document`` and return a
+        new ticket giving access to the job.
+
+        Nothing is rendered if the same job is already done, or pending or
+        running in any process. Old jobs are purged from the store.
+
+        :param document: the document instance to render
+        :param part: part of the document to render
+        :param archive: whether to render the archive
+        :param filename: attachment filename of the PDF, expect unicode
+
+        """
+        job_id = self.job_id(document, part, archive)
+        self._purge()
+        ticket = self.store.add_ticket(job_id, filename)
+        if not self.store.claim(job_id, self.timeout):
+            return ticket
+        if flask.has_request_context():
+            path, url_root = flask.request.path, flask.request.url_root
+        else:
+            path, url_root = '/', None
+        self.pool.apply_async(
+            self._run, (job_id, document, part, archive, path, url_root))
+        return ticket
+
+    def _run(self, job_id, document, part, archive, path, url_root):
+        """Render the job and store its result."""
+        try:
+            self.store.update(job_id, 'running')
+            with self.app.test_request_context(path, base_url=url_root):
+                pdf = document._generate_pdf(part=part, archive=archive)
+        except Exception as exception:
+            self.store.update(job_id, 'failed', error=str(exception))
+        else:
+            self.store.update(job_id, 'done', pdf=pdf)
+
+    def _purge(self):
+        """Purge the old jobs, at most once per hour."""
+        if self.max_age is None:
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._purged < min(self.max_age, 3600):
+                return
+            self._purged = now
+        self.store.purge(self.max_age)
+
+    def response(self, ticket):
+        """Return a HTTP response with the PDF of the job of ``ticket`` if it
+        is done, with the attachment filename of the ticket.
+
+        Otherwise, return the status of the job as JSON, with the 202 status
+        code if the job is pending or running, 500 if it failed and 404 if
+        the ticket or the job does not exist.
+
+        """
+        ticket_info = self.store.get_ticket(ticket)
+        job = self.store.get(ticket_info['job']) if ticket_info else None
+        if job is None:
+            response = jsonify(id=ticket, status='unknown')
+            response.status_code = 404
+            return response
+        if job['status'] == 'done':
+            filename = ticket_info['filename']
+            headers = Headers()
+            headers.add(
+                'Content-Disposition', 'attachment',
+                filename=filename.encode('utf-8') if filename else None)
+            return Response(
+                bytes(job['pdf']), mimetype='application/pdf',
+                headers=headers)
+        response = jsonify(
+            id=ticket, status=job['status'], error=job['error'])
+        response.status_code = 500 if job['status'] == 'failed' else 202
+        return response
+
+    def close(self):
+        """Stop the rendering threads once the current jobs are done."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -0,0 +1,422 @@
+"""Maintenance of the document repositories for Pynuts.
+
+Documents write loose objects and loose refs, that slow down reads as they
+pile up. :func:`maintain` packs the objects and the refs of a repository,
+and removes the objects that are not reachable anymore. It is available as
+:meth:`pynuts.Pynuts.maintain` for the repositories of an application, and
+as a command::
+
+    pynuts-maintenance instance/documents.git
+    pynuts-maintenance --app application:nuts
+
+Maintenance is safe while the application is running: the new pack is
+written before the objects it replaces are removed, refs are locked when
+their loose files are removed, and only the objects and packs older than a
+grace period are pruned, so that objects being written by a document save
+are kept. Objects reused by a save are freshened (see
+:meth:`pynuts.git.Git.freshen`), and the objects referenced by recent
+objects are kept too.
+
+"""
+
+import os
+import re
+import stat
+import time
+import zlib
+import argparse
+import importlib
+
+from dulwich.file import GitFile, FileLocked
+from dulwich.pack import Pack
+from dulwich.refs import (
+    read_packed_refs, read_packed_refs_with_peeled, write_packed_refs)
+
+from .git import refresh_packed_refs
+
+
+#: Default number of seconds before unreachable objects are pruned
+GRACE_PERIOD = 14 * 24 * 60 * 60
+
+_LOOSE_NAME = re.compile('^[0-9a-f]{38}$')
+
+
+def _loose_objects(repository):
+    """Yield the ``(sha, path)`` tuples of the loose objects."""
+    objects_path = repository.object_store.path
+    for directory in sorted(os.listdir(objects_path)):
+        if len(directory) != 2:
+            continue
+        directory_path = os.path.join(objects_path, directory)
+        for name in os.listdir(directory_path):
+            if _LOOSE_NAME.match(name):
+                yield ((directory + name).encode('ascii'),
+                       os.path.join(directory_path, name))
+
+
+def _packs(repository):
+    """Return the list of the base names of the complete pack files."""
+    pack_dir = repository.object_store.pack_dir
+    if not os.path.isdir(pack_dir):
+        return []
+    names = os.listdir(pack_dir)
+    return sorted(
+        os.path.join(pack_dir, name[:-len('.pack')]) for name in names
+        if name.startswith('pack-') and name.endswith('.pack') and
+        name[:-len('.pack')] + '.idx' in names)
+
+
+def _loose_refs(repository):
+    """Return a dict of the shas of the loose refs, keyed by ref name."""
+    controldir = repository.controldir()
+    refs = {}
+    for root, _, filenames in os.walk(os.path.join(controldir, 'refs')):
+        for filename in filenames:
+            if filename.endswith('.lock'):
+                continue
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as fd:
+                content = fd.read().strip()
+            if content.startswith(b'ref: ') or len(content) != 40:
+                continue  # Symbolic ref
+            name = os.path.relpath(path, controldir).replace(os.sep, '/')
+            refs[name.encode('utf-8')] = content
+    return refs
+
+
+def _file_size(path):
+    """Return the size of the file at `path`, or ``0``."""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def repository_stats(repository):
+    """Return a dict with the numbers and the sizes of the loose objects,
+    of the packs and of the loose refs of `repository`.
+
+    """
+    loose = [path for _, path in _loose_objects(repository)]
+    packs = _packs(repository)
+    return {
+        'loose_objects': len(loose),
+        'loose_size': sum(_file_size(path) for path in loose),
+        'packs': len(packs),
+        'pack_size': sum(
+            _file_size(name + '.pack') + _file_size(name + '.idx')
+            for name in packs),
+        'loose_refs': len(_loose_refs(repository)),
+        'packed_refs_size': _file_size(
+            os.path.join(repository.controldir(), 'packed-refs')),
+    }
+
+
+def _loose_type(path):
+    """Return the type name of the loose object at `path`, or ``None``."""
+    try:
+        with open(path, 'rb') as fd:
+            header = zlib.decompressobj().decompress(fd.read(64))
+    except (IOError, OSError, zlib.error):
+        return None
+    return header.split(b' ', 1)[0]
+
+
+def reachable_objects(repository, heads, known=()):
+    """Return the set of the shas of the objects reachable from `heads`.
+
+    Blobs are found in their trees, and are not loaded. The objects in
+    `known` and the objects they reference are not walked.
+
+    """
+    reachable = set()
+    stack = list(heads)
+    while stack:
+        sha = stack.pop()
+        if sha in reachable or sha in known:
+            continue
+        reachable.add(sha)
+        try:
+            obj = repository[sha]
+        except KeyError:
+            continue
+        if obj.type_name == b'commit':
+            stack.append(obj.tree)
+            stack.extend(obj.parents)
+        elif obj.type_name == b'tree':
+            for name, mode, entry_sha in obj.iteritems():
+                if stat.S_ISDIR(mode):
+                    stack.append(entry_sha)
+                elif mode != 0o160000:  # Submodules are not stored
+                    reachable.add(entry_sha)
+        elif obj.type_name == b'tag':
+            stack.append(obj.object[1])
+    return reachable
+
+
+def pack_objects(repository, prune=True, grace_period=GRACE_PERIOD,
+                 now=None):
+    """Pack the loose objects and the packs of `repository` in a new pack.
+
+    Return a tuple of the number of objects packed and of the number of
+    objects pruned.
+
+    Loose objects and packs modified during the `grace_period` are only
+    packed if they are reachable, and are never removed. The objects they
+    reference are kept too, as they may be used by a save in progress.
+    Objects are loaded one by one while the new pack is written.
+
+    :param repository: the dulwich repository
+    :param prune: whether to remove the unreachable objects
+    :param grace_period: number of seconds before unreachable objects are
+        removed
+    :param now: current timestamp, default is the current time
+
+    """
+    limit = (time.time() if now is None else now) - grace_period
+    object_store = repository.object_store
+    # Refs are read before objects, so that new objects are recent
+    refresh_packed_refs(repository)
+    reachable = reachable_objects(
+        repository, set(repository.get_refs().values()))
+
+    loose = []
+    young = set()
+    for sha, path in _loose_objects(repository):
+        old = os.stat(path).st_mtime < limit
+        loose.append((sha, path, old))
+        if not old and sha not in reachable and (
+                _loose_type(path) in (b'commit', b'tree', b'tag')):
+            young.add(sha)
+    old_packs = []
+    pack_shas = {}
+    for name in _packs(repository):
+        pack = Pack(name)
+        try:
+            shas = list(pack)
+        finally:
+            pack.close()
+        if os.stat(name + '.pack').st_mtime < limit:
+            old_packs.append(name)
+            pack_shas[name] = shas
+        else:
+            young.update(sha for sha in shas if sha not in reachable)
+    # Objects referenced by recent objects may be reused by a save
+    kept = reachable_objects(repository, young, reachable) if prune else ()
+
+    objects = {}
+    packed_paths = []
+    pruned_paths = []
+    for sha, path, old in loose:
+        if sha in reachable or (old and (not prune or sha in kept)):
+            objects[sha] = path
+            packed_paths.append(path)
+        elif old:
+            pruned_paths.append(path)
+    pruned = len(pruned_paths)
+    for name in old_packs:
+        for sha in pack_shas[name]:
+            if sha in reachable or sha in kept or not prune:
+                objects.setdefault(sha, name)
+            elif sha not in objects:
+                pruned += 1
+
+    if not objects or (
+            not packed_paths and len(old_packs) == 1 and
+            len(objects) == len(pack_shas[old_packs[0]])):
+        # Nothing to pack, or the only pack is already complete
+        old_packs = []
+        packed = 0
+    else:
+        if not os.path.isdir(object_store.pack_dir):
+            os.makedirs(object_store.pack_dir)
+        new_pack = object_store.add_pack_data(
+            len(objects), _pack_records(repository, objects))
+        new_name = os.path.join(
+            object_store.pack_dir, 'pack-' + new_pack.name().decode('ascii'))
+        # The consolidated pack may have the name of an old pack
+        old_packs = [name for name in old_packs if name != new_name]
+        packed = len(objects)
+
+    # The new pack is complete, replaced objects can be removed, unless
+    # they have been freshened by a save in the meantime
+    for path in packed_paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    for path in pruned_paths:
+        try:
+            if os.stat(path).st_mtime < limit:
+                os.remove(path)
+        except OSError:
+            pass
+    for name in old_packs:
+        try:
+            if os.stat(name + '.pack').st_mtime >= limit:
+                continue
+        except OSError:
+            continue
+        for extension in ('.pack', '.idx'):
+            try:
+                os.remove(name + extension)
+            except OSError:
+                pass
+    return packed, pruned
+
+
+def _pack_records(repository, shas):
+    """Yield the pack records of the objects `shas`, loaded one by one."""
+    for sha in shas:
+        obj = repository[sha]
+        yield obj.type_num, obj.sha().digest(), None, obj.as_raw_string()
+
+
+def pack_refs(repository):
+    """Move the loose refs of `repository` to its packed refs file.
+
+    Return the number of refs packed. Each loose ref is locked and checked
+    before being removed, refs updated in the meantime are kept.
+
+    """
+    controldir = repository.controldir()
+    packed_path = os.path.join(controldir, 'packed-refs')
+    loose = _loose_refs(repository)
+    if not loose:
+        return 0
+    packed, peeled = {}, {}
+    if os.path.exists(packed_path):
+        with open(packed_path, 'rb') as fd:
+            if b'peeled' in fd.readline():
+                for sha, name, peeled_sha in read_packed_refs_with_peeled(fd):
+                    packed[name] = sha
+                    if peeled_sha:
+                        peeled[name] = peeled_sha
+            else:
+                fd.seek(0)
+                packed.update(
+                    (name, sha) for sha, name in read_packed_refs(fd))
+    packed.update(loose)
+    for name in loose:
+        peeled.pop(name, None)
+    with GitFile(packed_path, 'wb') as fd:
+        write_packed_refs(fd, packed, peeled)
+
+    count = 0
+    for name, sha in loose.items():
+        path = os.path.join(controldir, *name.decode('utf-8').split('/'))
+        try:
+            lock = GitFile(path, 'wb')
+        except FileLocked:
+            continue  # Being updated
+        try:
+            with open(path, 'rb') as fd:
+                if fd.read().strip() == sha:
+                    os.remove(path)
+                    count += 1
+        except (IOError, OSError):
+            pass
+        finally:
+            lock.abort()
+    refresh_packed_refs(repository)
+    return count
+
+
+def maintain(repository, prune=True, grace_period=GRACE_PERIOD, refs=True):
+    """Pack the objects and the refs of `repository`, and return a report.
+
+    The report is a dict with the ``before`` and ``after`` statistics
+    returned by :func:`repository_stats`, the numbers of ``packed`` objects,
+    of ``pruned`` objects and of packed ``refs``, and the ``timings`` in
+    seconds of the ``objects`` and ``refs`` steps.
+
+    :param repository: the dulwich repository
+    :param prune: whether to remove the unreachable objects
+    :param grace_period: number of seconds before unreachable objects are
+        removed
+    :param refs: whether to pack the refs
+
+    """
+    report = {'before': repository_stats(repository), 'timings': {}}
+    start = time.time()
+    report['packed'], report['pruned'] = pack_objects(
+        repository, prune=prune, grace_period=grace_period)
+    report['timings']['objects'] = time.time() - start
+    start = time.time()
+    report['refs'] = pack_refs(repository) if refs else 0
+    report['timings']['refs'] = time.time() - start
+    report['after'] = repository_stats(repository)
+    return report
+
+
+def format_report(path, report):
+    """Return a human-readable text of the `report` of the repository at
+    `path`.
+
+    """
+    before, after = report['before'], report['after']
+    return '\n'.join((
+        path,
+        '  loose objects: %d (%d bytes) -> %d (%d bytes)' % (
+            before['loose_objects'], before['loose_size'],
+            after['loose_objects'], after['loose_size']),
+        '  packs: %d (%d bytes) -> %d (%d bytes)' % (
+            before['packs'], before['pack_size'],
+            after['packs'], after['pack_size']),
+        '  loose refs: %d -> %d' % (
+            before['loose_refs'], after['loose_refs']),
+        '  %d objects packed, %d pruned in %.3f s' % (
+            report['packed'], report['pruned'],
+            report['timings']['objects']),
+        '  %d refs packed in %.3f s' % (
+            report['refs'], report['timings']['refs'])))
+
+
+def _load_application(name):
+    """Return the Pynuts object named ``module:attribute``."""
+    module_name, _, attribute = name.partition(':')
+    return getattr(importlib.import_module(module_name), attribute or 'nuts')
+
+
+def main(argv=None):
+    """Run the maintenance of document repositories."""
+    from dulwich.repo import Repo
+
+    parser = argparse.ArgumentParser(
+        description='Pack and prune Pynuts document repositories.')
+    parser.add_argument(
+        'repositories', nargs='*', help='paths of the repositories')
+    parser.add_argument(
+        '--app', metavar='MODULE:ATTRIBUTE',
+        help='Pynuts object whose repositories and configuration are used')
+    parser.add_argument(
+        '--no-prune', dest='prune', action='store_false',
+        help='keep the unreachable objects')
+    parser.add_argument(
+        '--grace-period', type=int,
+        help='number of seconds before unreachable objects are pruned')
+    parser.add_argument(
+        '--no-refs', dest='refs', action='store_false',
+        help='do not pack the refs')
+    args = parser.parse_args(argv)
+    if not args.repositories and not args.app:
+        parser.error('give the repositories or the application')
+    if args.app:
+        nuts = _load_application(args.app)
+        with nuts.app.app_context():
+            reports = nuts.maintain(
+                prune=args.prune, grace_period=args.grace_period,
+                refs=args.refs)
+        for path, report in sorted(reports.items()):
+            print(format_report(path, report))
+    grace_period = (
+        GRACE_PERIOD if args.grace_period is None else args.grace_period)
+    for path in args.repositories:
+        report = maintain(
+            Repo(path), prune=args.prune, grace_period=grace_period,
+            refs=args.refs)
+        print(format_report(path, report))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,313 @@
+"""PDF rendering engines for Pynuts.
+
+Documents are rendered in PDF by :attr:`pynuts.Pynuts.pdf_renderer`, chosen
+by the ``PYNUTS_PDF_RENDERER`` configuration key.
+
+"""
+
+import sys
+import math
+import signal
+import zipfile
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import flask
+from flask_weasyprint import HTML
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    from concurrent.futures import ProcessPoolExecutor, TimeoutError
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:  # Python 2
+    ProcessPoolExecutor = TimeoutError = BrokenProcessPool = None
+
+
+# Applications rendering documents in process pools, by name. Worker
+# processes are forked after the applications are registered, and find them
+# in their copy of this dict.
+_applications = {}
+
+
+class PDFTimeoutError(Exception):
+    """The PDF rendering took more time than allowed."""
+
+
+class _ApplicationNotFound(LookupError):
+    """The application is unknown to a worker process not forked from the
+    process registering it.
+
+    """
+
+
+def write_pdf(html):
+    """Render the ``html`` string in PDF.
+
+    Resources are fetched from the application of the current request
+    context.
+
+    """
+    return HTML(string=html, encoding='utf-8').write_pdf()
+
+
+def _raise_timeout(signum, frame):
+    """Stop the rendering of a worker process on ``SIGALRM``."""
+    raise PDFTimeoutError('PDF rendering took too much time.')
+
+
+def _write_pdf_in_context(app_name, path, url_root, html, timeout=None):
+    """Render the ``html`` string in PDF in a worker process.
+
+    A request context with the path and the URL root of the parent request
+    is pushed, so that resources are fetched from the application. The
+    rendering is stopped after ``timeout`` seconds where ``SIGALRM`` is
+    available.
+
+    """
+    if app_name not in _applications:
+        raise _ApplicationNotFound(app_name)
+    app = _applications[app_name]
+    alarm = timeout is not None and hasattr(signal, 'SIGALRM')
+    if alarm:
+        previous = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(max(1, int(math.ceil(timeout))))
+    try:
+        with app.test_request_context(path, base_url=url_root):
+            return write_pdf(html)
+    finally:
+        if alarm:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+class InlineRenderer(object):
+    """PDF renderer rendering documents in the current thread."""
+    def render(self, html):
+        """Return the PDF bytestring of the ``html`` string."""
+        return write_pdf(html)
+
+
+class ProcessPoolRenderer(object):
+    """PDF renderer rendering documents in a pool of processes.
+
+    Rendering is done inline when there is no request context to share with
+    the worker processes, when ``queue_size`` renderings are already pending,
+    or when the pool is broken.
+
+    Workers find the application in the memory of the process creating the
+    renderer, and are forked from it. Other start methods are only used when
+    given with `mp_context`, and then all the documents are rendered inline
+    as soon as a worker cannot find the application.
+
+    Workers only get the HTML, with the path and the URL root of the current
+    request: the session, :data:`flask.g` and the request headers are not
+    available to them. Resources are fetched by Flask-WeasyPrint with a new
+    test client, without the cookies and the authorization of the request,
+    as with inline rendering, so they must be public or embedded in the
+    HTML.
+
+    A worker still rendering after ``timeout`` seconds is stopped by an
+    alarm signal on Unix, so that it can take other renderings.
+
+    :param app: the Flask application
+    :param processes: number of worker processes, default is the number of
+        CPUs
+    :param timeout: maximum number of seconds to wait for a rendering,
+        ``None`` waits forever
+    :param queue_size: maximum number of pending renderings, ``None`` for no
+        limit
+    :param mp_context: :mod:`multiprocessing` context of the workers,
+        default is the ``fork`` context, other contexts need Python 3.7
+
+    :raises ValueError: when the ``fork`` start method is not available
+    :raises PDFTimeoutError: when the rendering takes more than ``timeout``
+        seconds
+
+    """
+    def __init__(self, app, processes=None, timeout=None, queue_size=None,
+                 mp_context=None):
+        if ProcessPoolExecutor is None:  # pragma: no cover
+            raise ImportError('The process PDF renderer needs Python 3.')
+        if mp_context is None:
+            try:
+                mp_context = multiprocessing.get_context('fork')
+            except ValueError:
+                raise ValueError(
+                    'The process PDF renderer needs the fork start method.')
+        if sys.version_info < (3, 7) and (
+                mp_context.get_start_method() != 'fork'):
+            raise ValueError(
+                'The process PDF renderer needs Python 3.7 for the %s start '
+                'method.' % mp_context.get_start_method())
+        self.app = app
+        self.processes = processes
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.mp_context = mp_context
+        #: Whether documents are rendered inline, as the workers cannot find
+        #: the application
+        self.inline = False
+        self.pending = 0
+        self._pool = None
+        self._lock = threading.Lock()
+        _applications[app.name] = app
+
+    @property
+    def pool(self):
+        """Process pool, created on first use."""
+        with self._lock:
+            if self._pool is None:
+                if sys.version_info < (3, 7):
+                    # Workers are forked, as checked by the constructor
+                    self._pool = ProcessPoolExecutor(self.processes)
+                else:
+                    self._pool = ProcessPoolExecutor(
+                        self.processes, mp_context=self.mp_context)
+            return self._pool
+
+    def _done(self, future):
+        """Update the number of pending renderings."""
+        with self._lock:
+            self.pending -= 1
+
+    def submit(self, html):
+        """Send the rendering of ``html`` to the pool and return a future.
+
+        Return ``None`` if the rendering has to be done inline.
+
+        """
+        if self.inline or not flask.has_request_context():
+            return None
+        with self._lock:
+            if self.queue_size is not None and (
+                    self.pending >= self.queue_size):
+                return None
+            self.pending += 1
+        try:
+            future = self.pool.submit(
+                _write_pdf_in_context, self.app.name, flask.request.path,
+                flask.request.url_root, html, self.timeout)
+        except RuntimeError:
+            # The pool is broken or shut down, use a new one next time
+            self._done(None)
+            self.shutdown(wait=False)
+            return None
+        future.add_done_callback(self._done)
+        return future
+
+    def render(self, html):
+        """Return the PDF bytestring of the ``html`` string."""
+        future = self.submit(html)
+        if future is None:
+            return write_pdf(html)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # Pending renderings are cancelled, running ones are stopped by
+            # the alarm of their worker
+            future.cancel()
+            raise PDFTimeoutError(
+                'PDF rendering took more than %s seconds.' % self.timeout)
+        except BrokenProcessPool:
+            # A worker died, use a new pool next time
+            self.shutdown(wait=False)
+            return write_pdf(html)
+        except _ApplicationNotFound:
+            # Workers are not forked, they will never find the application,
+            # and fail at once
+            self.inline = True
+            self.shutdown()
+            return write_pdf(html)
+
+    def shutdown(self, wait=True):
+        """Stop the worker processes."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+
+class _ZipStream(object):
+    """Write-only file object whose content is regularly drained."""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, bytestring):
+        """Store ``bytestring``."""
+        self.chunks.append(bytestring)
+        self.position += len(bytestring)
+        return len(bytestring)
+
+    def tell(self):
+        """Return the number of bytes written since the beginning."""
+        return self.position
+
+    def flush(self):
+        """Do nothing, content is kept until drained."""
+
+    def drain(self):
+        """Return and forget the content written since the last drain."""
+        chunks, self.chunks = self.chunks, []
+        return b''.join(chunks)
+
+
+def iter_zip(app, items, render, workers=4):
+    """Render ``items`` in threads and yield a ZIP file by chunks.
+
+    Files are added to the ZIP file as soon as they are rendered, and at most
+    ``workers`` items are rendered at the same time, so that memory is
+    bounded by the number of items being rendered.
+
+    :param app: the Flask application
+    :param items: iterable of objects to render
+    :param render: function taking an item and returning a
+        ``(filename, bytestring)`` tuple, called in a request context similar
+        to the current one
+    :param workers: number of items rendered at the same time
+
+    """
+    if flask.has_request_context():
+        path, url_root = flask.request.path, flask.request.url_root
+    else:
+        path, url_root = '/', None
+
+    def render_in_context(item):
+        """Render ``item``, returning a ``(success, result)`` tuple."""
+        try:
+            with app.test_request_context(path, base_url=url_root):
+                return True, render(item)
+        except Exception as exception:
+            return False, exception
+
+    results = Queue()
+    pool = ThreadPool(workers)
+    stream = _ZipStream()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED)
+    items = iter(items)
+    pending = 0
+    try:
+        while True:
+            for item in items:
+                pool.apply_async(
+                    render_in_context, (item,), callback=results.put)
+                pending += 1
+                if pending >= workers:
+                    break
+            if not pending:
+                break
+            success, result = results.get()
+            pending -= 1
+            if not success:
+                raise result
+            archive.writestr(*result)
+            yield stream.drain()
+        archive.close()
+        yield stream.drain()
+    finally:
+        pool.terminate()
@@ -0,0 +1,114 @@
+"""ReStructuredText rendering for Pynuts.
+
+Documents are rendered in two stages: their ReST source is parsed and
+transformed into a doctree, and the doctree is written as HTML. Doctrees
+are kept pickled in a cache, keyed by a hash of the source and of the
+settings used by the parser, so that a source rendered again with other
+writer settings, such as the stylesheet, is not parsed again.
+
+"""
+
+import hashlib
+
+import docutils.io
+import docutils.core
+import docutils.readers.doctree
+from docutils_html5 import Writer
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def writer_settings(writer):
+    """Return the set of the names of the settings specific to `writer`."""
+    names = set()
+    spec = writer.settings_spec or ()
+    for index in range(2, len(spec), 3):
+        for _, flags, options in spec[index]:
+            names.add(options.get('dest') or (
+                flags[0].lstrip('-').replace('-', '_')))
+    return names
+
+
+def _settings_key(source, settings, ignored=()):
+    """Return a hash of `source` and of the public `settings`."""
+    public_settings = sorted(
+        (key, repr(value)) for key, value in settings.items()
+        if not key.startswith('_') and key not in ignored)
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    key = hashlib.sha1(source)
+    key.update(repr(public_settings).encode('utf-8'))
+    return key.hexdigest()
+
+
+def doctree_key(source, settings, writer=None):
+    """Return a string identifying the doctree of `source`.
+
+    Private settings, whose names start with ``_``, and the settings of
+    `writer` are ignored.
+
+    """
+    return _settings_key(
+        source, settings, writer_settings(writer or Writer()))
+
+
+def parts_key(source, settings):
+    """Return a string identifying the HTML parts of `source`.
+
+    Private settings, whose names start with ``_``, are ignored.
+
+    """
+    return _settings_key(source, settings)
+
+
+def publish_doctree(source, settings, cache=None, writer=None):
+    """Return the pickled doctree of the ReST `source`.
+
+    :param source: ReST source, as a unicode or an UTF-8 encoded string
+    :param settings: dict of docutils settings
+    :param cache: cache storing the pickled doctrees, or ``None``
+    :param writer: writer whose settings are ignored in the cache key
+
+    """
+    key = doctree_key(source, settings, writer)
+    if cache is not None:
+        doctree = cache.get(key)
+        if doctree is not None:
+            return doctree
+    document = docutils.core.publish_doctree(
+        source, settings_overrides=settings)
+    # Settings may include unpicklable objects, the writer sets new ones
+    document.settings = document.reporter = document.transformer = None
+    doctree = pickle.dumps(document, pickle.HIGHEST_PROTOCOL)
+    if cache is not None:
+        cache.set(key, doctree)
+    return doctree
+
+
+def publish_parts(source, settings, cache=None, writer=None):
+    """Return the dict of the HTML parts of the ReST `source`.
+
+    The parts are the same as the ones given by
+    :func:`docutils.core.publish_parts`.
+
+    :param source: ReST source, as a unicode or an UTF-8 encoded string
+    :param settings: dict of docutils settings
+    :param cache: cache storing the pickled doctrees, or ``None``
+    :param writer: docutils writer, default is the HTML5 writer
+
+    """
+    writer = writer or Writer()
+    doctree = pickle.loads(publish_doctree(source, settings, cache, writer))
+    _, publisher = docutils.core.publish_programmatically(
+        source_class=docutils.io.DocTreeInput, source=doctree,
+        source_path=None, destination_class=docutils.io.StringOutput,
+        destination=None, destination_path=None,
+        reader=docutils.readers.doctree.Reader(parser_name='null'),
+        reader_name=None, parser=None, parser_name='null', writer=writer,
+        writer_name=None, settings=None, settings_spec=None,
+        settings_overrides=settings, config_section=None,
+        enable_exit_status=False)
+    return publisher.writer.parts
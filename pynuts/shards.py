@@ -0,0 +1,148 @@
+"""Document repository sharding for Pynuts.
+
+Documents can be stored in many bare repositories, called shards. Each
+document is routed to one shard, chosen by its type or by a hash of its id,
+so that the refs and the objects of a repository stay in reasonable numbers
+and shards can be backed up separately.
+
+Existing repositories are split into shards by :func:`split_repository`,
+also available as a command::
+
+    pynuts-split-repository documents.git 'documents-{shard}.git' 4
+
+"""
+
+import os
+import hashlib
+import argparse
+import threading
+
+from dulwich.repo import Repo
+
+try:
+    from urllib import unquote
+except ImportError:
+    from urllib.parse import unquote
+
+
+def open_repository(path):
+    """Return the bare repository at `path`, created if needed."""
+    if os.path.exists(path):
+        return Repo(path)
+    os.makedirs(path)
+    return Repo.init_bare(path)
+
+
+def shard_paths(path, shards):
+    """Return the list of the paths of the shards of the repository `path`.
+
+    `path` can include a ``{shard}`` placeholder replaced by the shard
+    number, otherwise the number is added before the extension of `path`.
+
+    """
+    if '{shard}' not in path:
+        root, extension = os.path.splitext(path)
+        path = root + '-{shard}' + extension
+    return [path.format(shard=shard) for shard in range(shards)]
+
+
+class ShardRouter(object):
+    """Route documents to the repositories storing them.
+
+    :param paths: list of the paths of the repositories
+    :param shard_by: ``'id'`` to route documents by a hash of their id,
+        ``'type'`` to route them by a hash of their type name
+    :param repositories: list of repositories already opened for `paths`
+
+    """
+    def __init__(self, paths, shard_by='id', repositories=None):
+        if shard_by not in ('id', 'type'):
+            raise ValueError('Documents are sharded by id or by type.')
+        self.paths = list(paths)
+        self.shard_by = shard_by
+        self._repositories = dict(enumerate(repositories or ()))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(key):
+        """Return a stable integer hash of the string `key`."""
+        return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16)
+
+    def shard(self, type_name, document_id):
+        """Return the number of the shard storing a document."""
+        if len(self.paths) == 1:
+            return 0
+        key = type_name if self.shard_by == 'type' else '%s' % document_id
+        return self._hash(key) % len(self.paths)
+
+    def get(self, shard):
+        """Return the repository of the `shard` number, opened once."""
+        with self._lock:
+            if shard not in self._repositories:
+                self._repositories[shard] = open_repository(self.paths[shard])
+            return self._repositories[shard]
+
+    def repository(self, type_name, document_id):
+        """Return the repository storing a document."""
+        return self.get(self.shard(type_name, document_id))
+
+    def repositories(self, type_name=None):
+        """Return the list of the repositories storing documents of the
+        type `type_name`, or of all the types.
+
+        """
+        if type_name is not None and self.shard_by == 'type':
+            return [self.get(self.shard(type_name, None))]
+        return [self.get(shard) for shard in range(len(self.paths))]
+
+
+def split_repository(source, router):
+    """Copy the document branches of the `source` repository to the shards
+    of `router`, and return the number of branches copied by shard.
+
+    Objects are copied in one pack by shard. The source repository is not
+    modified, and can be removed once the application uses the shards.
+
+    :param source: the dulwich repository to split
+    :param router: the :class:`ShardRouter` of the shards
+
+    """
+    refs_by_shard = {}
+    for ref, sha in source.get_refs().items():
+        parts = ref.decode('utf-8').split('/', 4)
+        if len(parts) != 5 or parts[:2] != ['refs', 'heads'] or (
+                parts[2] not in ('documents', 'archives')):
+            continue
+        shard = router.shard(unquote(parts[3]), unquote(parts[4]))
+        refs_by_shard.setdefault(shard, {})[ref] = sha
+
+    counts = {}
+    for shard, refs in refs_by_shard.items():
+        target = router.get(shard)
+        source.fetch(target, lambda remote_refs: list(set(refs.values())))
+        for ref, sha in refs.items():
+            target.refs[ref] = sha
+        counts[shard] = len(refs)
+    return counts
+
+
+def main(argv=None):
+    """Split a document repository into shards."""
+    parser = argparse.ArgumentParser(
+        description='Split a Pynuts document repository into shards.')
+    parser.add_argument('source', help='path of the repository to split')
+    parser.add_argument(
+        'target', help='path of the shards, with a {shard} placeholder')
+    parser.add_argument('shards', type=int, help='number of shards')
+    parser.add_argument(
+        '--by', choices=('id', 'type'), default='id',
+        help='route documents by a hash of their id or of their type')
+    args = parser.parse_args(argv)
+    router = ShardRouter(shard_paths(args.target, args.shards), args.by)
+    counts = split_repository(Repo(args.source), router)
+    for shard, path in enumerate(router.paths):
+        print('%s: %d branches' % (path, counts.get(shard, 0)))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -9,6 +9,50 @@ function hashCode(string) {
     return hash;
 }
 
+function text_ops(base, text) {
+    // Return the ops replacing the changed range of base by text
+    var start = 0;
+    var base_end = base.length;
+    var text_end = text.length;
+    while (start < base_end && start < text_end &&
+           base.charAt(start) == text.charAt(start)) {
+        start++;
+    }
+    while (base_end > start && text_end > start &&
+           base.charAt(base_end - 1) == text.charAt(text_end - 1)) {
+        base_end--;
+        text_end--;
+    }
+    // Do not split surrogate pairs
+    if (start > 0 && /[\uD800-\uDBFF]/.test(base.charAt(start - 1))) {
+        start--;
+    }
+    if (base_end < base.length &&
+        /[\uDC00-\uDFFF]/.test(base.charAt(base_end))) {
+        base_end++;
+        text_end++;
+    }
+    return [[start, base_end, text.substring(start, text_end)]];
+}
+
+function part_data($element, content) {
+    // Return the data saving content, as a delta if its base is known
+    var data = {
+        "part": $element.attr('data-part'),
+        "document_type": $element.attr('data-document-type'),
+        "document_id": $element.attr('data-document-id'),
+        "version": $element.attr('data-document-version')
+    };
+    var base = $element.data('pynuts-base');
+    if ($element.attr('data-blob') && typeof base == 'string') {
+        data.base = $element.attr('data-blob');
+        data.ops = text_ops(base, content);
+    } else {
+        data.content = content;
+    }
+    return {'element': $element, 'data': data, 'content': content};
+}
+
 function init_content (doc) {
     if (!doc) {
         doc = document;
@@ -42,13 +86,7 @@ function save_content (options) {
         $.each(divs, function () {
             var $this = $(this);
             if($this.attr('data-hash') != hashCode($this.html())) {
-                data.push({
-                    "part": $this.attr('data-part'),
-                    "document_type": $this.attr('data-document-type'),
-                    "document_id": $this.attr('data-document-id'),
-                    "version": $this.attr('data-document-version'),
-                    "content": $this.html()
-                });
+                data.push(part_data($this, $this.html()));
             }
             $(this).attr('data-hash', hashCode($(this).html()));
         });
@@ -62,13 +100,7 @@ function save_content (options) {
                 $.each(spans, function () {
                     values.push($(this).html());
                 });
-                data.push({
-                    "part": $this.attr('data-part'),
-                    "document_type": $this.attr('data-document-type'),
-                    "document_id": $this.attr('data-document-id'),
-                    "version": $this.attr('data-document-version'),
-                    "content": JSON.stringify(values)
-                });
+                data.push(part_data($this, JSON.stringify(values)));
             }
             $this.attr('data-hash', hashCode($this.html()));
         });
@@ -80,15 +112,19 @@ function save_content (options) {
         return false;
     }
 
+    // Make ajax
+    post_content(options, data, span_containers);
+}
+
+function post_content (options, data, span_containers) {
     // Get commit options
     var commit_message = options.message ? options.message : null;
     var commit_author = options.author ? options.author : null;
     var commit_author_email = options.author_email ? options.author_email : null;
-    // Make ajax
     $.ajax({
         url: '/_pynuts/update_content',
         data: JSON.stringify({
-            'data': data,
+            'data': $.map(data, function (item) { return item.data; }),
             'message': commit_message,
             'author': commit_author,
             'author_email': commit_author_email
@@ -106,11 +142,47 @@ function save_content (options) {
                     );
                     divs.attr('data-document-version', this.version);
                     span_containers.attr('data-document-version', this.version);
+                    // The saved contents are the bases of the next deltas
+                    var saved = this;
+                    $.each(data, function () {
+                        var item = this;
+                        if (item.data.document_type == saved.document_type &&
+                            item.data.document_id == saved.document_id &&
+                            saved.parts && item.data.part in saved.parts) {
+                            item.element.attr(
+                                'data-blob', saved.parts[item.data.part]);
+                            item.element.data('pynuts-base', item.content);
+                        }
+                    });
                 });
                 if ('success_callback' in options) options.success_callback();
             } else {
                 if ('fail_callback' in options) options.fail_callback();
             }
+        },
+        error: function(xhr) {
+            var response = null;
+            try {
+                response = $.parseJSON(xhr.responseText);
+            } catch (e) {}
+            if (xhr.status == 409 && response && response.resend) {
+                // The bases have changed, send the full contents
+                $.each(data, function () {
+                    var item = this;
+                    $.each(response.resend, function () {
+                        if (item.data.document_type == this.document_type &&
+                            item.data.document_id == this.document_id &&
+                            item.data.part == this.part) {
+                            delete item.data.base;
+                            delete item.data.ops;
+                            item.data.content = item.content;
+                        }
+                    });
+                });
+                post_content(options, data, span_containers);
+            } else {
+                if ('fail_callback' in options) options.fail_callback();
+            }
         }
     });
 }
@@ -198,6 +198,20 @@ class ModelView(object, with_metaclass(MetaView)):
             (column.key, getattr(self.data, column.key))
             for column in self.mapping.primary_key)
 
+    def cache_key(self):
+        """Return a JSON-serializable value identifying the viewed data.
+
+        It is used by :meth:`pynuts.document.Document.render_cache_key` when
+        the view is given as document data. The value includes all the
+        columns of the row, so that it changes when the row is updated.
+
+        """
+        if self.data is None:
+            return None
+        return [self.model.__name__, sorted(
+            (column.key, repr(getattr(self.data, column.key)))
+            for column in self.mapping.column_attrs)]
+
     @property
     def name(self):
         """Common name."""
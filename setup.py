@@ -15,5 +15,9 @@ setup(
     platforms="Any",
     packages=["pynuts"],
     package_data={'pynuts': ['templates/_pynuts/*.jinja2',
-                             'static/javascript/*.js']}
+                             'static/javascript/*.js']},
+    entry_points={
+        'console_scripts': [
+            'pynuts-maintenance = pynuts.maintenance:main',
+            'pynuts-split-repository = pynuts.shards:main']}
 )
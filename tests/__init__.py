@@ -38,6 +38,7 @@ def setup_fixture():
     app.config.from_pyfile('config/test.cfg')
     app.config.update({
         'PYNUTS_DOCUMENT_REPOSITORY': os.path.join(mkdtemp(), 'documents.git'),
+        'PYNUTS_JOB_DATABASE': os.path.join(mkdtemp(), 'jobs.sqlite'),
         'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + DATABASE})
     app.db = SQLAlchemy(app)
     model.reflect(app)
@@ -50,6 +51,7 @@ def teardown_fixture():
     """Remove the temp directory after the tests."""
     paths = (
         os.path.dirname(application.app.config['PYNUTS_DOCUMENT_REPOSITORY']),
+        os.path.dirname(application.app.config['PYNUTS_JOB_DATABASE']),
         application.app.config['UPLOADS_DEFAULT_DEST'])
     for path in paths:
         if os.path.exists(path):
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark storing a directory of a few thousand files.
+
+Run it with ``python tests/benchmark_git.py [files] [threads]``.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+from tempfile import mkdtemp
+
+from dulwich.repo import Repo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pynuts.git import Git
+
+
+def benchmark(files=3000, threads=4):
+    """Store a directory serially and in threads, and print the times."""
+    tempdir = mkdtemp()
+    try:
+        directory = os.path.join(tempdir, 'model')
+        for i in range(files):
+            sub_directory = os.path.join(directory, 'part%d' % (i % 50))
+            if not os.path.isdir(sub_directory):
+                os.makedirs(sub_directory)
+            with open(os.path.join(sub_directory, '%d.txt' % i), 'wb') as fd:
+                fd.write(os.urandom(4096) + b'Pynuts\n' * (i % 5000))
+
+        trees = []
+        for name, count in (('serial', 1), ('%d threads' % threads, threads)):
+            path = os.path.join(tempdir, name)
+            os.mkdir(path)
+            repo = Repo.init_bare(path)
+            start = time.time()
+            trees.append(Git(repo).store_directory(directory, count).id)
+            print('%s: %.3f s' % (name, time.time() - start))
+        assert trees[0] == trees[1]
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,63 @@
+""" Test suite of the cache module. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pynuts.cache import LRUCache, FileSystemCache
+
+
+class TestLRUCache(unittest.TestCase):
+    """Test suite for the LRU cache"""
+
+    def test_lru_cache(self):
+        """Test the behaviour of the LRUCache object."""
+        cache = LRUCache(2)
+        assert cache.get('a') is None
+        assert cache.misses == 1
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        assert cache.hits == 1
+        # 'b' is now the least recently used key
+        cache.set('c', 3)
+        assert 'b' not in cache
+        assert 'a' in cache and 'c' in cache
+        assert len(cache) == 2
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.hits == cache.misses == 0
+
+    def test_disabled_cache(self):
+        """Test that a cache of size 0 stores nothing."""
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        assert cache.get('a', 'default') == 'default'
+        assert len(cache) == 0
+
+
+class TestFileSystemCache(unittest.TestCase):
+    """Test suite for the file system cache"""
+
+    def setUp(self):
+        """Create a temporary directory."""
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Delete the temporary directory with its content."""
+        shutil.rmtree(self.tempdir)
+
+    def test_file_system_cache(self):
+        """Test the behaviour of the FileSystemCache object."""
+        path = os.path.join(self.tempdir, 'cache')
+        cache = FileSystemCache(path)
+        assert cache.get('pdf/a') is None
+        cache.set('pdf/a', b'%PDF')
+        cache.set('html/a', {'whole': u'<html>'})
+        assert cache.get('pdf/a') == b'%PDF'
+        # Values are shared between cache objects
+        assert FileSystemCache(path).get('html/a') == {'whole': u'<html>'}
+        assert (cache.hits, cache.misses) == (1, 1)
+        cache.clear()
+        assert cache.get('pdf/a') is None
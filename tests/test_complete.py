@@ -19,12 +19,24 @@
 
 import json
 import os
+import sys
+import time
+import shutil
+import zipfile
+import multiprocessing
 
 from flask import url_for
+from werkzeug.exceptions import BadRequest
 from io import BytesIO
+from tempfile import mkdtemp
 
-from pynuts.document import InvalidId
+from pynuts import maintenance, pdf
+from pynuts.directives import Editable
+from pynuts.document import InvalidId, apply_ops
+from pynuts.cache import LRUCache
 from pynuts.git import ConflictError
+from pynuts.pdf import ProcessPoolRenderer
+from pynuts.shards import ShardRouter, shard_paths, split_repository
 
 from . import (
     teardown_func, setup_func, setup_fixture as setup_module,
@@ -320,7 +332,10 @@ class TestComplete(object):
         with client.application.test_request_context():
             response = request(
                 client.get, url_for('html_employee', person_id=1))
-            assert 'EMPLOYEE\'S IDENTITY' in response.data.decode('utf-8')
+            html = response.data.decode('utf-8')
+            assert 'EMPLOYEE\'S IDENTITY' in html
+            assert 'data-content="true"' in html
+            assert 'pynuts-fragment' not in html
 
     @with_client
     def test_archived_html_employee(self, client):
@@ -339,6 +354,151 @@ class TestComplete(object):
                 content_type='application/pdf')
             assert b'%PDF' == response.data[:4]
 
+    @with_client
+    def test_process_pdf_employee(self, client):
+        """Test the PDF generation in a process pool."""
+        # Use the test app, not the vanilla app
+        from complete.application import nuts
+        renderer = ProcessPoolRenderer(client.application, processes=1)
+        # Mask the cached properties of the application renderer and cache
+        nuts.__dict__['pdf_renderer'] = renderer
+        nuts.__dict__['render_cache'] = None
+        try:
+            with client.application.test_request_context():
+                response = request(
+                    client.get, url_for('pdf_employee', person_id=1),
+                    content_type='application/pdf')
+                assert b'%PDF' == response.data[:4]
+                # The pending count is updated by a callback of the pool
+                deadline = time.time() + 10
+                while renderer.pending and time.time() < deadline:
+                    time.sleep(0.01)
+                assert renderer.pending == 0
+                assert renderer._pool is not None
+        finally:
+            renderer.shutdown()
+            del nuts.__dict__['pdf_renderer']
+            del nuts.__dict__['render_cache']
+
+    @with_client
+    def test_process_pdf_spawn(self, client):
+        """Test that spawned workers fall back to inline rendering."""
+        context = multiprocessing.get_context('spawn')
+        try:
+            renderer = ProcessPoolRenderer(
+                client.application, processes=1, mp_context=context)
+        except ValueError:
+            assert sys.version_info < (3, 7)
+            return
+        try:
+            with client.application.test_request_context():
+                assert renderer.render(u'<p>Spawn</p>')[:4] == b'%PDF'
+                assert renderer.inline
+                assert renderer.submit(u'<p>Inline</p>') is None
+        finally:
+            renderer.shutdown()
+
+    @with_client
+    def test_pdf_worker_timeout(self, client):
+        """Test that worker renderings are stopped after the timeout."""
+        renderer = ProcessPoolRenderer(client.application, timeout=1)
+        write_pdf = pdf.write_pdf
+        pdf.write_pdf = lambda html: time.sleep(10)
+        start = time.time()
+        try:
+            pdf._write_pdf_in_context(
+                client.application.name, '/', None, '', renderer.timeout)
+        except pdf.PDFTimeoutError:
+            assert time.time() - start < 5
+        else:
+            raise AssertionError('Rendering has not been stopped')
+        finally:
+            pdf.write_pdf = write_pdf
+
+    @with_client
+    def test_pdf_job(self, client):
+        """Test the PDF generation in background."""
+        from complete import document, view
+        from complete.application import nuts
+        with client.application.test_request_context():
+            response = request(
+                client.get, url_for('_pynuts-job', ticket='unknown'),
+                status_code=404, content_type='application/json')
+            ticket = document.EmployeeDoc.enqueue_pdf(
+                employee=view.EmployeeView(1), filename=u'report.pdf')
+            other_ticket = document.EmployeeDoc.enqueue_pdf(
+                employee=view.EmployeeView(1))
+            assert other_ticket != ticket
+            store = nuts.job_queue.store
+            job_id = store.get_ticket(ticket)['job']
+            assert store.get_ticket(other_ticket)['job'] == job_id
+            try:
+                document.EmployeeDoc.enqueue_pdf(
+                    employee=view.EmployeeView(1), extra=object())
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('Unidentified data has been enqueued')
+            for _ in range(100):
+                response = client.get(url_for('_pynuts-job', ticket=ticket))
+                if response.status_code != 202:
+                    break
+                time.sleep(0.05)
+            assert response.status_code == 200
+            assert 'application/pdf' in response.content_type
+            assert b'%PDF' == response.data[:4]
+            assert 'report.pdf' in response.headers['Content-Disposition']
+            response = client.get(url_for('_pynuts-job', ticket=other_ticket))
+            assert response.status_code == 200
+            assert 'report.pdf' not in response.headers['Content-Disposition']
+            # Job ids can be guessed, they do not give the PDF
+            response = client.get(url_for('_pynuts-job', ticket=job_id))
+            assert response.status_code == 404
+
+    def test_job_store(self):
+        """Test the claims, the tickets and the purge of the jobs."""
+        from pynuts.jobs import JobStore
+        tempdir = mkdtemp()
+        try:
+            store = JobStore(os.path.join(tempdir, 'jobs.sqlite'))
+            assert store.claim('job')
+            assert not store.claim('job', stale_after=60)
+            store.update('job', 'failed', error='Error')
+            assert store.claim('job', stale_after=60)
+            assert store.get('job')['error'] is None
+            store.update('job', 'running')
+            assert not store.claim('job', stale_after=60)
+            # Jobs lost by a restarted process are claimed again
+            assert store.claim('job', stale_after=-1)
+            store.update('job', 'done', pdf=b'%PDF')
+            assert not store.claim('job', stale_after=-1)
+            ticket = store.add_ticket('job', u'job.pdf')
+            assert store.get_ticket(ticket) == {
+                'id': ticket, 'job': 'job', 'filename': u'job.pdf'}
+            assert store.add_ticket('job') != ticket
+            store.purge(60)
+            assert store.get('job')['status'] == 'done'
+            assert store.get_ticket(ticket) is not None
+            store.purge(-1)
+            assert store.get('job') is None
+            assert store.get_ticket(ticket) is None
+        finally:
+            shutil.rmtree(tempdir)
+
+    @with_client
+    def test_pdf_export(self, client):
+        """Test the generation of a ZIP file of PDF documents."""
+        from complete import document, view
+        with client.application.test_request_context():
+            response = document.EmployeeDoc.download_pdfs(
+                [{'employee': view.EmployeeView(person_id)}
+                 for person_id in (1, 2)],
+                zip_filename=u'employees.zip', workers=2)
+            assert response.mimetype == 'application/zip'
+            archive = zipfile.ZipFile(BytesIO(response.get_data()))
+            assert sorted(archive.namelist()) == ['1.pdf', '2.pdf']
+            assert archive.read('1.pdf')[:4] == b'%PDF'
+
     @with_client
     def test_archived_pdf_employee(self, client):
         """Test the PDF generation archive."""
@@ -365,6 +525,33 @@ class TestComplete(object):
                     '/370fc6c4f1cf798e954791d7d9bbd169afabca71/logo.png',
                     content_type='image/png')
 
+    @with_client
+    def test_pynuts_resource_cache(self, client):
+        """Test the HTTP cache headers of the pynuts resource route."""
+        url = ('/_pynuts/resource/EmployeeDoc/1'
+               '/370fc6c4f1cf798e954791d7d9bbd169afabca71/logo.png')
+        with client.application.test_request_context():
+            response = request(client.get, url, content_type='image/png')
+            etag = response.headers['ETag']
+            length = len(response.data)
+            assert response.headers['Cache-Control'].startswith('private,')
+            assert 'immutable' in response.headers['Cache-Control']
+            response = client.get(url, headers={'If-None-Match': etag})
+            assert response.status_code == 304
+            assert response.data == b''
+            response = client.get(url, headers={'Range': 'bytes=0-3'})
+            assert response.status_code == 206
+            assert response.data == b'\x89PNG'
+            assert response.headers['Content-Range'] == (
+                'bytes 0-3/%d' % length)
+            response = client.get(
+                url, headers={'Range': 'bytes=%d-' % (length + 1)})
+            assert response.status_code == 416
+            request(client.get, url.replace('logo.png', 'nologo.png'),
+                    status_code=404)
+            request(client.get, url.replace('370fc6c4', 'HEAD'),
+                    status_code=404)
+
     @with_client
     def test_rights(self, client):
         """Test for rights."""
@@ -404,6 +591,371 @@ class TestComplete(object):
                         content_type='application/json')
             assert "document" in response.data.decode('utf-8')
 
+    @with_client
+    def test_update_content_delta(self, client):
+        """Test saving parts with deltas."""
+        from complete.application import nuts
+        document_class = nuts.documents['EmployeeDoc']
+        git = document_class('delta').git
+        git.tree = git._get_object(document_class._model_tree_id(git))
+        git.commit('Tester', 'tester@pynuts.org', 'Create')
+
+        def save(part, status_code=200, **values):
+            values.update(
+                part=part, document_type='EmployeeDoc', document_id='delta',
+                version=document_class('delta').version)
+            with client.application.test_request_context():
+                response = request(client.post, url_for(
+                    '_pynuts_resource_EmployeeDoc_update_content'),
+                    data=json.dumps({
+                        'data': [values], 'message': None, 'author': None,
+                        'author_email': None}),
+                    data_content_type='application/json',
+                    content_type='application/json', status_code=status_code)
+            return json.loads(response.data.decode('utf-8'))
+
+        document = save('comments', content=u'<p>Hello world \u263a</p>')
+        [document] = document['documents']
+        base = document['parts']['comments']
+        document = save('comments', base=base, ops=[[9, 14, u'Pynuts']])
+        [document] = document['documents']
+        assert document['parts']['comments'] != base
+        assert document_class('delta').git.read('comments') == (
+            u'<p>Hello Pynuts \u263a</p>'.encode('utf-8'))
+
+        response = save('comments', 409, base=base, ops=[[0, 0, u'Old']])
+        assert response['resend'] == [{
+            'document_type': 'EmployeeDoc', 'document_id': 'delta',
+            'part': 'comments'}]
+
+        version = document['version']
+        document = save('comments', content=u'<p>Hello Pynuts \u263a</p>')
+        assert document['documents'][0]['version'] == version
+
+        assert apply_ops(u'Hello', [[0, 1, u'J']]) == u'Jello'
+        for ops in ([[True, 1, u'J']], [[0, 1.0, u'J']], [[0, 1, 1]],
+                    [[0, 1]], {'0': [0, 1, u'J']}):
+            try:
+                apply_ops(u'Hello', ops)
+            except ValueError:
+                continue
+            raise Exception('Invalid operations must raise ValueError')
+        try:
+            save('comments', ops=[[0, 0, u'No base']])
+        except BadRequest:
+            pass
+        else:
+            raise Exception('Deltas without base must raise BadRequest')
+
+        try:
+            save('comments', base=document['documents'][0]['parts'][
+                'comments'], ops=[[10, 5, u'']])
+        except BadRequest:  # Trapped by the test configuration
+            return
+        raise Exception('This test must raise BadRequest')
+
+    def test_shared_environment(self):
+        """Test that documents of a same version share their environment."""
+        from complete.application import nuts
+
+        class EmployeeDoc(nuts.Document):
+            type_name = 'EmployeeDoc'
+
+        environment = EmployeeDoc(1).jinja_environment
+        hits = nuts.environment_cache.hits
+        assert EmployeeDoc(1).jinja_environment is environment
+        assert nuts.environment_cache.hits == hits + 1
+        assert EmployeeDoc(2).jinja_environment is not environment
+
+    def test_versions(self):
+        """Test the version records of a document."""
+        from complete.application import nuts
+
+        class EmployeeDoc(nuts.Document):
+            type_name = 'EmployeeDoc'
+
+        document = EmployeeDoc(1)
+        versions = document.versions()
+        assert versions[0].version == document.version
+        assert versions[0].datetime == document.datetime
+        assert [version.version for version in document.history] == [
+            version.version for version in versions]
+        document.get_content('index.rst.jinja2').write(b'New version')
+        new_versions = EmployeeDoc(1).versions(limit=1, after=document.version)
+        assert new_versions[0].id == versions[0].id
+        assert EmployeeDoc(1).versions()[0].message == 'Edit index.rst.jinja2'
+        history = EmployeeDoc(1).part_history('index.rst.jinja2', limit=1)
+        assert history[0].message == 'Edit index.rst.jinja2'
+        assert EmployeeDoc(1).part_history('style.css')[0].id != (
+            history[0].id)
+        changes = EmployeeDoc(1).diff(versions[0].id)
+        assert [change.path for change in changes] == ['index.rst.jinja2']
+        assert '+New version' in changes[0].diff.splitlines()
+
+    def test_list_document_ids(self):
+        """Test the paginated list of document ids."""
+        from complete.application import nuts
+
+        class EmployeeDoc(nuts.Document):
+            type_name = 'EmployeeDoc'
+
+        ids = list(EmployeeDoc.list_document_ids())
+        assert ids == sorted(ids)
+        assert EmployeeDoc.count_documents() == len(ids)
+        assert list(EmployeeDoc.list_document_ids(limit=1)) == ids[:1]
+        assert list(EmployeeDoc.list_document_ids(after=ids[0])) == ids[1:]
+        assert list(EmployeeDoc.list_document_ids(prefix=ids[0])) == [
+            document_id for document_id in ids
+            if document_id.startswith(ids[0])]
+        assert [document.document_id for document in (
+            EmployeeDoc.list_documents(offset=1))] == ids[1:]
+
+    def test_lazy_document(self):
+        """Test that documents only read the repository when needed."""
+        from complete.application import nuts
+
+        class EmployeeDoc(nuts.Document):
+            type_name = 'EmployeeDoc'
+
+        document = list(EmployeeDoc.list_documents(limit=1))[0]
+        version = document.version
+        assert 'git' not in document.__dict__
+        assert 'jinja_environment' not in document.__dict__
+        old_document = list(document.history)[0]
+        assert old_document.author == document.git.head.author.decode('utf-8')
+        assert old_document.datetime == document.datetime
+        assert old_document.version == version
+        assert 'git' not in old_document.__dict__
+        assert old_document.git.head.id.decode('ascii') == version
+
+    def test_render_cache_key(self):
+        """Test the key identifying the data of rendered documents."""
+        from complete.application import nuts
+
+        class EmployeeDoc(nuts.Document):
+            type_name = 'EmployeeDoc'
+
+        document = EmployeeDoc(1)
+        document.data = {'name': 'Tester', 'tags': [1, 2]}
+        key = document.render_cache_key()
+        document.data = {'tags': [1, 2], 'name': 'Tester'}
+        assert document.render_cache_key() == key
+        document.data = {'name': 'Other'}
+        assert document.render_cache_key() != key
+        document.data = {'employee': object()}
+        assert document.render_cache_key() is None
+
+    def test_directive_registry(self):
+        """Test that directives create each document version once."""
+        import docutils.core
+        from complete.application import nuts
+        document_class = nuts.documents['EmployeeDoc']
+        created = []
+
+        def create_document(*args):
+            created.append(args)
+            return document_class(*args)
+
+        version = document_class(1).version
+        path = 'EmployeeDoc/1/%s/index.rst.jinja2' % version
+        source = '\n\n'.join(['.. editable:: %s' % path] * 3 + [
+            '.. editable:: EmployeeDoc/1/%s/missing\n\n   Default' % version])
+        nuts.documents['EmployeeDoc'] = create_document
+        nuts.directive_cache.clear()
+        try:
+            html = docutils.core.publish_parts(
+                source, writer_name='html',
+                settings_overrides={'_pynuts': nuts})['body']
+            assert html.count('EMPLOYEE') == 3
+            assert 'Default' in html
+            assert created == [('1', version)]
+            # Two blob SHAs, one blob and one default content
+            assert nuts.directive_cache.misses == 4
+
+            del created[:]
+            docutils.core.publish_parts(
+                source, writer_name='html',
+                settings_overrides={'_pynuts': nuts})
+            assert created == []
+            assert nuts.directive_cache.hits == 4
+        finally:
+            nuts.documents['EmployeeDoc'] = document_class
+
+    def test_incremental_html(self):
+        """Test that new versions only render their changed fragments."""
+        from complete.application import nuts
+        document_class = nuts.documents['EmployeeDoc']
+        git = document_class('incremental').git
+        git.tree = git._get_object(document_class._model_tree_id(git))
+        git.commit('Tester', 'tester@pynuts.org', 'Create')
+
+        def render():
+            document = document_class('incremental')
+            document.data = {}
+            return document.version, document._generate_html(
+                part='comments.rst.jinja2')['article']
+
+        nuts.__dict__['render_cache'] = LRUCache(16)
+        try:
+            with nuts.app.test_request_context():
+                old_version, html = render()
+                assert old_version in html
+                assert 'data-part="comments"' in html
+
+                git.write('comments', b'<p>Incremental comment</p>')
+                git.commit('Tester', 'tester@pynuts.org', 'Comment')
+                doctree_calls = (
+                    nuts.doctree_cache.hits + nuts.doctree_cache.misses)
+                template_hits = nuts.template_cache.cache.hits
+                version, html = render()
+                assert version != old_version
+                assert version in html and old_version not in html
+                assert '<p>Incremental comment</p>' in html
+                # The templates have not been rendered, nor the ReST parsed again
+                assert doctree_calls == (
+                    nuts.doctree_cache.hits + nuts.doctree_cache.misses)
+                assert nuts.template_cache.cache.hits == template_hits
+
+                # Unchanged fragments are taken from the cache
+                git.write('other', b'Other')
+                git.commit('Tester', 'tester@pynuts.org', 'Other')
+                fragment_hits = nuts.directive_cache.hits
+                new_version, html = render()
+                assert new_version in html and version not in html
+                assert '<p>Incremental comment</p>' in html
+                assert nuts.directive_cache.hits > fragment_hits
+        finally:
+            del nuts.__dict__['render_cache']
+
+    def test_render_cache(self):
+        """Test that cached documents are rendered again when the documents
+        they include change.
+
+        """
+        from complete.application import nuts
+        from complete import view
+        document_class = nuts.documents['EmployeeDoc']
+        nuts.__dict__['render_cache'] = LRUCache(16)
+        try:
+            with nuts.app.test_request_context():
+                employee = view.EmployeeView(1)
+                version = document_class(1).version
+                git = document_class('cached').git
+                git.tree = git._get_object(document_class._model_tree_id(git))
+                git.commit('Tester', 'tester@pynuts.org', 'Create')
+
+                def render():
+                    document = document_class('cached')
+                    document.data = {'employee': employee}
+                    return document._generate_html()['article']
+
+                html = render()
+                assert version in html
+                hits = nuts.render_cache.hits
+                assert render() == html
+                assert nuts.render_cache.hits > hits
+
+                # Comments are included from the head of the document 1
+                other = document_class(1).git
+                other.write('other', b'Other')
+                other.commit('Tester', 'tester@pynuts.org', 'Other')
+                html = render()
+                assert other.head.id.decode('ascii') in html
+                assert version not in html
+        finally:
+            del nuts.__dict__['render_cache']
+
+    def test_skeleton_document(self):
+        """Test that skeletons reading the document commit are not reused."""
+        from complete.application import nuts
+        document_class = nuts.documents['EmployeeDoc']
+        git = document_class('dated').git
+        git.tree = git._get_object(document_class._model_tree_id(git))
+        git.write('dated.rst.jinja2', (
+            b'Saved {{ document.datetime }}: {{ document.message }}\n\n'
+            b'.. editable:: {{ document.type_name }}/'
+            b'{{ document.document_id }}/{{ document.version }}/comments'))
+        git.commit('Tester', 'tester@pynuts.org', 'Create')
+        nuts.__dict__['render_cache'] = LRUCache(16)
+        try:
+            with nuts.app.test_request_context():
+                for message in ('First save', 'Second save'):
+                    git.write('comments', message.encode('utf-8'))
+                    git.commit('Tester', 'tester@pynuts.org', message)
+                    document = document_class('dated')
+                    document.data = {}
+                    html = document._generate_html(
+                        part='dated.rst.jinja2')['article']
+                    assert 'Saved %s: %s' % (
+                        document.datetime, message) in html
+        finally:
+            del nuts.__dict__['render_cache']
+
+    def test_version_token(self):
+        """Test that only the version token is replaced by the version."""
+        from complete.application import nuts
+        document_class = nuts.documents['EmployeeDoc']
+        git = document_class('token').git
+        git.tree = git._get_object(document_class._model_tree_id(git))
+        git.write('zeros.rst.jinja2', (
+            u'Null %s, version {{ document.version }}' % ('0' * 40)
+        ).encode('utf-8'))
+        git.commit('Tester', 'tester@pynuts.org', 'Create')
+        nuts.__dict__['render_cache'] = LRUCache(16)
+        try:
+            with nuts.app.test_request_context():
+                document = document_class('token')
+                document.data = {}
+                html = document._generate_html(
+                    part='zeros.rst.jinja2')['article']
+                assert 'Null %s, version %s' % (
+                    '0' * 40, document.version) in html
+                assert nuts.version_token not in html
+        finally:
+            del nuts.__dict__['render_cache']
+
+    def test_fragment_markers(self):
+        """Test that forged fragment markers are not rendered."""
+        from complete.application import nuts
+        from pynuts.directives import DocumentRegistry, render_fragments
+        version = nuts.documents['EmployeeDoc'](1).version
+        marker = Editable(
+            'editable', ['EmployeeDoc/1/%s/index.rst.jinja2' % version], {},
+            [], 0, 0, '', None, None).fragment_marker(b'forged key')
+        html = render_fragments(marker, DocumentRegistry(nuts))
+        assert html == marker
+        marker = Editable(
+            'editable', ['EmployeeDoc/1/%s/index.rst.jinja2' % version], {},
+            [], 0, 0, '', None, None).fragment_marker(nuts.fragment_key)
+        html = render_fragments(marker, DocumentRegistry(nuts))
+        assert 'EMPLOYEE' in html and 'pynuts-fragment' not in html
+
+    def test_model_tree(self):
+        """Test that the model directory is only stored when it changes."""
+        from complete.application import nuts
+        model_path = os.path.join(mkdtemp(), 'models')
+        shutil.copytree(os.path.join(
+            PYNUTS_ROOT, 'docs', 'example', 'complete', 'models'), model_path)
+
+        class EmployeeDoc(nuts.Document):
+            type_name = 'EmployeeDoc'
+
+        EmployeeDoc.model_path = model_path
+        git = EmployeeDoc(1).git
+        tree_id = EmployeeDoc._model_tree_id(git)
+        store_directory, git.store_directory = git.store_directory, None
+        assert EmployeeDoc._model_tree_id(git) == tree_id
+        git.store_directory = store_directory
+
+        filename = os.path.join(model_path, 'index.rst.jinja2')
+        with open(filename, 'a') as fd:
+            fd.write('\nNew line\n')
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+        new_tree_id = EmployeeDoc._model_tree_id(git)
+        assert new_tree_id != tree_id
+        assert new_tree_id == git.store_directory(model_path).id
+        shutil.rmtree(os.path.dirname(model_path))
+
     def test_InvalidId(self):
         """Test InvalidId exception."""
         # Use Document from the vanilla app, not from the test app
@@ -456,4 +1008,77 @@ class TestComplete(object):
             return
         raise Exception('This test must raise ConflictError')
 
+    def test_merge_conflict(self):
+        """Test merging saves of different parts of a document."""
+        from complete.application import nuts
+
+        class EmployeeDoc(nuts.Document):
+            type_name = 'EmployeeDoc'
+
+        nuts.app.config['PYNUTS_MERGE_RETRIES'] = 2
+        try:
+            content1 = EmployeeDoc(1).get_content('comments.rst.jinja2')
+            content2 = EmployeeDoc(1).get_content('style.css')
+            content1.write(b'Comments')
+            content2.write(b'Style')
+            document = EmployeeDoc(1)
+            assert document.git.read('comments.rst.jinja2') == b'Comments'
+            assert document.git.read('style.css') == b'Style'
+        finally:
+            nuts.app.config['PYNUTS_MERGE_RETRIES'] = 0
+
+    @with_client
+    def test_shards(self, client):
+        """Test documents stored in many repositories."""
+        from complete.application import nuts
+
+        class EmployeeDoc(nuts.Document):
+            type_name = 'EmployeeDoc'
+
+        ids = list(EmployeeDoc.list_document_ids())
+        version = EmployeeDoc(1).version
+        tempdir = mkdtemp()
+        router = ShardRouter(shard_paths(
+            os.path.join(tempdir, 'documents.git'), 3))
+        try:
+            split_repository(nuts.document_repository, router)
+            nuts.repository_router = router
+            assert list(EmployeeDoc.list_document_ids()) == ids
+            assert list(EmployeeDoc.list_document_ids(offset=1, limit=1)) == (
+                ids[1:2])
+            assert EmployeeDoc.count_documents() == len(ids)
+            document = EmployeeDoc(1)
+            assert document.repository is router.repository('EmployeeDoc', 1)
+            assert document.version == version
+            document.get_content('style.css').write(b'Style')
+            assert EmployeeDoc(1).git.read('style.css') == b'Style'
+            with client.application.test_request_context():
+                response = request(client.get, url_for(
+                    '_pynuts_resource_EmployeeDoc', document_id=1,
+                    version=EmployeeDoc(1).version, filename='style.css'),
+                    content_type='text/css')
+            assert response.data == b'Style'
+        finally:
+            nuts.__dict__.pop('repository_router', None)
+            shutil.rmtree(tempdir)
+
+    def test_maintenance_command(self):
+        """Test the maintenance of the repositories of an application."""
+        from complete.application import nuts
+
+        tempdir = mkdtemp()
+        router = ShardRouter(shard_paths(
+            os.path.join(tempdir, 'documents.git'), 2))
+        try:
+            split_repository(nuts.document_repository, router)
+            nuts.repository_router = router
+            maintenance.main(['--app', 'complete.application:nuts'])
+            for repository in router.repositories():
+                stats = maintenance.repository_stats(repository)
+                assert stats['loose_objects'] == 0
+                assert stats['loose_refs'] == 0
+        finally:
+            nuts.__dict__.pop('repository_router', None)
+            shutil.rmtree(tempdir)
+
 # pylint: enable=R0201,W0613
@@ -1,6 +1,7 @@
 """ Test suite of the Git module. """
 
 import os.path
+import time
 import unittest
 import shutil
 import tempfile
@@ -8,8 +9,9 @@ import tempfile
 import jinja2
 
 from pynuts.git import (Git, ObjectTypeError, NotFoundError,
-                        ConflictError)
-from dulwich.repo import Repo
+                        ConflictError, RefIndex)
+from pynuts.maintenance import pack_objects
+from dulwich.repo import Repo, Blob
 
 
 class TestGit(unittest.TestCase):
@@ -49,7 +51,7 @@ class TestGit(unittest.TestCase):
         assert list(git.history()) == []
         git.commit('Alice', 'alice@pynuts.org', 'First commit')
         commit_1 = git.head.id
-        assert list(git.history()) == [commit_1]
+        assert [info.id for info in git.history()] == [commit_1]
         self.assertRaises(ConflictError, git2.commit,
                           'Alice', 'alice@pynuts.org', '(not) First commit')
 
@@ -62,7 +64,7 @@ class TestGit(unittest.TestCase):
         assert commit_2 != commit_1
         assert git.head.parents == [commit_1]
         assert git.repository.refs[b'refs/heads/master'] == commit_2
-        assert list(git.history()) == [commit_2, commit_1]
+        assert [info.id for info in git.history()] == [commit_2, commit_1]
 
         # Make sure we read from the filesystem
         git = Git(repo, branch='master', commit=commit_1)
@@ -97,3 +99,373 @@ class TestGit(unittest.TestCase):
         git = Git(repo, branch='inexistent')
         git.tree = git.store_directory(os.path.join(self.tempdir, 'refs'))
         assert git.read('heads/master').strip() == commit_2
+
+    def test_lookup_cache(self):
+        """Test that paths are resolved from the shared caches."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write('templates/sub/name.jinja', b'Pynuts')
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+
+        git = Git(repo, branch='master')
+        assert git.read('templates/sub/name.jinja') == b'Pynuts'
+        hits = Git.path_cache.hits
+        git = Git(repo, branch='master')
+        assert git.read('templates/sub/name.jinja') == b'Pynuts'
+        assert Git.path_cache.hits == hits + 1
+
+        # Writing changes the root tree, cached entries are not used anymore
+        git.write('templates/sub/name.jinja', b'Nuts')
+        assert git.read('templates/sub/name.jinja') == b'Nuts'
+        assert Git(repo, branch='master').read(
+            'templates/sub/name.jinja') == b'Pynuts'
+
+    def test_write_many(self):
+        """Test writing many files at once."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write('index.rst', b'Index')
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+
+        git.write_many({
+            'parts/a': b'A', 'parts/b': b'B', 'parts/sub/c': b'C',
+            'index.rst': b'New index'})
+        assert git.read('parts/a') == b'A'
+        assert git.read('parts/sub/c') == b'C'
+        assert git.read('index.rst') == b'New index'
+
+        tree_id = git.tree.id
+        self.assertRaises(ObjectTypeError, git.write_many, {
+            'parts/d': b'D', 'parts/a/e': b'E'})
+        self.assertRaises(ObjectTypeError, git.write_many, {
+            'parts': b'D'})
+        self.assertRaises(ObjectTypeError, git.write_many, {
+            'new/f': b'F', 'new': b'G'})
+        # The tree is unchanged after errors
+        assert git.tree.id == tree_id
+
+        with git.transaction():
+            git.write('parts/a', b'AA')
+            git.write('parts/sub/c', b'CC')
+            assert git.read('parts/a') == b'A'
+        assert git.read('parts/a') == b'AA'
+        assert git.read('parts/sub/c') == b'CC'
+        git.commit('Alice', 'alice@pynuts.org', 'Second commit')
+        git = Git(repo, branch='master')
+        assert git.read('parts/b') == b'B'
+        assert git.read('parts/sub/c') == b'CC'
+
+    def test_pack(self):
+        """Test writing the objects of a commit in a single pack."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master', pack=True)
+        git.write_many({'index.rst': b'Index', 'parts/a': b'A'})
+        # Pending objects can be read before being written
+        assert git.read('parts/a') == b'A'
+        git.write('parts/b', b'B')
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+        assert list(repo.object_store._iter_loose_objects()) == []
+        assert len([
+            name for name in os.listdir(repo.object_store.pack_dir)
+            if name.endswith('.pack')]) == 1
+
+        git = Git(repo, branch='master')
+        assert git.read('parts/a') == b'A'
+        assert git.read('parts/b') == b'B'
+
+    def test_store_big_file(self):
+        """Test storing and reading big files by chunks."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.chunk_size = 16
+        content = b''.join(
+            ('%d Pynuts\n' % i).encode('ascii') for i in range(1000))
+        directory = os.path.join(self.tempdir, 'model')
+        os.mkdir(directory)
+        with open(os.path.join(directory, 'big.txt'), 'wb') as fd:
+            fd.write(content)
+        with open(os.path.join(directory, 'small.txt'), 'wb') as fd:
+            fd.write(b'Small')
+
+        blob = git.store_file(os.path.join(directory, 'big.txt'))
+        assert blob.id == Blob.from_string(content).id
+        git.tree = git.store_directory(directory)
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+
+        git = Git(repo, branch='master')
+        git.chunk_size = 16
+        assert git.read('big.txt') == content
+        with git.open('big.txt') as reader:
+            assert reader.size == len(content)
+            assert reader.read(9) == b'0 Pynuts\n'
+            assert reader.read() == content[9:]
+            assert reader.read() == b''
+        with git.open('small.txt') as reader:
+            assert reader.read() == b'Small'
+        self.assertRaises(ObjectTypeError, git.open, 'big.txt/foo')
+
+        # Big files are kept loose with packed commits, then packed
+        git = Git(repo, branch='master', pack=True)
+        git.chunk_size = 16
+        git.tree = git.store_directory(directory)
+        assert git.tree.id == Git(repo, branch='master').tree.id
+        pack_objects(repo, grace_period=0)
+        assert not os.path.exists(os.path.join(
+            self.tempdir, 'objects', blob.id[:2].decode('ascii'),
+            blob.id[2:].decode('ascii')))
+        git = Git(Repo(self.tempdir), branch='master')
+        git.chunk_size = 16
+        with git.open('big.txt') as reader:
+            assert reader.size == len(content)
+            assert reader.read(9) == b'0 Pynuts\n'
+            assert reader.read() == content[9:]
+        with git.open('small.txt') as reader:
+            assert reader.read() == b'Small'
+
+    def test_store_directory(self):
+        """Test storing directories in parallel threads."""
+        directory = os.path.join(self.tempdir, 'model')
+        for i in range(20):
+            sub_directory = os.path.join(directory, 'part%d' % (i % 3))
+            if not os.path.isdir(sub_directory):
+                os.makedirs(sub_directory)
+            with open(os.path.join(sub_directory, '%d.txt' % i), 'wb') as fd:
+                # Some files have the same content
+                fd.write(('Pynuts %d\n' % (i % 7)).encode('ascii') * 1000)
+        os.mkdir(os.path.join(directory, 'empty'))
+
+        trees = []
+        for threads in (1, 4):
+            path = os.path.join(self.tempdir, str(threads))
+            os.mkdir(path)
+            repo = Repo.init_bare(path)
+            git = Git(repo, branch='master')
+            git.chunk_size = 4096
+            git.tree = git.store_directory(directory, threads=threads)
+            git.commit('Alice', 'alice@pynuts.org', 'First commit')
+            git = Git(repo, branch='master')
+            assert git.read('part2/14.txt') == b'Pynuts 0\n' * 1000
+            trees.append(git.tree.id)
+        assert trees[0] == trees[1]
+
+    def test_history(self):
+        """Test the paginated history read from the commit index."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        commits = []
+        for i in range(10):
+            git.write('file', ('Version %d' % i).encode('ascii'))
+            git.commit('Alice', 'alice@pynuts.org', 'Commit %d' % i)
+            commits.insert(0, git.head.id)
+            if i == 4:
+                # Index the first commits
+                assert len(git.history()) == 5
+
+        for index_commits in (True, False):
+            git = Git(repo, branch='master')
+            git.index_commits = index_commits
+            history = git.history()
+            assert [info.id for info in history] == commits
+            assert history[0].message == 'Commit 9'
+            assert history[0].author == 'Alice <alice@pynuts.org>'
+            assert history[0].parent == commits[1]
+            assert history[-1].parent is None
+            assert [info.id for info in git.history(offset=3, limit=2)] == (
+                commits[3:5])
+            page = git.history(limit=4, after=commits[2])
+            assert [info.id for info in page] == commits[3:7]
+            assert git.history(offset=20) == []
+            assert git.history(limit=0) == []
+            if index_commits:
+                assert [info.generation for info in history] == (
+                    list(range(10, 0, -1)))
+        assert os.path.exists(
+            os.path.join(self.tempdir, 'pynuts-commits.sqlite'))
+
+    def test_path_history(self):
+        """Test the history of the commits changing a path."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write('parts/a', b'A1')
+        git.commit('Alice', 'alice@pynuts.org', 'Add a')
+        commit_1 = git.head.id
+        git.write('parts/b', b'B1')
+        git.commit('Alice', 'alice@pynuts.org', 'Add b')
+        commit_2 = git.head.id
+        git.write('other', b'Other')
+        git.commit('Alice', 'alice@pynuts.org', 'Add other')
+        git.write('parts/a', b'A2')
+        git.commit('Bob', 'bob@pynuts.org', 'Edit a')
+        commit_4 = git.head.id
+        git.write('parts/a', b'A2')
+        git.commit('Bob', 'bob@pynuts.org', 'Edit nothing')
+
+        def ids(versions):
+            """Return the ids of the versions."""
+            return [version.id for version in versions]
+
+        assert ids(git.path_history('parts/a')) == [commit_4, commit_1]
+        assert ids(git.path_history('parts/b')) == [commit_2]
+        assert ids(git.path_history('parts')) == [commit_4, commit_2, commit_1]
+        assert ids(git.path_history('parts/a', limit=1)) == [commit_4]
+        assert git.path_history('parts/c') == []
+        assert git.path_history('parts/a/foo') == []
+        assert git.path_history('parts/a')[0].message == 'Edit a'
+        self.assertRaises(ValueError, git.path_history, '')
+
+        # Parents and trees are read from the commit index
+        git = Git(repo, branch='master')
+        for version in git.history():
+            os.remove(os.path.join(
+                self.tempdir, 'objects', version.version[:2],
+                version.version[2:]))
+        assert ids(git.path_history('parts')) == [commit_4, commit_2, commit_1]
+        git.index_commits = False
+        self.assertRaises(KeyError, git.path_history, 'parts')
+
+    def test_diff(self):
+        """Test the changes between two commits."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write_many({
+            'parts/a': b'Line 1\nLine 2\n', 'parts/b': b'B',
+            'image': b'\x89PNG\0', 'same/c': b'C', 'tree': b'File'})
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+        commit_1 = git.head.id
+        git.tree = Git(repo).tree
+        git.write_many({
+            'parts/a': b'Line 1\nLine 3\n', 'new': b'New',
+            'image': b'\x89PNG\0\0', 'same/c': b'C', 'tree/d': b'D'})
+        git.commit('Alice', 'alice@pynuts.org', 'Second commit')
+        commit_2 = git.head.id
+
+        changes = Git(repo, commit=commit_1).diff(commit_2)
+        assert [(change.path, change.status) for change in changes] == [
+            ('image', 'modified'), ('new', 'added'), ('parts/a', 'modified'),
+            ('parts/b', 'removed'), ('tree', 'removed'), ('tree/d', 'added')]
+        assert changes[0].diff is None
+        assert changes[2].diff.splitlines() == [
+            '--- a/parts/a', '+++ b/parts/a', '@@ -1,2 +1,2 @@',
+            ' Line 1', '-Line 2', '+Line 3']
+        assert changes[3].diff.splitlines()[:2] == [
+            '--- a/parts/b', '+++ /dev/null']
+        assert Git(repo, commit=commit_2).diff(commit_2) == []
+        assert Git(repo).diff(commit_1, text=False)[0].diff is None
+
+    def test_ref_index(self):
+        """Test the cached index of refs."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write('file', b'Content')
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+        with open(os.path.join(self.tempdir, 'packed-refs'), 'wb') as fd:
+            fd.write(b'# pack-refs with: peeled\n')
+            for i in range(10):
+                fd.write(git.head.id + (' refs/heads/docs/%d\n' % i).encode(
+                    'ascii'))
+        repo.refs[b'refs/heads/docs/a'] = git.head.id
+        repo.refs[b'refs/heads/docs/sub/b'] = git.head.id
+        repo.refs[b'refs/heads/docsx'] = git.head.id
+
+        index = RefIndex(repo, b'refs/heads/docs/')
+        index.racy_delay = 0
+        reads = []
+        read = index._read
+        index._read = lambda: reads.append(None) or read()
+        names = [str(i).encode('ascii') for i in range(10)] + [
+            b'a', b'sub/b']
+        assert index.names() == names
+        assert index.names() == names
+        assert len(reads) == 1
+        assert index.count() == 12
+        assert index.count(b'sub/') == 1
+        assert index.range(offset=2, limit=3) == names[2:5]
+        assert index.range(after=b'8') == names[9:]
+        assert index.range(prefix=b'su') == [b'sub/b']
+        assert index.range(prefix=b'z') == []
+
+        time.sleep(0.01)
+        repo.refs[b'refs/heads/docs/c'] = git.head.id
+        assert index.count() == 13
+        assert len(reads) == 2
+        del repo.refs[b'refs/heads/docs/c']
+        assert index.count() == 12
+
+        # Refs written by Git objects are added without reading the refs
+        time.sleep(0.01)
+        assert index.count() == 12
+        reads_count = len(reads)
+        new = Git(repo, branch='docs/b')
+        new.write('file', b'Content')
+        new.commit('Alice', 'alice@pynuts.org', 'First commit')
+        new.write('file', b'New content')
+        new.commit('Alice', 'alice@pynuts.org', 'Second commit')
+        assert index.names() == names[:10] + [b'a', b'b', b'sub/b']
+        assert len(reads) == reads_count
+        # Refs written by other means are found by the signature
+        time.sleep(0.01)
+        repo.refs[b'refs/heads/docs/d'] = git.head.id
+        assert index.count() == 14
+        assert len(reads) == reads_count + 1
+
+    def test_merge(self):
+        """Test merging concurrent commits changing different paths."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write_many({'a': b'A', 'parts/b': b'B', 'parts/c': b'C'})
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+        commit_1 = git.head.id
+
+        git_1 = Git(repo, branch='master', merge_retries=1)
+        git_2 = Git(repo, branch='master', merge_retries=1)
+        git_3 = Git(repo, branch='master', merge_retries=1)
+        git_4 = Git(repo, branch='master')
+        git_1.write('parts/b', b'B1')
+        git_1.commit('Alice', 'alice@pynuts.org', 'Edit b')
+        git_2.write_many({'parts/c': b'C2', 'parts/d/e': b'E2'})
+        git_2.commit('Bob', 'bob@pynuts.org', 'Edit c')
+        assert git_2.head.parents == [git_1.head.id]
+        assert git_2.read('parts/b') == b'B1'
+        assert git_2.read('parts/c') == b'C2'
+
+        git = Git(repo, branch='master')
+        assert git.head.id == git_2.head.id
+        assert git.read('parts/b') == b'B1'
+        assert git.read('parts/d/e') == b'E2'
+
+        # Same change on both sides
+        git_3.write('parts/b', b'B1')
+        git_3.commit('Alice', 'alice@pynuts.org', 'Edit b again')
+        # Overlapping changes
+        git_3 = Git(repo, branch='master', merge_retries=1)
+        git_4.merge_retries = 1
+        git_4.write('parts/c', b'C4')
+        git_3.write('parts/c', b'C3')
+        git_3.commit('Alice', 'alice@pynuts.org', 'Edit c')
+        self.assertRaises(
+            ConflictError, git_4.commit, 'Bob', 'bob@pynuts.org', 'Edit c')
+        # File added where a tree has been added
+        git_4 = Git(repo, branch='master', commit=commit_1, merge_retries=1)
+        git_4.write('parts/d', b'D')
+        self.assertRaises(
+            ConflictError, git_4.commit, 'Bob', 'bob@pynuts.org', 'Edit d')
+        assert Git(repo, branch='master').head.id == git_3.head.id
+
+        # Modes of the merged files are kept
+        git_5 = Git(repo, branch='master', merge_retries=1)
+        git_6 = Git(repo, branch='master', merge_retries=1)
+        git_5.tree = git_5.tree.copy()
+        git_5.tree[b'run'] = 0o100755, git_5.store_bytes(b'#!/bin/sh').id
+        repo.object_store.add_object(git_5.tree)
+        git_6.write('a', b'A6')
+        git_6.commit('Bob', 'bob@pynuts.org', 'Edit a')
+        git_5.commit('Alice', 'alice@pynuts.org', 'Add run')
+        git = Git(repo, branch='master')
+        assert git.read('a') == b'A6'
+        assert git.tree[b'run'][0] == 0o100755
+
+        # Deleted branches are not merged
+        git_5.write('a', b'A5')
+        del repo.refs[git_5.ref]
+        self.assertRaises(
+            ConflictError, git_5.commit, 'Alice', 'alice@pynuts.org', 'Edit')
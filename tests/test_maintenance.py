@@ -0,0 +1,164 @@
+""" Test suite of the Maintenance module. """
+
+import os
+import time
+import threading
+import unittest
+import shutil
+import tempfile
+
+from dulwich.file import GitFile
+from dulwich.objects import Blob, Tree
+from dulwich.repo import Repo
+
+from pynuts.git import Git, ConflictError, GitException
+from pynuts.maintenance import (
+    GRACE_PERIOD, maintain, pack_objects, repository_stats, main)
+
+
+class TestMaintenance(unittest.TestCase):
+    """Test suite for the Maintenance module"""
+
+    def setUp(self):
+        """Create a temporary repository with some documents."""
+        self.tempdir = tempfile.mkdtemp()
+        self.repository = Repo.init_bare(self.tempdir)
+        for i in range(5):
+            git = Git(self.repository, branch='documents/Doc/%d' % i)
+            git.write('index.rst', ('Document %d' % i).encode('ascii'))
+            git.commit('Alice', 'alice@pynuts.org', 'Create %d' % i)
+            git.write('index.rst', ('Document %d v2' % i).encode('ascii'))
+            git.commit('Alice', 'alice@pynuts.org', 'Edit %d' % i)
+
+    def tearDown(self):
+        """Delete the temporary directory with its content."""
+        shutil.rmtree(self.tempdir)
+
+    def _unreachable_blob(self, data, age):
+        """Store a blob not referenced by any commit, `age` seconds old."""
+        blob = Blob.from_string(data)
+        self.repository.object_store.add_object(blob)
+        path = self.repository.object_store._get_shafile_path(blob.id)
+        timestamp = time.time() - age
+        os.utime(path, (timestamp, timestamp))
+        return blob.id
+
+    def test_maintain(self):
+        """Test packing objects and refs, and pruning objects."""
+        old = self._unreachable_blob(b'Old', 2 * GRACE_PERIOD)
+        young = self._unreachable_blob(b'Young', 60)
+        git = Git(self.repository, branch='documents/Doc/4')
+
+        stats = repository_stats(self.repository)
+        assert stats['loose_objects'] == 5 * 6 + 2
+        assert stats['packs'] == 0
+        assert stats['loose_refs'] == 5
+
+        report = maintain(self.repository)
+        assert report['packed'] == 5 * 6
+        assert report['pruned'] == 1
+        assert report['refs'] == 5
+        assert report['before'] == stats
+        after = report['after']
+        assert after['loose_objects'] == 1
+        assert after['packs'] == 1
+        assert after['loose_refs'] == 0
+        assert old not in self.repository
+        assert young in self.repository
+
+        # Packed refs are read by open and new repositories
+        for repository in (self.repository, Repo(self.tempdir)):
+            for i in range(5):
+                document = Git(repository, branch='documents/Doc/%d' % i)
+                assert document.read('index.rst') == (
+                    'Document %d v2' % i).encode('ascii')
+
+        # Saves use the refs packed in the meantime
+        git.write('index.rst', b'Document 4 v3')
+        git.commit('Alice', 'alice@pynuts.org', 'Edit 4')
+        assert Repo(self.tempdir).refs[git.ref] == git.head.id
+        stale = Git(self.repository, branch='documents/Doc/4',
+                    commit=git.head.parents[0])
+        stale.write('index.rst', b'Stale')
+        self.assertRaises(
+            ConflictError, stale.commit, 'Bob', 'bob@pynuts.org', 'Stale')
+
+        # Packs are consolidated once they are old enough
+        report = maintain(self.repository, grace_period=0)
+        assert report['pruned'] == 1 + 3  # Young blob and stale commit
+        assert report['after']['loose_objects'] == 0
+        assert report['after']['packs'] == 1
+        assert young not in self.repository
+        assert git.read('index.rst') == b'Document 4 v3'
+        assert pack_objects(self.repository, grace_period=0) == (0, 0)
+
+    def test_freshen(self):
+        """Test that reused and recent objects are kept with their content."""
+        old = time.time() - 2 * GRACE_PERIOD
+        blob = self._unreachable_blob(b'Reused', 2 * GRACE_PERIOD)
+        tree = Tree()
+        tree.add(b'index.rst', 0o100644, blob)
+        self.repository.object_store.add_object(tree)
+        path = self.repository.object_store._get_shafile_path(tree.id)
+        os.utime(path, (old, old))
+
+        # The old tree is reused, its blob is kept
+        Git(self.repository).freshen(tree.id)
+        report = maintain(self.repository, refs=False)
+        assert report['pruned'] == 0
+        assert tree.id in self.repository and blob in self.repository
+
+        # Packed objects are freshened with their pack
+        maintain(self.repository, prune=False)
+        pack = self.repository.object_store.packs[0]
+        pack_path = os.path.join(
+            self.repository.object_store.pack_dir,
+            'pack-%s.pack' % pack.name().decode('ascii'))
+        os.utime(pack_path, (old, old))
+        Git(self.repository).freshen(blob)
+        assert os.stat(pack_path).st_mtime > old
+        report = maintain(self.repository)
+        assert report['pruned'] == 0
+        assert blob in Repo(self.tempdir)
+
+    def test_locked_ref(self):
+        """Test that saves wait for refs locked by the maintenance."""
+        git = Git(self.repository, branch='documents/Doc/0')
+        git.write('index.rst', b'Document 0 v3')
+        ref_path = os.path.join(self.tempdir, 'refs', 'heads', 'documents',
+                                'Doc', '0')
+        lock = GitFile(ref_path, 'wb')
+        threading.Timer(0.05, lock.abort).start()
+        git.commit('Alice', 'alice@pynuts.org', 'Edit 0')
+        assert Repo(self.tempdir).refs[git.ref] == git.head.id
+
+        git.write('index.rst', b'Document 0 v4')
+        git.lock_delays = ()
+        lock = GitFile(ref_path, 'wb')
+        try:
+            git.commit('Alice', 'alice@pynuts.org', 'Edit')
+        except ConflictError:
+            raise AssertionError('Locked refs are not conflicts')
+        except GitException:
+            pass
+        else:
+            raise AssertionError('Locked ref has been written')
+        finally:
+            lock.abort()
+
+    def test_no_prune(self):
+        """Test packing unreachable objects without removing them."""
+        old = self._unreachable_blob(b'Old', 2 * GRACE_PERIOD)
+        report = maintain(self.repository, prune=False, refs=False)
+        assert report['packed'] == 5 * 6 + 1
+        assert report['pruned'] == 0
+        assert report['after']['loose_objects'] == 0
+        assert report['after']['loose_refs'] == 5
+        assert old in Repo(self.tempdir)
+
+    def test_command(self):
+        """Test the maintenance command."""
+        main([self.tempdir, '--grace-period', '0'])
+        stats = repository_stats(Repo(self.tempdir))
+        assert stats['loose_objects'] == 0
+        assert stats['loose_refs'] == 0
@@ -0,0 +1,53 @@
+""" Test suite of the ReST module. """
+
+import unittest
+
+import docutils.core
+from docutils_html5 import Writer
+
+from pynuts.cache import LRUCache
+from pynuts.rest import doctree_key, publish_parts
+
+
+SOURCE = u'''
+Title
+=====
+
+Some *text* with a footnote [#]_.
+
+.. [#] Footnote
+
+Section
+-------
+
+.. raw:: html
+
+   <p>Raw</p>
+'''
+
+
+class TestRest(unittest.TestCase):
+    """Test suite for the ReST module"""
+
+    def test_publish_parts(self):
+        """Test that parts are the ones given by docutils."""
+        settings = {'stylesheet': 'style.css', '_pynuts': object()}
+        parts = docutils.core.publish_parts(
+            SOURCE, writer=Writer(), settings_overrides=settings)
+        assert publish_parts(SOURCE, settings) == parts
+        assert publish_parts(SOURCE.encode('utf-8'), settings) == parts
+
+    def test_doctree_cache(self):
+        """Test that sources are parsed once for all writer settings."""
+        cache = LRUCache()
+        parts = publish_parts(SOURCE, {'stylesheet': 'a.css'}, cache)
+        assert cache.misses == 1 and len(cache) == 1
+        other_parts = publish_parts(SOURCE, {'stylesheet': 'b.css'}, cache)
+        assert cache.hits == 1 and len(cache) == 1
+        assert parts['article'] == other_parts['article']
+        assert 'a.css' in parts['whole'] and 'b.css' in other_parts['whole']
+
+        publish_parts(SOURCE, {'tab_width': 4}, cache)
+        assert len(cache) == 2
+        assert doctree_key(SOURCE, {'_pynuts': 1}) == doctree_key(SOURCE, {})
+        assert doctree_key(SOURCE, {}) != doctree_key(SOURCE + u'Text', {})
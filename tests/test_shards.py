@@ -0,0 +1,81 @@
+""" Test suite of the Shards module. """
+
+import os.path
+import unittest
+import shutil
+import tempfile
+
+from dulwich.repo import Repo
+
+from pynuts.git import Git
+from pynuts.shards import ShardRouter, shard_paths, split_repository, main
+
+
+class TestShards(unittest.TestCase):
+    """Test suite for the Shards module"""
+
+    def setUp(self):
+        """Create a temporary directory."""
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Delete the temporary directory with its content."""
+        shutil.rmtree(self.tempdir)
+
+    def test_shard_paths(self):
+        """Test the paths of the shards."""
+        assert shard_paths('/a/documents.git', 2) == [
+            '/a/documents-0.git', '/a/documents-1.git']
+        assert shard_paths('/a/{shard}/documents.git', 2) == [
+            '/a/0/documents.git', '/a/1/documents.git']
+
+    def test_router(self):
+        """Test the routing of documents."""
+        paths = shard_paths(os.path.join(self.tempdir, 'shard.git'), 4)
+        router = ShardRouter(paths)
+        shards = set(router.shard('Doc', i) for i in range(100))
+        assert shards == set(range(4))
+        assert router.shard('Doc', 42) == ShardRouter(paths).shard('Doc', '42')
+        assert router.repository('Doc', 42).path == (
+            paths[router.shard('Doc', 42)])
+        assert router.repository('Doc', 42) is router.repository('Doc', 42)
+        assert len(router.repositories('Doc')) == 4
+
+        router = ShardRouter(paths, shard_by='type')
+        assert len(set(router.shard('Doc', i) for i in range(100))) == 1
+        assert len(router.repositories('Doc')) == 1
+        self.assertRaises(ValueError, ShardRouter, paths, 'foo')
+
+    def test_split_repository(self):
+        """Test splitting a repository into shards."""
+        source = Repo.init_bare(self.tempdir)
+        for i in range(10):
+            git = Git(source, branch='documents/Doc/%d' % i)
+            git.write('index.rst', ('Document %d' % i).encode('ascii'))
+            git.commit('Alice', 'alice@pynuts.org', 'Create %d' % i)
+        git = Git(source, branch='archives/Doc/3')
+        git.write('index.rst', b'Archive 3')
+        git.commit('Alice', 'alice@pynuts.org', 'Archive 3')
+        git = Git(source, branch='master')
+        git.write('other', b'Other')
+        git.commit('Alice', 'alice@pynuts.org', 'Other')
+
+        target = os.path.join(self.tempdir, 'shards', '{shard}.git')
+        router = ShardRouter(shard_paths(target, 3))
+        counts = split_repository(source, router)
+        assert sum(counts.values()) == 11
+        for i in range(10):
+            repository = router.repository('Doc', i)
+            git = Git(repository, branch='documents/Doc/%d' % i)
+            assert git.read('index.rst') == (
+                'Document %d' % i).encode('ascii')
+        git = Git(router.repository('Doc', 3), branch='archives/Doc/3')
+        assert git.read('index.rst') == b'Archive 3'
+        for repository in router.repositories():
+            assert b'refs/heads/master' not in repository.refs
+
+        target = os.path.join(self.tempdir, 'command', '{shard}.git')
+        main([self.tempdir, target, '2', '--by', 'type'])
+        router = ShardRouter(shard_paths(target, 2), 'type')
+        git = Git(router.repository('Doc', 5), branch='documents/Doc/5')
+        assert git.read('index.rst') == b'Document 5'